@@ -1,15 +1,46 @@
-from confluent_kafka.admin import AdminClient, NewTopic
+import os
 
-admin_client = AdminClient({'bootstrap.servers': 'localhost'})
+from confluent_kafka.admin import AdminClient, NewTopic, NewPartitions
+from dotenv import load_dotenv, find_dotenv
 
-new_topics = [NewTopic(topic, num_partitions=3, replication_factor=1)
-              for topic in ["localtostripe", "stripetolocal"]]
+from . import retry
 
-fs = admin_client.create_topics(new_topics)
+load_dotenv(find_dotenv())
 
-for topic, f in fs.items():
-    try:
-        f.result()
-        print("Topic {} created".format(topic))
-    except Exception as e:
-        print("Failed to create topic {}: {}".format(topic, e))
+# messages are keyed by customer ID, so partitions only bound consumer parallelism
+num_partitions = int(os.getenv("KAFKA_TOPIC_PARTITIONS", 3))
+replication_factor = int(os.getenv("KAFKA_TOPIC_REPLICATION_FACTOR", 1))
+
+admin_client = AdminClient(
+    {'bootstrap.servers': os.getenv("KAFKA_BOOTSTRAP_SERVERS", 'localhost')})
+
+topic_names = retry.SOURCE_TOPICS + retry.RETRY_TOPICS + retry.DEAD_LETTER_TOPICS
+existing_topics = admin_client.list_topics(timeout=10).topics
+
+new_topics = [NewTopic(topic, num_partitions=num_partitions, replication_factor=replication_factor)
+              for topic in topic_names if topic not in existing_topics]
+
+# existing topics can only grow, note that this remaps keys to other partitions
+grown_topics = [NewPartitions(topic, num_partitions)
+                for topic in topic_names
+                if topic in existing_topics and len(existing_topics[topic].partitions) < num_partitions]
+
+if new_topics:
+    fs = admin_client.create_topics(new_topics)
+
+    for topic, f in fs.items():
+        try:
+            f.result()
+            print("Topic {} created".format(topic))
+        except Exception as e:
+            print("Failed to create topic {}: {}".format(topic, e))
+
+if grown_topics:
+    fs = admin_client.create_partitions(grown_topics)
+
+    for topic, f in fs.items():
+        try:
+            f.result()
+            print("Topic {} grown to {} partitions".format(topic, num_partitions))
+        except Exception as e:
+            print("Failed to grow topic {}: {}".format(topic, e))
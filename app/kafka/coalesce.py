@@ -0,0 +1,119 @@
+import time
+
+from typing import Dict, List, Tuple
+
+from confluent_kafka import Message, TopicPartition
+
+from . import dispatcher, topics
+
+
+class Coalescer:
+    """
+    Buffer the messages of each key for a short window and keep only their
+    net effect: consecutive updates collapse to the latest one, updates
+    before a delete are dropped and a create followed by a delete cancels out.
+
+    Dropped messages are completed on the tracker right away. This is safe
+    since every dropped message has an offset below the buffered message
+    that supersedes it, which stays in flight until it is handled.
+    """
+
+    def __init__(self, window: float, tracker: dispatcher.OffsetTracker) -> None:
+        self._window = window
+        self._tracker = tracker
+        self._buffers: Dict[Tuple[str, bytes], List[Message]] = {}
+        self._deadlines: Dict[Tuple[str, bytes], float] = {}
+        self._ready: List[Message] = []
+
+    def add(self, msg: Message) -> None:
+        """
+        Buffer a message, already registered with the tracker, merging it with the buffered messages of its key.
+
+        Parameters:
+        - msg (Message): Kafka message object.
+
+        Returns:
+        None
+        """
+        if msg.key() is None:
+            self._ready.append(msg)
+            return
+
+        key = (msg.topic(), msg.key())
+        buffered = self._buffers.setdefault(key, [])
+        self._deadlines.setdefault(key, time.monotonic() + self._window)
+
+        operation = topics.get_operation(msg)
+        if operation == topics.UPDATE and buffered and topics.get_operation(buffered[-1]) == topics.UPDATE:
+            # updates carry the full customer state, the latest one wins
+            self._drop([buffered.pop()])
+        elif operation == topics.DELETE:
+            if buffered and topics.get_operation(buffered[0]) == topics.CREATE:
+                # created and deleted within the window, nothing to sync
+                self._drop(buffered + [msg])
+                del self._buffers[key]
+                del self._deadlines[key]
+                return
+            self._drop([m for m in buffered if topics.get_operation(m) == topics.UPDATE])
+            buffered[:] = [m for m in buffered if topics.get_operation(m) != topics.UPDATE]
+        buffered.append(msg)
+
+    def due(self) -> List[Message]:
+        """
+        Take the buffered messages whose window has elapsed.
+
+        Returns:
+        List[Message]: Messages to be handled, in order for each key.
+        """
+        now = time.monotonic()
+        msgs, self._ready = self._ready, []
+        for key in [key for key, deadline in self._deadlines.items() if deadline <= now]:
+            msgs.extend(self._buffers.pop(key))
+            del self._deadlines[key]
+        return msgs
+
+    def drain(self) -> List[Message]:
+        """
+        Take every buffered message regardless of its window.
+
+        Returns:
+        List[Message]: Messages to be handled, in order for each key.
+        """
+        msgs, self._ready = self._ready, []
+        for buffered in self._buffers.values():
+            msgs.extend(buffered)
+        self._buffers.clear()
+        self._deadlines.clear()
+        return msgs
+
+    def discard(self, partitions: List[TopicPartition]) -> None:
+        """
+        Drop the buffered messages of partitions without handling nor completing them.
+
+        Parameters:
+        - partitions (List[TopicPartition]): Partitions whose messages are dropped.
+
+        Returns:
+        None
+        """
+        lost = {(tp.topic, tp.partition) for tp in partitions}
+        self._ready = [msg for msg in self._ready
+                       if (msg.topic(), msg.partition()) not in lost]
+        # the messages of a key all come from the same partition
+        for key in [key for key, buffered in self._buffers.items()
+                    if (buffered[0].topic(), buffered[0].partition()) in lost]:
+            del self._buffers[key]
+            del self._deadlines[key]
+
+    def _drop(self, msgs: List[Message]) -> None:
+        """
+        Complete superseded messages without handling them.
+
+        Parameters:
+        - msgs (List[Message]): Kafka message objects.
+
+        Returns:
+        None
+        """
+        for msg in msgs:
+            self._tracker.complete(msg)
@@ -0,0 +1,110 @@
+import json
+import os
+
+from typing import Callable, Dict, Tuple, Union
+
+import msgpack
+import orjson
+from confluent_kafka import Message
+from dotenv import load_dotenv, find_dotenv
+from pydantic import BaseModel
+
+from ..sql import schemas
+from . import topics
+
+load_dotenv(find_dotenv())
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# json messages are written with orjson, its output stays readable by any JSON decoder
+ENCODERS: Dict[str, Callable[[Dict], bytes]] = {
+    JSON: orjson.dumps,
+    MSGPACK: msgpack.packb,
+}
+DECODERS: Dict[str, Callable[[bytes], Dict]] = {
+    JSON: orjson.loads,
+    MSGPACK: msgpack.unpackb,
+}
+
+FORMAT = os.getenv("KAFKA_MESSAGE_FORMAT", JSON)
+if FORMAT not in ENCODERS:
+    raise ValueError(f"Unknown KAFKA_MESSAGE_FORMAT {FORMAT}")
+
+
+class CustomerChange(BaseModel):
+    """
+    Version 1 of the customer change message. Changes from the local
+    database carry 'customer_id', changes from Stripe 'stripe_customer_id',
+    and deletes carry no 'customer'.
+    """
+
+    customer_id: Union[int, None] = None
+    stripe_customer_id: Union[str, None] = None
+    customer: Union[schemas.Customer, None] = None
+
+
+VERSION = 1
+SCHEMAS = {
+    1: CustomerChange,
+}
+
+
+def encode(data: Union[Dict, CustomerChange], format: str = None) -> Tuple[bytes, Dict[str, str]]:
+    """
+    Serialize a customer change with the current schema version.
+
+    Parameters:
+    - data (Dict or CustomerChange): Message data.
+    - format (str, optional): One of 'json' or 'msgpack', KAFKA_MESSAGE_FORMAT if None.
+
+    Returns:
+    Tuple[bytes, Dict[str, str]]: Message value and the headers describing its encoding.
+    """
+    format = format or FORMAT
+    if isinstance(data, CustomerChange):
+        data = data.model_dump(exclude_none=True)
+    headers = {topics.FORMAT_HEADER: format,
+               topics.VERSION_HEADER: str(VERSION)}
+    return ENCODERS[format](data), headers
+
+
+def decode_value(value: bytes, format: str = None, version: int = VERSION) -> CustomerChange:
+    """
+    Deserialize and validate a message value.
+
+    Parameters:
+    - value (bytes): Message value.
+    - format (str, optional): Encoding of the value, JSON if None.
+    - version (int, optional): Schema version of the value. Defaults to the current one.
+
+    Returns:
+    CustomerChange: Decoded customer change.
+    """
+    schema = SCHEMAS.get(version)
+    if schema is None:
+        raise ValueError(f"Unsupported message schema version {version}")
+    if format is None:
+        # messages produced before the format header were plain JSON
+        data = json.loads(value)
+    else:
+        decoder = DECODERS.get(format)
+        if decoder is None:
+            raise ValueError(f"Unsupported message format {format}")
+        data = decoder(value)
+    return schema.model_validate(data)
+
+
+def decode(msg: Message) -> CustomerChange:
+    """
+    Decode a Kafka message using the format and schema version from its headers.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    CustomerChange: Decoded customer change.
+    """
+    version = topics.get_header(msg, topics.VERSION_HEADER)
+    return decode_value(msg.value(), topics.get_header(msg, topics.FORMAT_HEADER),
+                        int(version) if version is not None else VERSION)
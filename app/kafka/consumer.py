@@ -1,12 +1,90 @@
-import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from typing import List, Tuple, Union
+
+from confluent_kafka import Consumer, Message, TopicPartition
+from dotenv import load_dotenv, find_dotenv
+
+from sqlalchemy.orm import scoped_session
+
+from .. import metrics, tracing
+from ..sql import database, idmapping, outstanding, schemas, syncstate, crud as sql_crud
+from ..stripeapp import crud as stripe_crud, echo
+from . import codec, coalesce, dispatcher, producer, retry, topics, transport
+
+load_dotenv(find_dotenv())
+
+BATCH_SIZE = int(os.getenv("KAFKA_CONSUMER_BATCH_SIZE", 1))
+BATCH_TIMEOUT = float(os.getenv("KAFKA_CONSUMER_BATCH_TIMEOUT", 1.0))
+LOCAL_TO_STRIPE_WORKERS = int(os.getenv("LOCAL_TO_STRIPE_WORKERS", 1))
+LOCAL_TO_STRIPE_MAX_IN_FLIGHT = int(
+    os.getenv("LOCAL_TO_STRIPE_MAX_IN_FLIGHT", 100))
+# seconds during which the messages of a customer are merged, 0 to disable
+COALESCE_WINDOW = float(os.getenv("KAFKA_CONSUMER_COALESCE_WINDOW", 0))
+# offsets of handled messages are committed asynchronously, after this many messages or seconds
+COMMIT_MESSAGES = int(os.getenv("KAFKA_CONSUMER_COMMIT_MESSAGES", 1000))
+COMMIT_INTERVAL = float(os.getenv("KAFKA_CONSUMER_COMMIT_INTERVAL", 1.0))
+# consumers of a single sync direction use '<group>-<topic>', so each direction scales on its own
+GROUP_ID = os.getenv("KAFKA_CONSUMER_GROUP", "mygroup")
+
+# one session per thread, the localtostripe workers must not share a session
+db = scoped_session(database.SessionLocal)
+# set by stop() to end the consume loops
+stopping = threading.Event()
+# messages consumed and time of the last commit, owned by the consume loop
+_uncommitted = 0
+_last_commit = time.monotonic()
+
+
+def idempotency_key(msg: Message) -> str:
+    """
+    Derive the Stripe idempotency key of a message from the topic, partition and offset
+    it was first consumed at, so a redelivered or retried message repeats the same request.
+
+    The trace ID tells apart offsets reused by a recreated topic or a restarted in-process bus,
+    and the replay count the messages replayed from a dead-letter topic.
 
-from confluent_kafka import Consumer, Message
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    str: Idempotency key.
+    """
+    partition = topics.get_header(
+        msg, topics.ORIGINAL_PARTITION_HEADER) or msg.partition()
+    offset = topics.get_header(
+        msg, topics.ORIGINAL_OFFSET_HEADER) or msg.offset()
+    trace_id = topics.get_header(msg, topics.TRACE_HEADER) or ""
+    key = f"kafsync-{retry.source_topic(msg)}-{partition}-{offset}-{trace_id}"
+    replays = topics.get_header(msg, topics.REPLAY_HEADER)
+    return f"{key}-replay-{replays}" if replays else key
 
-from ..sql import database, schemas, crud as sql_crud
-from ..stripeapp import crud as stripe_crud
-from . import producer
 
-db = database.SessionLocal()
+def current_stripe_customer(stripe_cust_id: Union[str, None]) -> Union[schemas.Customer, None]:
+    """
+    Fetch the current state of a Stripe customer, for retried or replayed messages whose payload may be stale.
+
+    Parameters:
+    - stripe_cust_id (str): ID of the Stripe customer, None if it has no Id mapping anymore.
+
+    Returns:
+    schemas.Customer: Current customer data, None if it was deleted meanwhile.
+    """
+    if stripe_cust_id is None:
+        return None
+    result = stripe_crud.get_customer(stripe_cust_id)
+    if not result.ok:
+        if result.error.code == "resource_missing":
+            return None
+        raise retry.HandlingError(f"Unable to get Stripe Customer {stripe_cust_id}: {result.error}",
+                                  result.error.retryable, result.error.kind)
+    if getattr(result.value, "deleted", False):
+        return None
+    return schemas.Customer(name=result.value.name, email=result.value.email)
 
 
 def handle_topic_stripe_to_local(msg: Message) -> None:
@@ -19,52 +97,84 @@ def handle_topic_stripe_to_local(msg: Message) -> None:
     Returns:
     None
     """
-    partition = msg.partition()
-    if partition == 0:
+    operation = topics.get_operation(msg)
+    if operation == topics.CREATE:
         # Create
-        data = json.loads(msg.value().decode('utf-8'))
-        customer = schemas.Customer(**data['customer'])
-        stripe_cust_id = data["stripe_customer_id"]
-
-        customer = sql_crud.create_customer(db, customer, create_message=False)
+        data = codec.decode(msg)
+        customer = data.customer
+        stripe_cust_id = data.stripe_customer_id
+        if retry.is_redelivered(msg):
+            # later changes may have been synced meanwhile, retry with the current state instead
+            customer = current_stripe_customer(stripe_cust_id)
+            if customer is None:
+                print(
+                    f"Skipped Create of Local Customer for {stripe_cust_id}, deleted meanwhile")
+                return
+
+        # a redelivered create updates the customer it created the first time
+        db_customer, created = sql_crud.upsert_external_customer(
+            db, stripe_cust_id, customer)
         print(
-            f"Sucessfully Created Local Customer with local id {customer.id}")
-
-        sql_crud.create_idmap(db, customer.id, stripe_cust_id)
+            f"Sucessfully {'Created' if created else 'Updated'} Local Customer with local id {db_customer.id}")
         print(
-            f"Sucessfully Created Id mapping of {customer.id} - {stripe_cust_id}")
+            f"Sucessfully Created Id mapping of {db_customer.id} - {stripe_cust_id}")
+        syncstate.save(db, db_customer.id, stripe_cust_id, customer)
 
-    elif partition == 1:
+    elif operation == topics.UPDATE:
         # Update
-        data = json.loads(msg.value().decode('utf-8'))
-        customer = schemas.Customer(**data['customer'])
+        data = codec.decode(msg)
+        customer = data.customer
 
-        if data.get('customer_id'):
-            customer_id = data['customer_id']
+        if data.customer_id:
+            customer_id = data.customer_id
         else:
-            stripe_cust_id = data["stripe_customer_id"]
-            customer_id = sql_crud.get_idmap_from_externalid(
-                db, stripe_cust_id).localid
+            stripe_cust_id = data.stripe_customer_id
+            customer_id = idmapping.get_localid(db, stripe_cust_id)
+            if customer_id is None:
+                # the create of the customer may still be retried
+                raise retry.HandlingError(
+                    f"No Id mapping found for {stripe_cust_id}", kind="missing_mapping")
+
+        if retry.is_redelivered(msg):
+            # later changes may have been synced meanwhile, retry with the current state instead
+            customer = current_stripe_customer(
+                data.stripe_customer_id or idmapping.get_externalid(db, customer_id))
+            if customer is None:
+                print(
+                    f"Skipped Update of Local Customer with local id {customer_id}, deleted meanwhile")
+                return
+
+        if syncstate.is_synced(db, customer, localid=customer_id):
+            print(
+                f"Skipped Update of Local Customer with local id {customer_id}, already synced")
+            return
 
         sql_crud.update_customer(
             db, customer_id, customer, create_message=False)
 
         print(
             f"Sucessfully Updated Local Customer with local id {customer_id}")
+        if data.stripe_customer_id:
+            syncstate.save(db, customer_id,
+                           data.stripe_customer_id, customer)
 
-    elif partition == 2:
+    elif operation == topics.DELETE:
         # Delete
-        data = json.loads(msg.value().decode('utf-8'))
+        data = codec.decode(msg)
 
-        if data.get('customer_id'):
-            customer_id = data['customer_id']
+        if data.customer_id:
+            customer_id = data.customer_id
         else:
-            stripe_cust_id = data["stripe_customer_id"]
-            customer_id = sql_crud.get_idmap_from_externalid(
-                db, stripe_cust_id).localid
+            stripe_cust_id = data.stripe_customer_id
+            customer_id = idmapping.get_localid(db, stripe_cust_id)
+            if customer_id is None:
+                # the create of the customer may still be retried
+                raise retry.HandlingError(
+                    f"No Id mapping found for {stripe_cust_id}", kind="missing_mapping")
 
         sql_crud.delete_customer(db, customer_id, create_message=False)
         sql_crud.delete_idmap_by_localid(db, customer_id)
+        syncstate.forget(db, [customer_id])
 
         print(
             f"Sucessfully Deleted Local Customer with local id {customer_id}")
@@ -83,59 +193,96 @@ def handle_topic_local_to_stripe(msg: Message) -> None:
     Returns:
     None
     """
-    partition = msg.partition()
-    if partition == 0:
+    operation = topics.get_operation(msg)
+    if operation == topics.CREATE:
         # Create
-        data = json.loads(msg.value().decode('utf-8'))
-        customer = schemas.Customer(**data['customer'])
+        data = codec.decode(msg)
+        customer = data.customer
 
-        stripe_customer_data = stripe_crud.create_customer(customer)
-        if stripe_customer_data.get("error") is not None:
-            print(stripe_customer_data)
+        # read from the database, a mapping cached by this process may have been deleted by another one
+        if idmapping.get_externalid(db, data.customer_id, fresh=True) is not None:
+            print(
+                f"Skipped Create of Stripe Customer with local id {data.customer_id}, already created")
             return
+        result = stripe_crud.create_customer(
+            customer, metadata=echo.origin_metadata(data.customer_id), idempotency_key=idempotency_key(msg))
+        if not result.ok:
+            raise retry.HandlingError(f"Unable to create Stripe Customer with local id {data.customer_id}: {result.error}",
+                                      result.error.retryable, result.error.kind)
 
         print(
-            f"Sucessfully Created Stripe Customer with local id {data['customer_id']}")
+            f"Sucessfully Created Stripe Customer with local id {data.customer_id}")
         idmap = sql_crud.create_idmap(
-            db, data['customer_id'], stripe_customer_data.id)
+            db, data.customer_id, result.value.id)
         print(
-            f"Sucessfully Created Id mapping of {data['customer_id']} - {idmap.externalid}")
-    elif partition == 1:
+            f"Sucessfully Created Id mapping of {data.customer_id} - {idmap.externalid}")
+        syncstate.save(db, data.customer_id, idmap.externalid, customer)
+    elif operation == topics.UPDATE:
         # Update
-        data = json.loads(msg.value().decode('utf-8'))
-        customer = schemas.Customer(**data['customer'])
-
-        stripe_cust_id = sql_crud.get_idmap_from_localid(db,
-                                                         data['customer_id']).externalid
-        stripe_customer_data = stripe_crud.update_customer(
-            stripe_cust_id, customer)
-        if stripe_customer_data.get("error") is not None:
-            print(stripe_customer_data)
+        data = codec.decode(msg)
+        customer = data.customer
+        if retry.is_redelivered(msg):
+            # later changes may have been synced meanwhile, retry with the current state instead
+            db_customer = sql_crud.get_customer(db, data.customer_id)
+            if db_customer is None:
+                print(
+                    f"Skipped Update of Stripe Customer with local id {data.customer_id}, deleted meanwhile")
+                return
+            customer = schemas.Customer(
+                name=db_customer.name, email=db_customer.email)
+
+        if syncstate.is_synced(db, customer, localid=data.customer_id):
+            print(
+                f"Skipped Update of Stripe Customer with local id {data.customer_id}, already synced")
             return
 
+        stripe_cust_id = idmapping.get_externalid(db, data.customer_id)
+        if stripe_cust_id is None:
+            # the create of the customer may still be retried
+            raise retry.HandlingError(
+                f"No Id mapping found for local id {data.customer_id}", kind="missing_mapping")
+        outstanding.register(db, stripe_cust_id, topics.UPDATE,
+                             syncstate.fingerprint(customer))
+        # retries send the current state, which may differ from the previous attempt
+        result = stripe_crud.update_customer(
+            stripe_cust_id, customer, idempotency_key=f"{idempotency_key(msg)}-{retry.get_attempt(msg)}")
+        if not result.ok:
+            raise retry.HandlingError(f"Unable to update Stripe Customer with local id {data.customer_id}: {result.error}",
+                                      result.error.retryable, result.error.kind)
+
         print(
-            f"Sucessfully Updated Stripe Customer with local id {data['customer_id']}")
-    elif partition == 2:
+            f"Sucessfully Updated Stripe Customer with local id {data.customer_id}")
+        syncstate.save(db, data.customer_id, stripe_cust_id, customer)
+    elif operation == topics.DELETE:
         # Delete
-        data = json.loads(msg.value().decode('utf-8'))
-
-        stripe_cust_id = sql_crud.get_idmap_from_localid(db,
-                                                         data['customer_id']).externalid
-        stripe_customer_data = stripe_crud.delete_customer(stripe_cust_id)
-        if stripe_customer_data.get("error") is not None:
-            print(stripe_customer_data)
-            return
-
-        sql_crud.delete_idmap_by_localid(db, data['customer_id'])
+        data = codec.decode(msg)
+
+        stripe_cust_id = idmapping.get_externalid(db, data.customer_id)
+        if stripe_cust_id is None:
+            # the create of the customer may still be retried
+            raise retry.HandlingError(
+                f"No Id mapping found for local id {data.customer_id}", kind="missing_mapping")
+        outstanding.register(db, stripe_cust_id, topics.DELETE)
+        result = stripe_crud.delete_customer(
+            stripe_cust_id, idempotency_key=idempotency_key(msg))
+        # a customer already deleted in Stripe only needs its mapping dropped
+        if not result.ok and result.error.code != "resource_missing":
+            raise retry.HandlingError(f"Unable to delete Stripe Customer with local id {data.customer_id}: {result.error}",
+                                      result.error.retryable, result.error.kind)
+
+        sql_crud.delete_idmap_by_localid(db, data.customer_id)
+        syncstate.forget(db, [data.customer_id])
         print(
-            f"Sucessfully Deleted Stripe Customer with local id {data['customer_id']}")
+            f"Sucessfully Deleted Stripe Customer with local id {data.customer_id}")
     else:
         print("Unable to handle this message")
 
 
 def handle_message(msg: Message) -> None:
     """
-    Handle Kafka messages based on their topics.
+    Handle Kafka messages based on their original topics, moving the ones that fail to a retry topic.
+
+    Raises when a failed message cannot be moved before stop() is called, it must then stay uncommitted.
 
     Parameters:
     - msg (Message): Kafka message object.
@@ -143,32 +290,518 @@ def handle_message(msg: Message) -> None:
     Returns:
     None
     """
-    topic = msg.topic()
-    if topic == "localtostripe":
-        handle_topic_local_to_stripe(msg)
-    elif topic == "stripetolocal":
-        handle_topic_stripe_to_local(msg)
-    else:
-        print(f"Can't Handle the topic {topic}")
+    topic = retry.source_topic(msg)
+    operation = topics.get_operation(msg) or "unknown"
+    start = time.perf_counter()
+    try:
+        with tracing.handling(msg):
+            if topic == topics.LOCAL_TO_STRIPE:
+                handle_topic_local_to_stripe(msg)
+            elif topic == topics.STRIPE_TO_LOCAL:
+                handle_topic_stripe_to_local(msg)
+            else:
+                print(f"Can't Handle the topic {topic}")
+    except Exception as e:
+        metrics.HANDLER_ERRORS.labels(topic, operation).inc()
+        db.rollback()
+        # waits for the message to be parked, so its offset is not committed before
+        retry.park(msg, e, stopping)
+    finally:
+        metrics.HANDLER_LATENCY.labels(topic, operation).observe(
+            time.perf_counter() - start)
+        # a session per message, nothing it loaded outlives the message
+        db.remove()
+
+
+tracker = dispatcher.OffsetTracker()
+# set up by run() for the topics it consumes
+local_to_stripe = None
+coalescer = None
+
+
+def dispatch_local_to_stripe(msg: Message) -> None:
+    """
+    Hand a 'localtostripe' message to the worker pool, keyed by its local customer ID.
+
+    Parameters:
+    - msg (Message): Kafka message object, already registered with the tracker.
+
+    Returns:
+    None
+    """
+    local_to_stripe.submit(msg.key(), msg)
+
 
+def process_message(msg: Message) -> None:
+    """
+    Register a Kafka message with the tracker and handle it, or buffer it when coalescing.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    None
+    """
+    tracker.begin(msg)
+    tracing.begin(msg, True)
+    if coalescer is not None:
+        coalescer.add(msg)
+    else:
+        route_message(msg)
 
-c = Consumer({
-    'bootstrap.servers': 'localhost',
-    'group.id': 'mygroup',
-    'auto.offset.reset': 'earliest'
-})
 
-c.subscribe(["localtostripe", "stripetolocal"])
+def route_message(msg: Message) -> None:
+    """
+    Handle a registered Kafka message, either inline or through the localtostripe worker pool.
 
-while True:
-    msg = c.poll(1.0)
+    Parameters:
+    - msg (Message): Kafka message object, already registered with the tracker.
 
-    if msg is None:
-        continue
-    if msg.error():
-        print("Consumer error: {}".format(msg.error()))
-        continue
+    Returns:
+    None
+    """
+    if local_to_stripe is not None and msg.topic() == topics.LOCAL_TO_STRIPE:
+        dispatch_local_to_stripe(msg)
+        return
 
     handle_message(msg)
+    tracker.complete(msg)
+
+
+def commit_completed(c: Consumer, asynchronous: bool = True) -> None:
+    """
+    Commit the offsets of every partition up to its first unfinished message.
+
+    Parameters:
+    - c (Consumer): Kafka consumer.
+    - asynchronous (bool, optional): Flag to indicate whether to commit without waiting. Defaults to True.
+
+    Returns:
+    None
+    """
+    offsets = tracker.committable()
+    if offsets:
+        c.commit(offsets=offsets, asynchronous=asynchronous)
+        tracing.committed(offsets)
+
+
+def maybe_commit(c: Consumer, consumed: int = 0) -> None:
+    """
+    Commit the completed offsets without waiting, once COMMIT_MESSAGES messages were consumed
+    or COMMIT_INTERVAL seconds passed since the last commit.
+
+    Parameters:
+    - c (Consumer): Kafka consumer.
+    - consumed (int, optional): Number of messages consumed since the previous call. Defaults to 0.
+
+    Returns:
+    None
+    """
+    global _uncommitted, _last_commit
+    _uncommitted += consumed
+    if _uncommitted < COMMIT_MESSAGES and time.monotonic() - _last_commit < COMMIT_INTERVAL:
+        return
+    commit_completed(c)
+    _uncommitted = 0
+    _last_commit = time.monotonic()
+
+
+def handle_topic_stripe_to_local_batch(msgs: List[Message]) -> None:
+    """
+    Handle a batch of messages from the 'stripetolocal' Kafka topic in a single transaction.
+
+    Parameters:
+    - msgs (List[Message]): Kafka message objects.
+
+    Returns:
+    None
+    """
+    creates, updates, deletes = [], [], []
+    for msg in msgs:
+        data = codec.decode(msg)
+        operation = topics.get_operation(msg)
+        if operation == topics.CREATE:
+            creates.append(data)
+        elif operation == topics.UPDATE:
+            updates.append(data)
+        elif operation == topics.DELETE:
+            deletes.append(data)
+        else:
+            print("Unable to handle this message")
+
+    with metrics.HANDLER_LATENCY.labels(topics.STRIPE_TO_LOCAL, "batch").time():
+        created, updated, deleted = sql_crud.apply_customer_batch(
+            db, creates, updates, deletes)
+    print(
+        f"Sucessfully Applied batch of {created} creates, {updated} updates and {deleted} deletes to Local Customers")
+
+
+def split_unbatchable(msgs: List[Message]) -> Tuple[List[Message], List[Message]]:
+    """
+    Set aside the creates whose email an earlier create of the batch already has, so a batch
+    never creates two customers with one email, and the messages replayed from a dead-letter
+    topic, which need the current Stripe state. The later messages of their key follow them.
+
+    Parameters:
+    - msgs (List[Message]): Kafka message objects from the 'stripetolocal' topic.
+
+    Returns:
+    Tuple[List[Message], List[Message]]: Messages to apply as a batch, and the ones to handle one by one afterwards, in order.
+    """
+    batch, deferred = [], []
+    emails, deferred_keys = set(), set()
+    for msg in msgs:
+        if msg.key() in deferred_keys or retry.is_redelivered(msg):
+            deferred_keys.add(msg.key())
+            deferred.append(msg)
+            continue
+        if topics.get_operation(msg) == topics.CREATE:
+            try:
+                email = codec.decode(msg).customer.email
+            except Exception:
+                # left to the batch, which fails over to handling its messages one by one
+                email = None
+            if email is not None and email in emails:
+                deferred_keys.add(msg.key())
+                deferred.append(msg)
+                continue
+            emails.add(email)
+        batch.append(msg)
+    return batch, deferred
+
+
+def handle_batch(msgs: List[Message]) -> None:
+    """
+    Handle a batch of Kafka messages, grouping the 'stripetolocal' ones.
+
+    Parameters:
+    - msgs (List[Message]): Kafka message objects.
+
+    Returns:
+    None
+    """
+    registered = []
+    for msg in msgs:
+        if msg.error():
+            print("Consumer error: {}".format(msg.error()))
+        else:
+            tracker.begin(msg)
+            tracing.begin(msg, True)
+            registered.append(msg)
+
+    if coalescer is not None:
+        for msg in registered:
+            coalescer.add(msg)
+        registered = coalescer.due()
+    route_batch(registered)
+
+
+def route_batch(msgs: List[Message]) -> None:
+    """
+    Handle a batch of registered Kafka messages, applying the 'stripetolocal' ones in a single transaction.
+
+    Parameters:
+    - msgs (List[Message]): Kafka message objects, already registered with the tracker.
+
+    Returns:
+    None
+    """
+    stripe_to_local = []
+    for msg in msgs:
+        if msg.topic() == topics.STRIPE_TO_LOCAL:
+            stripe_to_local.append(msg)
+        else:
+            route_message(msg)
+
+    stripe_to_local, deferred = split_unbatchable(stripe_to_local)
+    if stripe_to_local:
+        try:
+            with tracing.handling(*stripe_to_local):
+                handle_topic_stripe_to_local_batch(stripe_to_local)
+        except Exception as e:
+            # find the failing messages, only those go to the retry topic
+            print(f"Unable to apply batch of {len(stripe_to_local)} messages, handling them one by one: {e}")
+            db.rollback()
+            for msg in stripe_to_local:
+                handle_message(msg)
+        db.remove()
+        for msg in stripe_to_local:
+            tracker.complete(msg)
+    for msg in deferred:
+        handle_message(msg)
+        tracker.complete(msg)
+
+
+def consume_loop(c: Consumer) -> None:
+    """
+    Poll and handle messages one at a time.
+
+    Parameters:
+    - c (Consumer): Subscribed Kafka consumer.
 
-c.close()
+    Returns:
+    None
+    """
+    timeout = min(1.0, COALESCE_WINDOW) if coalescer is not None else 1.0
+    # wake up in time for the next commit
+    timeout = min(timeout, COMMIT_INTERVAL)
+    while not stopping.is_set():
+        msg = c.poll(timeout)
+        if coalescer is not None:
+            for due in coalescer.due():
+                route_message(due)
+        maybe_commit(c, 0 if msg is None else 1)
+
+        if msg is None:
+            continue
+        if msg.error():
+            print("Consumer error: {}".format(msg.error()))
+            continue
+
+        process_message(msg)
+
+
+def consume_batch_loop(c: Consumer, batch_size: int, timeout: float) -> None:
+    """
+    Consume and handle messages in batches, committing completed offsets along the way.
+
+    Parameters:
+    - c (Consumer): Subscribed Kafka consumer.
+    - batch_size (int): Maximum number of messages per batch.
+    - timeout (float): Maximum time to wait for a batch in seconds.
+
+    Returns:
+    None
+    """
+    timeout = min(timeout, COMMIT_INTERVAL)
+    while not stopping.is_set():
+        msgs = c.consume(batch_size, timeout)
+
+        if not msgs:
+            if coalescer is not None:
+                route_batch(coalescer.due())
+            # workers may still have completed messages in the meantime
+            maybe_commit(c)
+            continue
+
+        handle_batch(msgs)
+        maybe_commit(c, len(msgs))
+
+
+def group_id(sources: List[str]) -> str:
+    """
+    Get the consumer group of the consumers of some sync topics.
+
+    Parameters:
+    - sources (List[str]): Sync topic names.
+
+    Returns:
+    str: GROUP_ID when consuming both directions, '<GROUP_ID>-<topic>' for a single one.
+    """
+    if set(sources) == set(retry.SOURCE_TOPICS):
+        return GROUP_ID
+    return "-".join([GROUP_ID] + sorted(sources))
+
+
+def finish_in_flight() -> None:
+    """
+    Handle the held back messages and wait for the ones queued to the worker pool.
+
+    Returns:
+    None
+    """
+    if coalescer is not None:
+        route_batch(coalescer.drain())
+    if local_to_stripe is not None:
+        local_to_stripe.drain()
+
+
+def on_assign(c: Consumer, partitions: List[TopicPartition]) -> None:
+    """
+    Rebalance callback reporting the partitions assigned to this consumer.
+
+    Parameters:
+    - c (Consumer): Kafka consumer.
+    - partitions (List[TopicPartition]): Newly assigned partitions.
+
+    Returns:
+    None
+    """
+    print(f"Assigned {', '.join(f'{tp.topic}[{tp.partition}]' for tp in partitions)}")
+
+
+def on_revoke(c: Consumer, partitions: List[TopicPartition]) -> None:
+    """
+    Rebalance callback finishing the messages in flight and committing them before the partitions move to another consumer.
+
+    Parameters:
+    - c (Consumer): Kafka consumer.
+    - partitions (List[TopicPartition]): Revoked partitions.
+
+    Returns:
+    None
+    """
+    finish_in_flight()
+    commit_completed(c, asynchronous=False)
+    print(f"Revoked {', '.join(f'{tp.topic}[{tp.partition}]' for tp in partitions)}")
+
+
+def on_lost(c: Consumer, partitions: List[TopicPartition]) -> None:
+    """
+    Rebalance callback for partitions taken away without a chance to commit, their new owner handles the uncommitted messages again.
+
+    Their held back messages are dropped unhandled and their offsets forgotten, messages
+    already queued to the worker pool still complete but are no longer committed.
+
+    Parameters:
+    - c (Consumer): Kafka consumer.
+    - partitions (List[TopicPartition]): Lost partitions.
+
+    Returns:
+    None
+    """
+    if coalescer is not None:
+        coalescer.discard(partitions)
+    tracker.forget(partitions)
+    print(f"Lost {', '.join(f'{tp.topic}[{tp.partition}]' for tp in partitions)}")
+
+
+def create_consumer(sources: List[str] = retry.SOURCE_TOPICS) -> Consumer:
+    """
+    Create a consumer of the configured transport subscribed to sync topics.
+
+    Parameters:
+    - sources (List[str], optional): Sync topics to consume. Defaults to both.
+
+    Returns:
+    Consumer: Subscribed consumer.
+    """
+    c = transport.get_transport().create_consumer({
+        'group.id': group_id(sources),
+        'auto.offset.reset': 'earliest',
+        # offsets are only committed once their message is handled
+        'enable.auto.commit': False,
+        # feeds the consumer lag gauges
+        'statistics.interval.ms': int(os.getenv("KAFKA_CONSUMER_STATS_INTERVAL_MS", 5000)),
+        'stats_cb': metrics.record_consumer_stats,
+    })
+    c.subscribe(sources, on_assign=on_assign,
+                on_revoke=on_revoke, on_lost=on_lost)
+    return c
+
+
+def create_retry_consumer(sources: List[str] = retry.SOURCE_TOPICS) -> Consumer:
+    """
+    Create a consumer of the configured transport for the retry topics, subscribed by retry.consume_retries().
+
+    Parameters:
+    - sources (List[str], optional): Sync topics whose retry topics are consumed. Defaults to both.
+
+    Returns:
+    Consumer: Consumer committing by hand.
+    """
+    return transport.get_transport().create_consumer({
+        'group.id': f"{group_id(sources)}-retry",
+        'auto.offset.reset': 'earliest',
+        'enable.auto.commit': False,
+    })
+
+
+def run_retries(c: Consumer, sources: List[str]) -> None:
+    """
+    Handle the messages of the retry topics until stop() is called, then close the consumer.
+
+    Parameters:
+    - c (Consumer): Consumer created by create_retry_consumer().
+    - sources (List[str]): Sync topics whose retry topics are consumed.
+
+    Returns:
+    None
+    """
+    try:
+        retry.consume_retries(c, handle_message, stopping, sources)
+    except Exception:
+        # the message that could not be parked stays uncommitted, the consumer stops with it
+        stop()
+        raise
+    finally:
+        c.close()
+
+
+def run(sources: List[str] = retry.SOURCE_TOPICS) -> None:
+    """
+    Consume sync topics and their retry topics until stop() is called, then handle the
+    held back messages, commit and close the consumers.
+
+    The retry topics are consumed alongside, in a thread of their own.
+
+    Parameters:
+    - sources (List[str], optional): Sync topics to consume. Defaults to both.
+
+    Returns:
+    None
+    """
+    global local_to_stripe, coalescer
+    if topics.LOCAL_TO_STRIPE in sources and LOCAL_TO_STRIPE_WORKERS > 1:
+        # like the consume loop, a message that could not be parked ends the consumer
+        local_to_stripe = dispatcher.KeyedDispatcher(
+            handle_message, LOCAL_TO_STRIPE_WORKERS, LOCAL_TO_STRIPE_MAX_IN_FLIGHT, tracker,
+            on_error=lambda e: stop())
+    if COALESCE_WINDOW > 0:
+        coalescer = coalesce.Coalescer(COALESCE_WINDOW, tracker)
+
+    c = create_consumer(sources)
+    retries = threading.Thread(target=run_retries, args=(create_retry_consumer(sources), sources),
+                               name="retry-consumer", daemon=True)
+    retries.start()
+    try:
+        if BATCH_SIZE > 1:
+            consume_batch_loop(c, BATCH_SIZE, BATCH_TIMEOUT)
+        else:
+            consume_loop(c)
+    finally:
+        if coalescer is not None:
+            route_batch(coalescer.drain())
+        if local_to_stripe is not None:
+            local_to_stripe.stop()
+        commit_completed(c, asynchronous=False)
+        # leaves the group right away, instead of once the session times out
+        c.close()
+        stopping.set()
+        retries.join()
+        db.remove()
+
+
+def stop() -> None:
+    """
+    Make the running consume loop return after its current poll.
+
+    Returns:
+    None
+    """
+    stopping.set()
+
+
+def main(sources: List[str] = retry.SOURCE_TOPICS) -> None:
+    """
+    Run a consumer process, stopping gracefully on SIGTERM or SIGINT.
+
+    Parameters:
+    - sources (List[str], optional): Sync topics to consume. Defaults to both.
+
+    Returns:
+    None
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop())
+    database.configure_role(database.CONSUMER)
+    metrics.start_exporter("CONSUMER_METRICS_PORT", 9101)
+    print(f"Consuming {', '.join(sources)} as {group_id(sources)}")
+    run(sources)
+
+
+if __name__ == "__main__":
+    sources = sys.argv[1:] or retry.SOURCE_TOPICS
+    if not set(sources) <= set(retry.SOURCE_TOPICS):
+        sys.exit(f"Usage: python -m app.kafka.consumer [{' | '.join(retry.SOURCE_TOPICS)}]")
+    main(sources)
@@ -0,0 +1,192 @@
+import queue
+import threading
+import zlib
+
+from collections import deque
+from typing import Callable, Dict, List, Tuple
+
+from confluent_kafka import Message, TopicPartition
+
+
+class OffsetTracker:
+    """
+    Track in-flight messages per partition so that offsets are only committed
+    once every earlier message on the same partition has completed.
+
+    Each in-flight message is tagged with the assignment generation of its
+    partition, which forget() moves on, so a message of an earlier assignment
+    completing late is ignored. Kafka hands out a new Message object for
+    every delivery, which tells a redelivered message apart from the old one.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, int], deque] = {}
+        self._completed: Dict[Tuple[str, int], set] = {}
+        self._committable: Dict[Tuple[str, int], int] = {}
+        self._generations: Dict[Tuple[str, int], int] = {}
+        # id of each in-flight message -> its partition and generation
+        self._tags: Dict[int, Tuple[Tuple[str, int], int]] = {}
+
+    def begin(self, msg: Message) -> None:
+        """
+        Register a message as in flight. Messages of a partition must be
+        registered in offset order.
+
+        Parameters:
+        - msg (Message): Kafka message object.
+
+        Returns:
+        None
+        """
+        tp = (msg.topic(), msg.partition())
+        with self._lock:
+            self._pending.setdefault(tp, deque()).append(msg.offset())
+            self._completed.setdefault(tp, set())
+            self._tags[id(msg)] = (tp, self._generations.get(tp, 0))
+
+    def complete(self, msg: Message) -> None:
+        """
+        Mark a message as completed and advance the partition's commit point
+        over every contiguous completed offset.
+
+        Parameters:
+        - msg (Message): Kafka message object.
+
+        Returns:
+        None
+        """
+        tp = (msg.topic(), msg.partition())
+        with self._lock:
+            # a message of a forgotten assignment, its offsets are no longer ours to commit
+            if self._tags.pop(id(msg), None) != (tp, self._generations.get(tp, 0)):
+                return
+            pending = self._pending[tp]
+            completed = self._completed[tp]
+            completed.add(msg.offset())
+            while pending and pending[0] in completed:
+                offset = pending.popleft()
+                completed.discard(offset)
+                self._committable[tp] = offset + 1
+
+    def committable(self) -> List[TopicPartition]:
+        """
+        Get the offsets that became safe to commit since the last call.
+
+        Returns:
+        List[TopicPartition]: Offsets to be committed.
+        """
+        with self._lock:
+            offsets = [TopicPartition(topic, partition, offset)
+                       for (topic, partition), offset in self._committable.items()]
+            self._committable.clear()
+        return offsets
+
+    def forget(self, partitions: List[TopicPartition]) -> None:
+        """
+        Drop the in-flight messages and uncommitted offsets of partitions this consumer no longer owns.
+
+        Parameters:
+        - partitions (List[TopicPartition]): Partitions to forget.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            lost = {(tp.topic, tp.partition) for tp in partitions}
+            for tp in lost:
+                self._pending.pop(tp, None)
+                self._completed.pop(tp, None)
+                self._committable.pop(tp, None)
+                self._generations[tp] = self._generations.get(tp, 0) + 1
+            self._tags = {key: tag for key, tag in self._tags.items()
+                          if tag[0] not in lost}
+
+
+class KeyedDispatcher:
+    """
+    Run a message handler on a pool of worker threads. Messages sharing a key
+    always go to the same worker, so they are handled in order while messages
+    with different keys are handled in parallel.
+
+    A message whose handler raises is never completed, so it stays
+    uncommitted, and the error is passed to on_error.
+    """
+
+    def __init__(self, handler: Callable[[Message], None], workers: int, max_in_flight: int, tracker: OffsetTracker,
+                 on_error: Callable[[Exception], None] = None) -> None:
+        self._handler = handler
+        self._tracker = tracker
+        self._on_error = on_error
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(q,), name=f"dispatcher-{i}", daemon=True)
+                         for i, q in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: str, msg: Message) -> None:
+        """
+        Queue a message for the worker owning its key. Blocks while the
+        in-flight limit is reached.
+
+        Parameters:
+        - key (str): Ordering key of the message, such as the customer ID.
+        - msg (Message): Kafka message object, already registered with the tracker.
+
+        Returns:
+        None
+        """
+        self._in_flight.acquire()
+        worker = zlib.crc32(str(key).encode('utf-8')) % len(self._queues)
+        self._queues[worker].put(msg)
+
+    def drain(self) -> None:
+        """
+        Wait for all queued messages to be handled, leaving the workers running.
+
+        Returns:
+        None
+        """
+        for q in self._queues:
+            q.join()
+
+    def stop(self) -> None:
+        """
+        Wait for all queued messages to be handled and stop the workers.
+
+        Returns:
+        None
+        """
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, q: queue.Queue) -> None:
+        """
+        Handle the messages of one worker queue until stopped.
+
+        Parameters:
+        - q (queue.Queue): Queue of the worker.
+
+        Returns:
+        None
+        """
+        while True:
+            msg = q.get()
+            if msg is None:
+                q.task_done()
+                return
+            try:
+                self._handler(msg)
+            except Exception as e:
+                # left in flight, so neither it nor any later offset of its partition is committed
+                print(f"Unable to handle message at offset {msg.offset()}, leaving it uncommitted: {e}")
+                if self._on_error is not None:
+                    self._on_error(e)
+            else:
+                self._tracker.complete(msg)
+            finally:
+                self._in_flight.release()
+                q.task_done()
@@ -0,0 +1,132 @@
+import argparse
+import os
+import sys
+import uuid
+
+from typing import Dict, List
+
+from confluent_kafka import Consumer, Message
+from dotenv import load_dotenv, find_dotenv
+
+from . import producer, retry, topics, transport
+
+load_dotenv(find_dotenv())
+
+IDLE_TIMEOUT = 5.0
+# the dead-letter groups are named after the sync consumers' group
+GROUP_ID = os.getenv("KAFKA_CONSUMER_GROUP", "mygroup")
+
+
+def failure(msg: Message) -> Dict[str, str]:
+    """
+    Get the failure details of a dead-lettered message.
+
+    Parameters:
+    - msg (Message): Kafka message object from a dead-letter topic.
+
+    Returns:
+    Dict[str, str]: Original topic, partition and offset, operation, key, attempts, failure kind, reason and time, and replays.
+    """
+    details = {"key": msg.key().decode('utf-8') if msg.key() is not None else None}
+    for header in (topics.ORIGINAL_TOPIC_HEADER, topics.ORIGINAL_PARTITION_HEADER, topics.ORIGINAL_OFFSET_HEADER,
+                   topics.OPERATION_HEADER, topics.ATTEMPT_HEADER, topics.FAILURE_KIND_HEADER,
+                   topics.FAILURE_REASON_HEADER, topics.FAILED_AT_HEADER, topics.REPLAY_HEADER):
+        details[header] = topics.get_header(msg, header)
+    return details
+
+
+def read(c: Consumer, limit: int, idle_timeout: float) -> List[Message]:
+    """
+    Read messages until the limit is reached or none arrived for a while.
+
+    Parameters:
+    - c (Consumer): Subscribed consumer.
+    - limit (int): Maximum number of messages, 0 for no limit.
+    - idle_timeout (float): Seconds without a message after which the end is considered reached.
+
+    Returns:
+    List[Message]: Messages read.
+    """
+    msgs = []
+    while not limit or len(msgs) < limit:
+        msg = c.poll(idle_timeout)
+        if msg is None:
+            break
+        if msg.error():
+            print("Consumer error: {}".format(msg.error()))
+            continue
+        msgs.append(msg)
+    return msgs
+
+
+def replay(c: Consumer, limit: int, idle_timeout: float) -> int:
+    """
+    Produce dead-lettered messages back to their original topic with their retry count reset
+    and their replay count increased, committing each one once its copy is delivered.
+
+    Parameters:
+    - c (Consumer): Consumer of the dead-letter topics with auto commit disabled.
+    - limit (int): Maximum number of messages, 0 for no limit.
+    - idle_timeout (float): Seconds without a message after which the end is considered reached.
+
+    Returns:
+    int: Number of replayed messages.
+    """
+    replayed = 0
+    while not limit or replayed < limit:
+        msgs = read(c, 1, idle_timeout)
+        if not msgs:
+            break
+        msg = msgs[0]
+        headers = retry.original_headers(msg)
+        # a replay is a new request to Stripe, it must not get the response cached for the failed one
+        headers[topics.REPLAY_HEADER] = str(
+            int(headers.get(topics.REPLAY_HEADER, 0)) + 1)
+        retry.produce_copy(msg, retry.source_topic(msg), headers).result()
+        c.commit(message=msg, asynchronous=False)
+        replayed += 1
+    return replayed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Inspect or replay the messages of the dead-letter topics.")
+    parser.add_argument("command", choices=["list", "replay"])
+    parser.add_argument("--topic", choices=retry.SOURCE_TOPICS,
+                        help="original topic of the messages, both by default")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="maximum number of messages, 0 for all")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds without a message after which the end is considered reached")
+    args = parser.parse_args()
+
+    if transport.is_in_process():
+        sys.exit("The dead-letter topics of the in-process transport live in the API process, "
+                 "replay needs the Kafka transport")
+
+    sources = [args.topic] if args.topic else retry.SOURCE_TOPICS
+    if args.command == "list":
+        # a throwaway group, listing does not move the replay position
+        group = f"{GROUP_ID}-dlq-list-{uuid.uuid4()}"
+    else:
+        group = f"{GROUP_ID}-dlq-replay"
+    c = transport.get_transport().create_consumer({
+        'group.id': group,
+        'auto.offset.reset': 'earliest',
+        'enable.auto.commit': False,
+    })
+    c.subscribe([topics.dead_letter_topic(source) for source in sources])
+
+    try:
+        if args.command == "list":
+            for msg in read(c, args.limit, args.idle_timeout):
+                print(failure(msg))
+        else:
+            print(f"Replayed {replay(c, args.limit, args.idle_timeout)} messages")
+    finally:
+        c.close()
+        producer.flush()
+
+
+if __name__ == "__main__":
+    main()
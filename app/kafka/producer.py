@@ -1,14 +1,45 @@
-import json
+import asyncio
+import atexit
+import os
+import threading
+import time
 
-from confluent_kafka import Producer, Message
-from confluent_kafka.error import ProduceError
+from concurrent.futures import Future
+from functools import partial
+from typing import Dict, Union
 
-p = Producer({'bootstrap.servers': 'localhost'})
+from confluent_kafka import Producer, Message, KafkaException
+from dotenv import load_dotenv, find_dotenv
+
+from .. import metrics, tracing
+from . import codec, topics, transport
+
+load_dotenv(find_dotenv())
+
+PRODUCER_CONFIG = {
+    # let librdkafka batch messages instead of shipping each one on its own
+    'linger.ms': int(os.getenv("KAFKA_PRODUCER_LINGER_MS", 5)),
+    'batch.size': int(os.getenv("KAFKA_PRODUCER_BATCH_SIZE", 65536)),
+    'batch.num.messages': int(os.getenv("KAFKA_PRODUCER_BATCH_MESSAGES", 10000)),
+    # batches are compressed as a whole, so similar customer messages shrink well
+    'compression.type': os.getenv("KAFKA_PRODUCER_COMPRESSION", 'lz4'),
+}
+
+# created on first use, importing the module does not connect to anything
+p: Producer = None
+_client_lock = threading.Lock()
+metrics.PRODUCER_QUEUE_DEPTH.set_function(
+    lambda: len(p) if p is not None else 0)
+
+_poll_thread = None
+_poll_lock = threading.Lock()
+_poll_stop = threading.Event()
 
 
 def delivery_report(err, msg: Message) -> None:
     """
-    Called once for each message produced to indicate delivery result.
+    Called once for each message produced to report failed deliveries,
+    successful ones are only counted in the metrics.
     Triggered by poll() or flush().
 
     Parameters:
@@ -20,27 +51,178 @@ def delivery_report(err, msg: Message) -> None:
     """
     if err is not None:
         print('Message delivery failed: {}'.format(err))
+
+
+def _on_delivery(future: Future, start: float, err, msg: Message) -> None:
+    """
+    Delivery callback resolving the future handed out by produce_message.
+
+    Parameters:
+    - future (Future): Future to resolve with the delivery result.
+    - start (float): time.perf_counter() at which the message was enqueued.
+    - err: Delivery error (if any).
+    - msg: Message object.
+
+    Returns:
+    None
+    """
+    delivery_report(err, msg)
+    metrics.PRODUCE_LATENCY.labels(msg.topic()).observe(
+        time.perf_counter() - start)
+    if err is not None:
+        metrics.PRODUCE_ERRORS.labels(msg.topic()).inc()
+        future.set_exception(KafkaException(err))
     else:
-        print('Message delivered to {} [{}]'.format(
-            msg.topic(), msg.partition()))
+        future.set_result(msg)
+
+
+def client() -> Producer:
+    """
+    Get the producer of the configured transport, creating it on first use.
+
+    Returns:
+    Producer: Kafka producer, or the in-process one.
+    """
+    global p
+    if p is None:
+        with _client_lock:
+            if p is None:
+                p = transport.get_transport().create_producer(PRODUCER_CONFIG)
+    return p
+
+
+def _poll_loop() -> None:
+    """
+    Serve delivery callbacks in the background until the producer is stopped.
+
+    Returns:
+    None
+    """
+    producer = client()
+    while not _poll_stop.is_set():
+        producer.poll(0.1)
+
+
+def start_polling() -> None:
+    """
+    Start the background thread serving delivery callbacks, if not running yet.
+
+    Returns:
+    None
+    """
+    global _poll_thread
+    with _poll_lock:
+        if _poll_thread is not None and _poll_thread.is_alive():
+            return
+        _poll_stop.clear()
+        _poll_thread = threading.Thread(
+            target=_poll_loop, name="kafka-producer-poll", daemon=True)
+        _poll_thread.start()
 
 
-def produce_message(message: str, topic: str = None, partition: int = None) -> None:
+def flush(timeout: float = 10.0) -> int:
     """
-    Produce a message to a Kafka topic.
+    Wait for all queued messages to be delivered.
 
     Parameters:
-    - message (str): Message content.
-    - topic (str): Kafka topic to produce the message to.
-    - partition (int): Kafka partition to use for message delivery.
+    - timeout (float): Maximum time to wait in seconds.
+
+    Returns:
+    int: Number of messages still queued.
+    """
+    if p is None:
+        return 0
+    return p.flush(timeout)
+
+
+@atexit.register
+def close() -> None:
+    """
+    Stop the background poll thread and deliver any queued messages.
 
     Returns:
     None
     """
+    _poll_stop.set()
+    if _poll_thread is not None:
+        _poll_thread.join()
+    flush()
+
+
+def produce_message(message: Union[str, bytes], topic: str = None, key: str = None, headers: Dict[str, str] = None, partition: int = None) -> Future:
+    """
+    Enqueue a message for a Kafka topic without waiting for the broker.
+
+    Delivery happens in the background. Callers that need a durability
+    guarantee can wait on the returned future.
+
+    Parameters:
+    - message (str or bytes): Message content.
+    - topic (str): Kafka topic to produce the message to.
+    - key (str): Message key, messages sharing a key keep their order.
+    - headers (Dict[str, str]): Message headers.
+    - partition (int): Kafka partition to use for message delivery, chosen from the key by default.
+
+    Returns:
+    Future: Resolves to the delivered Message or raises KafkaException.
+    """
+    producer = client()
+    start_polling()
 
-    p.poll(0)
+    future = Future()
+    kwargs = {"callback": partial(_on_delivery, future, time.perf_counter())}
+    if key is not None:
+        kwargs["key"] = str(key).encode('utf-8')
+    if headers:
+        kwargs["headers"] = [(name, value.encode('utf-8'))
+                             for name, value in headers.items()]
+    if partition is not None:
+        kwargs["partition"] = partition
 
-    p.produce(topic, message.encode('utf-8'),
-              partition=partition, callback=delivery_report)
+    if isinstance(message, str):
+        message = message.encode('utf-8')
 
-    return p.flush()
+    while True:
+        try:
+            producer.produce(topic, message, **kwargs)
+            return future
+        except BufferError:
+            # local queue is full, give the poll thread time to drain it
+            producer.poll(0.1)
+
+
+def produce_event(topic: str, operation: str, key: str, data: Dict, origin: float = None, trace_id: str = None) -> Future:
+    """
+    Produce a customer change, keyed by customer ID with the operation, encoding and trace context in headers.
+
+    Parameters:
+    - topic (str): Kafka topic to produce the message to.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - key (str): Customer ID owning the change.
+    - data (Dict): Message data.
+    - origin (float, optional): Epoch time of the change, now if None.
+    - trace_id (str, optional): Trace ID to continue, a new one if None.
+
+    Returns:
+    Future: Resolves to the delivered Message or raises KafkaException.
+    """
+    value, headers = codec.encode(data)
+    headers[topics.OPERATION_HEADER] = operation
+    headers.update(tracing.headers(origin, trace_id))
+    return produce_message(value, topic=topic, key=key, headers=headers)
+
+
+async def produce_message_async(message: Union[str, bytes], topic: str = None, key: str = None, headers: Dict[str, str] = None) -> Message:
+    """
+    Produce a message to a Kafka topic and await its delivery.
+
+    Parameters:
+    - message (str or bytes): Message content.
+    - topic (str): Kafka topic to produce the message to.
+    - key (str): Message key, messages sharing a key keep their order.
+    - headers (Dict[str, str]): Message headers.
+
+    Returns:
+    Message: Delivered message.
+    """
+    return await asyncio.wrap_future(produce_message(message, topic, key, headers))
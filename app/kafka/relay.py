@@ -0,0 +1,109 @@
+import os
+import threading
+
+import orjson
+
+from concurrent.futures import wait
+
+from dotenv import load_dotenv, find_dotenv
+from sqlalchemy.orm import Session
+
+from .. import metrics
+from ..sql import database, models, crud as sql_crud
+from . import producer
+
+load_dotenv(find_dotenv())
+
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 500))
+POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 0.5))
+# sent events are kept for a day to help investigating sync issues
+RETENTION = float(os.getenv("OUTBOX_RETENTION", 24 * 60 * 60))
+
+# set when outbox events may have been committed, to relay them without waiting for the next poll
+wake = threading.Event()
+stopping = threading.Event()
+
+
+def relay_batch(db: Session, batch_size: int) -> int:
+    """
+    Produce a batch of pending outbox events and mark the delivered ones as sent.
+
+    Events that failed to be delivered stay pending and are retried with the
+    next batch, along with the later events of their key even when those were
+    delivered, so the key's events are received again in order. A single relay
+    must run at a time to keep the order per key.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - batch_size (int): Maximum number of events per batch.
+
+    Returns:
+    int: Number of events read from the outbox.
+    """
+    events = sql_crud.get_pending_outbox_events(db, batch_size)
+    if not events:
+        return 0
+
+    # outbox payloads are stored as readable JSON and encoded with the configured codec on the way out
+    futures = [(producer.produce_event(event.topic, event.operation, event.key, orjson.loads(event.payload),
+                                       origin=event.created_at), event)
+               for event in events]
+    wait([future for future, _ in futures])
+
+    # once an event of a key failed, the later ones stay pending too so they are sent again after it
+    sent_ids, failed_keys = [], set()
+    for future, event in futures:
+        if future.exception() is None and (event.topic, event.key) not in failed_keys:
+            sent_ids.append(event.id)
+        else:
+            failed_keys.add((event.topic, event.key))
+    sql_crud.mark_outbox_events_sent(db, sent_ids, RETENTION)
+
+    if len(sent_ids) < len(events):
+        print(f"Failed to relay {len(events) - len(sent_ids)} outbox events")
+    return len(events)
+
+
+def notify() -> None:
+    """
+    Wake the relay up, for writers sharing its process.
+
+    Returns:
+    None
+    """
+    wake.set()
+
+
+def run() -> None:
+    """
+    Relay the outbox in batches until stop() is called, polling it every POLL_INTERVAL seconds when idle.
+
+    Returns:
+    None
+    """
+    with database.SessionLocal() as db:
+        while not stopping.is_set():
+            wake.clear()
+            relayed = relay_batch(db, BATCH_SIZE)
+            if relayed < BATCH_SIZE:
+                # ends the read transaction, so the next batch sees the latest commits
+                db.commit()
+                wake.wait(POLL_INTERVAL)
+
+
+def stop() -> None:
+    """
+    Make the running relay return after its current batch.
+
+    Returns:
+    None
+    """
+    stopping.set()
+    wake.set()
+
+
+if __name__ == "__main__":
+    database.configure_role(database.RELAY)
+    models.Base.metadata.create_all(bind=database.engine)
+    metrics.start_exporter("RELAY_METRICS_PORT", 9103)
+    run()
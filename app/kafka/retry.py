@@ -0,0 +1,254 @@
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+from confluent_kafka import Consumer, Message, TopicPartition
+from dotenv import load_dotenv, find_dotenv
+
+from .. import metrics
+from . import producer, topics
+
+load_dotenv(find_dotenv())
+
+# delay in seconds of each retry topic, a message goes to the dead-letter topic once past the last one
+RETRY_DELAYS = [float(delay) for delay in os.getenv(
+    "KAFKA_RETRY_DELAYS", "5,30,300").split(",") if delay]
+SOURCE_TOPICS = [topics.LOCAL_TO_STRIPE, topics.STRIPE_TO_LOCAL]
+RETRY_TOPICS = [topics.retry_topic(topic, attempt)
+                for topic in SOURCE_TOPICS for attempt in range(1, len(RETRY_DELAYS) + 1)]
+DEAD_LETTER_TOPICS = [topics.dead_letter_topic(topic) for topic in SOURCE_TOPICS]
+FAILURE_HEADERS = (topics.ATTEMPT_HEADER, topics.RETRY_AT_HEADER, topics.FAILURE_KIND_HEADER,
+                   topics.FAILURE_REASON_HEADER, topics.FAILED_AT_HEADER)
+MAX_REASON_LENGTH = 1000
+# delay in seconds before producing a failed message to its retry topic again, doubling up to the max
+PARK_RETRY_BASE_DELAY = float(os.getenv("KAFKA_PARK_RETRY_BASE_DELAY", 1.0))
+PARK_RETRY_MAX_DELAY = float(os.getenv("KAFKA_PARK_RETRY_MAX_DELAY", 30.0))
+
+
+class HandlingError(Exception):
+    """
+    A message could not be handled. Retryable failures go through the retry
+    topics, the others straight to the dead-letter topic.
+    """
+
+    def __init__(self, message: str, retryable: bool = True, kind: str = "error") -> None:
+        super().__init__(message)
+        self.retryable = retryable
+        self.kind = kind
+
+
+def source_topic(msg: Message) -> str:
+    """
+    Get the topic a message was first produced to, before any retry.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    str: Original topic name.
+    """
+    return topics.get_header(msg, topics.ORIGINAL_TOPIC_HEADER) or msg.topic()
+
+
+def get_attempt(msg: Message) -> int:
+    """
+    Get the retry attempt a message is on.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    int: 0 for a first delivery.
+    """
+    return int(topics.get_header(msg, topics.ATTEMPT_HEADER) or 0)
+
+
+def is_redelivered(msg: Message) -> bool:
+    """
+    Check if a message failed before, either retried or replayed from a dead-letter topic.
+    Its payload may then be older than changes synced meanwhile.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    bool: True if the message is retried or replayed, False for a first delivery.
+    """
+    return get_attempt(msg) > 0 or topics.get_header(msg, topics.REPLAY_HEADER) is not None
+
+
+def retry_at(msg: Message) -> float:
+    """
+    Get the epoch time from which a retried message may be handled.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    float: Epoch time, 0 for a message that is not delayed.
+    """
+    return float(topics.get_header(msg, topics.RETRY_AT_HEADER) or 0)
+
+
+def original_headers(msg: Message) -> Dict[str, str]:
+    """
+    Get the headers of a message without its retry and failure details.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    Dict[str, str]: Message headers.
+    """
+    return {name: value.decode('utf-8') for name, value in msg.headers() or []
+            if name not in FAILURE_HEADERS}
+
+
+def produce_copy(msg: Message, topic: str, headers: Dict[str, str]) -> Future:
+    """
+    Produce a message again, with the same key and value, to another topic.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+    - topic (str): Kafka topic to produce the copy to.
+    - headers (Dict[str, str]): Headers of the copy.
+
+    Returns:
+    Future: Resolves to the delivered Message or raises KafkaException.
+    """
+    key = msg.key().decode('utf-8') if msg.key() is not None else None
+    return producer.produce_message(msg.value(), topic=topic, key=key, headers=headers)
+
+
+def reroute(msg: Message, error: Exception) -> Future:
+    """
+    Move a failed message to its next retry topic, or to the dead-letter topic once
+    its retries are exhausted or when the failure is not retryable.
+
+    Parameters:
+    - msg (Message): Kafka message object that failed to be handled.
+    - error (Exception): Failure, retryable unless it is a non retryable HandlingError.
+
+    Returns:
+    Future: Resolves once the message is delivered to its new topic.
+    """
+    source = source_topic(msg)
+    attempt = get_attempt(msg) + 1
+    kind = getattr(error, "kind", type(error).__name__)
+
+    headers = original_headers(msg)
+    # the first failure records where the message came from, later ones keep it
+    headers.setdefault(topics.ORIGINAL_TOPIC_HEADER, msg.topic())
+    headers.setdefault(topics.ORIGINAL_PARTITION_HEADER, str(msg.partition()))
+    headers.setdefault(topics.ORIGINAL_OFFSET_HEADER, str(msg.offset()))
+    headers[topics.ATTEMPT_HEADER] = str(attempt)
+    headers[topics.FAILURE_KIND_HEADER] = kind
+    headers[topics.FAILURE_REASON_HEADER] = str(error)[:MAX_REASON_LENGTH]
+    headers[topics.FAILED_AT_HEADER] = repr(time.time())
+
+    if getattr(error, "retryable", True) and attempt <= len(RETRY_DELAYS):
+        topic = topics.retry_topic(source, attempt)
+        headers[topics.RETRY_AT_HEADER] = repr(
+            time.time() + RETRY_DELAYS[attempt - 1])
+        metrics.RETRIED_MESSAGES.labels(source, str(attempt)).inc()
+        print(f"Retrying message from {source} in {RETRY_DELAYS[attempt - 1]}s: {error}")
+    else:
+        topic = topics.dead_letter_topic(source)
+        metrics.DEAD_LETTERS.labels(source, kind).inc()
+        print(f"Moved message from {source} to {topic} after {attempt} attempts: {error}")
+    return produce_copy(msg, topic, headers)
+
+
+def park(msg: Message, error: Exception, stopping: threading.Event) -> None:
+    """
+    Reroute a failed message and wait for its delivery, producing it again until it is delivered.
+
+    Parameters:
+    - msg (Message): Kafka message object that failed to be handled.
+    - error (Exception): Failure of the message.
+    - stopping (threading.Event): Event after which a failed delivery is raised instead of tried again.
+
+    Returns:
+    None
+    """
+    delay = PARK_RETRY_BASE_DELAY
+    while True:
+        try:
+            reroute(msg, error).result()
+            return
+        except Exception as e:
+            # the message must then stay uncommitted, so it is consumed again
+            if stopping.is_set():
+                raise
+            print(f"Unable to move message from {source_topic(msg)}, trying again in {delay}s: {e}")
+            stopping.wait(delay)
+            delay = min(delay * 2, PARK_RETRY_MAX_DELAY)
+
+
+def retry_topics(sources: List[str]) -> List[str]:
+    """
+    Get the retry topics of original topics.
+
+    Parameters:
+    - sources (List[str]): Original topic names.
+
+    Returns:
+    List[str]: Retry topic names, in attempt order for each original topic.
+    """
+    return [topic for topic in RETRY_TOPICS if topic.rsplit("-retry-", 1)[0] in sources]
+
+
+def consume_retries(c: Consumer, handler: Callable[[Message], None], stopping: threading.Event,
+                    sources: List[str] = SOURCE_TOPICS) -> None:
+    """
+    Handle the messages of the retry topics once their delay has passed, until stopping is set.
+
+    A message that is not due yet is held back and its partition paused, so the
+    other partitions and tiers keep flowing. Every message of a retry topic was
+    delayed by the same amount, so the ones behind it are not due earlier.
+
+    Parameters:
+    - c (Consumer): Consumer with auto commit disabled, not subscribed yet.
+    - handler (Callable[[Message], None]): Message handler, rerouting the messages that fail again.
+    - stopping (threading.Event): Event ending the loop.
+    - sources (List[str], optional): Original topics whose retry topics to consume. Defaults to both sync topics.
+
+    Returns:
+    None
+    """
+    held: Dict[Tuple[str, int], Message] = {}
+
+    def on_revoke(consumer: Consumer, partitions: List[TopicPartition]) -> None:
+        # the new owner of a partition reads its held message again
+        for tp in partitions:
+            held.pop((tp.topic, tp.partition), None)
+
+    def handle(msg: Message) -> None:
+        handler(msg)
+        c.commit(message=msg, asynchronous=True)
+
+    c.subscribe(retry_topics(sources), on_revoke=on_revoke)
+    while not stopping.is_set():
+        now = time.time()
+        for tp, msg in list(held.items()):
+            if retry_at(msg) <= now:
+                del held[tp]
+                handle(msg)
+                c.resume([TopicPartition(*tp)])
+
+        timeout = min([1.0] + [max(0.0, retry_at(msg) - now) for msg in held.values()])
+        msg = c.poll(timeout)
+        if msg is None:
+            continue
+        if msg.error():
+            print("Consumer error: {}".format(msg.error()))
+            continue
+
+        if retry_at(msg) > time.time():
+            held[(msg.topic(), msg.partition())] = msg
+            c.pause([TopicPartition(msg.topic(), msg.partition())])
+        else:
+            handle(msg)
@@ -0,0 +1,156 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from multiprocessing.connection import wait
+from typing import Dict, List, Tuple
+
+from dotenv import load_dotenv, find_dotenv
+
+from . import topics, transport
+
+load_dotenv(find_dotenv())
+
+# environment variable prefix of each sync direction
+DIRECTIONS = {
+    topics.LOCAL_TO_STRIPE: "LOCAL_TO_STRIPE",
+    topics.STRIPE_TO_LOCAL: "STRIPE_TO_LOCAL",
+}
+# consumer settings that can be set per direction, as <DIRECTION>_<SETTING>
+DIRECTION_SETTINGS = (
+    "KAFKA_CONSUMER_BATCH_SIZE",
+    "KAFKA_CONSUMER_BATCH_TIMEOUT",
+    "KAFKA_CONSUMER_COALESCE_WINDOW",
+    "KAFKA_CONSUMER_COMMIT_MESSAGES",
+    "KAFKA_CONSUMER_COMMIT_INTERVAL",
+)
+# the Stripe calling direction is the slow one, it gets more processes by default
+DEFAULT_PROCESSES = {topics.LOCAL_TO_STRIPE: 2, topics.STRIPE_TO_LOCAL: 1}
+METRICS_PORT = int(os.getenv("SUPERVISOR_METRICS_PORT", 9110))
+SHUTDOWN_TIMEOUT = float(os.getenv("SUPERVISOR_SHUTDOWN_TIMEOUT", 60))
+# seconds after its start before an exited worker is restarted
+RESTART_DELAY = float(os.getenv("SUPERVISOR_RESTART_DELAY", 5))
+
+Slot = Tuple[str, int]
+
+
+def work(source: str, environment: Dict[str, str]) -> None:
+    """
+    Entry point of a worker process, consuming one sync direction.
+
+    Parameters:
+    - source (str): Sync topic to consume.
+    - environment (Dict[str, str]): Settings of the worker, applied before the app reads them.
+
+    Returns:
+    None
+    """
+    os.environ.update(environment)
+    # imported once the settings are in place, the consumer reads them on import
+    from . import consumer
+    consumer.main([source])
+
+
+def worker_environment(source: str, index: int, processes: Dict[str, int]) -> Dict[str, str]:
+    """
+    Build the settings of a worker process from the direction specific variables.
+
+    Parameters:
+    - source (str): Sync topic the worker consumes.
+    - index (int): Index of the worker among all workers, picking its metrics port.
+    - processes (Dict[str, int]): Number of processes per sync topic.
+
+    Returns:
+    Dict[str, str]: Environment variables to set in the worker.
+    """
+    prefix = DIRECTIONS[source]
+    environment = {setting: os.environ[f"{prefix}_{setting}"] for setting in DIRECTION_SETTINGS
+                   if f"{prefix}_{setting}" in os.environ}
+    environment["CONSUMER_METRICS_PORT"] = str(
+        METRICS_PORT + index if METRICS_PORT else 0)
+    if source == topics.LOCAL_TO_STRIPE:
+        # the processes calling Stripe share its rate limit
+        rate_limit = float(os.getenv("STRIPE_RATE_LIMIT", 25))
+        environment["STRIPE_RATE_LIMIT"] = str(rate_limit / processes[source])
+        environment["STRIPE_RATE_BURST"] = str(
+            max(1, int(float(os.getenv("STRIPE_RATE_BURST", rate_limit)) / processes[source])))
+    return environment
+
+
+def supervise(processes: Dict[str, int]) -> None:
+    """
+    Run worker processes per sync direction, restarting the ones that exit,
+    until SIGTERM or SIGINT. Workers are then asked to drain and commit with
+    SIGTERM, and killed if still running after SHUTDOWN_TIMEOUT seconds.
+
+    Parameters:
+    - processes (Dict[str, int]): Number of processes per sync topic.
+
+    Returns:
+    None
+    """
+    # spawned, a forked worker would inherit the supervisor's threads and locks
+    context = multiprocessing.get_context("spawn")
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    slots: List[Slot] = [(source, i) for source in DIRECTIONS
+                         for i in range(processes[source])]
+    workers: Dict[Slot, multiprocessing.Process] = {}
+    started: Dict[Slot, float] = {}
+
+    def start(slot: Slot) -> None:
+        source, i = slot
+        worker = context.Process(target=work, name=f"{source}-{i}",
+                                 args=(source, worker_environment(source, slots.index(slot), processes)))
+        worker.start()
+        workers[slot] = worker
+        started[slot] = time.monotonic()
+        print(f"Started worker {worker.name} with pid {worker.pid}")
+
+    for slot in slots:
+        start(slot)
+
+    while not stopping.is_set():
+        wait([worker.sentinel for worker in workers.values() if worker.is_alive()], timeout=1.0)
+        for slot, worker in list(workers.items()):
+            # a worker crashing right away is restarted at a slower pace
+            if worker.is_alive() or stopping.is_set() or time.monotonic() < started[slot] + RESTART_DELAY:
+                continue
+            print(f"Worker {worker.name} exited with code {worker.exitcode}, restarting it")
+            start(slot)
+
+    print(f"Stopping {len(workers)} workers")
+    for worker in workers.values():
+        if worker.is_alive():
+            worker.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for worker in workers.values():
+        worker.join(max(0.0, deadline - time.monotonic()))
+        if worker.is_alive():
+            print(f"Worker {worker.name} did not stop in time, killing it")
+            worker.kill()
+            worker.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run consumer worker processes per sync direction, each direction in its own consumer group.")
+    for source, prefix in DIRECTIONS.items():
+        parser.add_argument(f"--{source}", type=int, default=int(os.getenv(f"{prefix}_PROCESSES", DEFAULT_PROCESSES[source])),
+                            help=f"number of {source} processes, {prefix}_PROCESSES by default")
+    args = parser.parse_args()
+
+    if transport.is_in_process():
+        sys.exit("The in-process transport runs the consumer in the API process, "
+                 "worker processes need the Kafka transport")
+    supervise({source: getattr(args, source) for source in DIRECTIONS})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+from typing import Union
+
+from confluent_kafka import Message
+
+LOCAL_TO_STRIPE = "localtostripe"
+STRIPE_TO_LOCAL = "stripetolocal"
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+OPERATION_HEADER = "operation"
+FORMAT_HEADER = "content-format"
+VERSION_HEADER = "schema-version"
+TRACE_HEADER = "trace-id"
+ORIGIN_TS_HEADER = "origin-ts"
+
+# set on messages moved to a retry or dead-letter topic
+ORIGINAL_TOPIC_HEADER = "original-topic"
+ORIGINAL_PARTITION_HEADER = "original-partition"
+ORIGINAL_OFFSET_HEADER = "original-offset"
+ATTEMPT_HEADER = "retry-attempt"
+RETRY_AT_HEADER = "retry-at"
+FAILURE_KIND_HEADER = "failure-kind"
+FAILURE_REASON_HEADER = "failure-reason"
+FAILED_AT_HEADER = "failed-at"
+# set on messages replayed from a dead-letter topic
+REPLAY_HEADER = "replay-count"
+
+
+def retry_topic(topic: str, attempt: int) -> str:
+    """
+    Get the name of the retry topic holding the messages of a topic for a retry attempt.
+
+    Parameters:
+    - topic (str): Original topic name.
+    - attempt (int): Retry attempt, starting at 1.
+
+    Returns:
+    str: Retry topic name.
+    """
+    return f"{topic}-retry-{attempt}"
+
+
+def dead_letter_topic(topic: str) -> str:
+    """
+    Get the name of the dead-letter topic of a topic.
+
+    Parameters:
+    - topic (str): Original topic name.
+
+    Returns:
+    str: Dead-letter topic name.
+    """
+    return f"{topic}-dlq"
+
+
+# messages produced before the operation header existed used one partition per operation
+LEGACY_PARTITION_OPERATIONS = {0: CREATE, 1: UPDATE, 2: DELETE}
+
+
+def get_header(msg: Message, header: str) -> Union[str, None]:
+    """
+    Get the value of a message header.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+    - header (str): Header name.
+
+    Returns:
+    str: Header value, None if the message does not carry it.
+    """
+    for name, value in msg.headers() or []:
+        if name == header:
+            return value.decode('utf-8')
+    return None
+
+
+def get_operation(msg: Message) -> Union[str, None]:
+    """
+    Get the operation a message carries from its 'operation' header.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+
+    Returns:
+    str: One of 'create', 'update' or 'delete', None if unknown.
+    """
+    operation = get_header(msg, OPERATION_HEADER)
+    if operation is not None:
+        return operation
+    return LEGACY_PARTITION_OPERATIONS.get(msg.partition())
@@ -0,0 +1,399 @@
+import os
+import threading
+import time
+import zlib
+
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Deque, Dict, List, Set, Tuple, Union
+
+from confluent_kafka import Consumer, Producer, TopicPartition, TIMESTAMP_CREATE_TIME
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+
+KAFKA = "kafka"
+IN_PROCESS = "inprocess"
+TRANSPORT = os.getenv("KAFSYNC_TRANSPORT", KAFKA)
+if TRANSPORT not in (KAFKA, IN_PROCESS):
+    raise ValueError(f"Unknown KAFSYNC_TRANSPORT {TRANSPORT!r}")
+# the in-process topics are partitioned by key like the Kafka ones
+PARTITIONS = int(os.getenv("KAFKA_TOPIC_PARTITIONS", 3))
+
+Headers = List[Tuple[str, bytes]]
+
+
+class Transport(ABC):
+    """
+    Creates the producer and consumer clients of a message transport.
+    """
+
+    @abstractmethod
+    def create_producer(self, config: Dict) -> Producer:
+        """
+        Create a producer client.
+
+        Parameters:
+        - config (Dict): confluent_kafka producer configuration.
+
+        Returns:
+        Producer: Client exposing produce(), poll(), flush() and len().
+        """
+
+    @abstractmethod
+    def create_consumer(self, config: Dict) -> Consumer:
+        """
+        Create a consumer client.
+
+        Parameters:
+        - config (Dict): confluent_kafka consumer configuration, including 'group.id'.
+
+        Returns:
+        Consumer: Client exposing subscribe(), poll(), consume(), commit() and close().
+        """
+
+    def backlog(self, topics: List[str]) -> Union[int, None]:
+        """
+        Count the messages of topics that some consumer group has not committed yet.
+
+        Parameters:
+        - topics (List[str]): Topic names.
+
+        Returns:
+        int: Number of messages, None when the transport cannot tell without asking the broker.
+        """
+        return None
+
+
+class KafkaTransport(Transport):
+    """
+    Messages go through a Kafka cluster.
+    """
+
+    def __init__(self, bootstrap_servers: str) -> None:
+        self.bootstrap_servers = bootstrap_servers
+
+    def create_producer(self, config: Dict) -> Producer:
+        return Producer({'bootstrap.servers': self.bootstrap_servers, **config})
+
+    def create_consumer(self, config: Dict) -> Consumer:
+        return Consumer({'bootstrap.servers': self.bootstrap_servers, **config})
+
+
+class LocalMessage:
+    """
+    Message of the in-process bus, exposing the confluent_kafka.Message accessors.
+    """
+
+    __slots__ = ("_topic", "_partition", "_offset",
+                 "_key", "_value", "_headers", "_timestamp")
+
+    def __init__(self, topic: str, partition: int, offset: int, key: bytes, value: bytes, headers: Headers) -> None:
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        self._headers = headers
+        self._timestamp = int(time.time() * 1000)
+
+    def topic(self) -> str:
+        return self._topic
+
+    def partition(self) -> int:
+        return self._partition
+
+    def offset(self) -> int:
+        return self._offset
+
+    def key(self) -> bytes:
+        return self._key
+
+    def value(self) -> bytes:
+        return self._value
+
+    def headers(self) -> Headers:
+        return self._headers
+
+    def timestamp(self) -> Tuple[int, int]:
+        return TIMESTAMP_CREATE_TIME, self._timestamp
+
+    def error(self) -> None:
+        return None
+
+
+class Bus:
+    """
+    In-memory topics of the current process, partitioned and offset like Kafka topics.
+
+    Messages are kept until every consumer group subscribed to their topic
+    committed past them, so a consumer started after the producers still
+    receives everything.
+    """
+
+    def __init__(self, partitions: int) -> None:
+        self.partitions = partitions
+        self._cond = threading.Condition()
+        # per (topic, partition): retained messages and the offset of the first one
+        self._logs: Dict[Tuple[str, int], Deque[LocalMessage]] = {}
+        self._bases: Dict[Tuple[str, int], int] = {}
+        self._groups: Dict[str, Set[str]] = {}
+        self._committed: Dict[str, Dict[Tuple[str, int], int]] = {}
+        self._turn = 0
+
+    def append(self, topic: str, value: bytes, key: bytes = None, headers: Headers = None, partition: int = None) -> LocalMessage:
+        """
+        Append a message to a topic and wake up the consumers waiting for it.
+
+        Parameters:
+        - topic (str): Topic name.
+        - value (bytes): Message content.
+        - key (bytes, optional): Message key, picking the partition when none is given.
+        - headers (Headers, optional): Message headers.
+        - partition (int, optional): Partition to append to.
+
+        Returns:
+        LocalMessage: Appended message.
+        """
+        if partition is None:
+            partition = zlib.crc32(key or b"") % self.partitions
+        with self._cond:
+            tp = (topic, partition)
+            log = self._logs.get(tp)
+            if log is None:
+                log = self._logs[tp] = deque()
+                self._bases[tp] = 0
+            msg = LocalMessage(topic, partition, self._bases[tp] + len(log),
+                               key, value, headers or [])
+            log.append(msg)
+            self._cond.notify_all()
+        return msg
+
+    def join(self, group: str, topics: List[str]) -> None:
+        """
+        Register a consumer group on topics, retaining their messages until it commits them.
+
+        Parameters:
+        - group (str): Consumer group ID.
+        - topics (List[str]): Topic names.
+
+        Returns:
+        None
+        """
+        with self._cond:
+            for topic in topics:
+                self._groups.setdefault(topic, set()).add(group)
+            self._committed.setdefault(group, {})
+
+    def fetch(self, group: str, topics: List[str], positions: Dict[Tuple[str, int], int],
+              max_messages: int, timeout: Union[float, None], paused: Set[Tuple[str, int]] = frozenset()) -> List[LocalMessage]:
+        """
+        Read the messages following the given positions, waiting for some to arrive.
+
+        Parameters:
+        - group (str): Consumer group ID, whose committed offsets are the starting positions.
+        - topics (List[str]): Topic names.
+        - positions (Dict[Tuple[str, int], int]): Next offset per partition, advanced past the returned messages.
+        - max_messages (int): Maximum number of messages to return.
+        - timeout (float or None): Maximum time to wait in seconds, None to wait forever.
+        - paused (Set[Tuple[str, int]], optional): Partitions to skip.
+
+        Returns:
+        List[LocalMessage]: Messages in offset order within each partition.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                msgs = []
+                # start from another partition each time, so none of them starves under a backlog
+                logs = list(self._logs.items())
+                self._turn += 1
+                start = self._turn % len(logs) if logs else 0
+                for tp, log in logs[start:] + logs[:start]:
+                    if tp[0] not in topics or tp in paused or len(msgs) >= max_messages:
+                        continue
+                    base = self._bases[tp]
+                    position = positions.setdefault(
+                        tp, max(base, self._committed[group].get(tp, base)))
+                    index = position - base
+                    while index < len(log) and len(msgs) < max_messages:
+                        msgs.append(log[index])
+                        index += 1
+                    positions[tp] = base + index
+                if msgs:
+                    return msgs
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return msgs
+                self._cond.wait(remaining)
+
+    def commit(self, group: str, offsets: Dict[Tuple[str, int], int]) -> None:
+        """
+        Store the committed offsets of a consumer group and drop the messages every group is done with.
+
+        Parameters:
+        - group (str): Consumer group ID.
+        - offsets (Dict[Tuple[str, int], int]): Offset of the next message to consume per partition.
+
+        Returns:
+        None
+        """
+        with self._cond:
+            committed = self._committed.setdefault(group, {})
+            committed.update(offsets)
+            for tp in offsets:
+                log = self._logs.get(tp)
+                if log is None:
+                    continue
+                done = min(self._committed[other].get(tp, 0)
+                           for other in self._groups.get(tp[0], {group}))
+                while log and self._bases[tp] < done:
+                    log.popleft()
+                    self._bases[tp] += 1
+
+    def backlog(self, topics: List[str]) -> int:
+        """
+        Count the retained messages of topics, which some consumer group has not committed yet.
+
+        Parameters:
+        - topics (List[str]): Topic names.
+
+        Returns:
+        int: Number of messages.
+        """
+        with self._cond:
+            return sum(len(log) for (topic, _), log in self._logs.items() if topic in topics)
+
+
+class LocalProducer:
+    """
+    Producer appending to the in-process bus, reporting each delivery right away.
+    """
+
+    def __init__(self, bus: Bus, config: Dict) -> None:
+        self._bus = bus
+
+    def produce(self, topic: str, value: bytes = None, key: bytes = None, headers: Headers = None,
+                partition: int = None, callback: Callable = None, on_delivery: Callable = None) -> None:
+        msg = self._bus.append(topic, value, key, headers, partition)
+        callback = callback or on_delivery
+        if callback is not None:
+            callback(None, msg)
+
+    def poll(self, timeout: float = 0) -> int:
+        # deliveries are reported by produce(), nothing is ever waiting here
+        if timeout:
+            time.sleep(timeout)
+        return 0
+
+    def flush(self, timeout: float = None) -> int:
+        return 0
+
+    def __len__(self) -> int:
+        return 0
+
+
+class LocalConsumer:
+    """
+    Consumer of the in-process bus, reading every partition of its subscribed topics.
+
+    Run a single consumer per group: the partitions are not shared between
+    the consumers of a group as a Kafka rebalance would.
+    """
+
+    def __init__(self, bus: Bus, config: Dict) -> None:
+        self._bus = bus
+        self._group = config['group.id']
+        self._auto_commit = config.get('enable.auto.commit', True)
+        self._topics: List[str] = []
+        self._positions: Dict[Tuple[str, int], int] = {}
+        self._paused: Set[Tuple[str, int]] = set()
+
+    def subscribe(self, topics: List[str], on_assign: Callable = None, on_revoke: Callable = None,
+                  on_lost: Callable = None) -> None:
+        # every partition stays assigned to this consumer, the callbacks are never called
+        self._topics = list(topics)
+        self._bus.join(self._group, self._topics)
+
+    def pause(self, partitions: List[TopicPartition]) -> None:
+        self._paused.update((tp.topic, tp.partition) for tp in partitions)
+
+    def resume(self, partitions: List[TopicPartition]) -> None:
+        self._paused.difference_update((tp.topic, tp.partition) for tp in partitions)
+
+    def poll(self, timeout: float = None) -> Union[LocalMessage, None]:
+        msgs = self.consume(1, timeout)
+        return msgs[0] if msgs else None
+
+    def consume(self, num_messages: int = 1, timeout: float = None) -> List[LocalMessage]:
+        if self._auto_commit:
+            # the messages returned by the previous call were handled meanwhile
+            self.commit(asynchronous=False)
+        if timeout is not None and timeout < 0:
+            timeout = None
+        return self._bus.fetch(self._group, self._topics, self._positions, num_messages, timeout, self._paused)
+
+    def commit(self, message: LocalMessage = None, offsets: List[TopicPartition] = None,
+               asynchronous: bool = True) -> List[TopicPartition]:
+        if message is not None:
+            offsets = [TopicPartition(message.topic(), message.partition(), message.offset() + 1)]
+        elif offsets is None:
+            offsets = [TopicPartition(topic, partition, offset)
+                       for (topic, partition), offset in self._positions.items()]
+        self._bus.commit(
+            self._group, {(tp.topic, tp.partition): tp.offset for tp in offsets})
+        return offsets
+
+    def close(self) -> None:
+        if self._auto_commit:
+            self.commit(asynchronous=False)
+
+
+class InProcessTransport(Transport):
+    """
+    Messages are handed over through a bus in memory, for a single process running every component.
+    """
+
+    def __init__(self, partitions: int) -> None:
+        self.bus = Bus(partitions)
+
+    def create_producer(self, config: Dict) -> LocalProducer:
+        return LocalProducer(self.bus, config)
+
+    def create_consumer(self, config: Dict) -> LocalConsumer:
+        return LocalConsumer(self.bus, config)
+
+    def backlog(self, topics: List[str]) -> int:
+        return self.bus.backlog(topics)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    """
+    Get the transport selected by KAFSYNC_TRANSPORT, created on first use.
+
+    Returns:
+    Transport: Kafka transport, or the in-process one.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            if TRANSPORT == IN_PROCESS:
+                _transport = InProcessTransport(PARTITIONS)
+            else:
+                _transport = KafkaTransport(
+                    os.getenv("KAFKA_BOOTSTRAP_SERVERS", 'localhost'))
+        return _transport
+
+
+def is_in_process() -> bool:
+    """
+    Check whether every component has to run in the current process.
+
+    Returns:
+    bool: True for the in-process transport.
+    """
+    return TRANSPORT == IN_PROCESS
@@ -1,5 +1,8 @@
 from fastapi import FastAPI
+from prometheus_client import make_asgi_app
 from .routers import base
-app = FastAPI()
+from . import standalone
+app = FastAPI(lifespan=standalone.lifespan)
 
-app.include_router(base.router)
\ No newline at end of file
+app.include_router(base.router)
+app.mount("/metrics", make_asgi_app())
@@ -0,0 +1,94 @@
+import json
+import os
+
+from dotenv import load_dotenv, find_dotenv
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+load_dotenv(find_dotenv())
+
+# Kafka producer
+PRODUCE_LATENCY = Histogram(
+    "kafsync_produce_latency_seconds", "Time from enqueueing a message to its delivery report", ["topic"])
+PRODUCE_ERRORS = Counter(
+    "kafsync_produce_errors_total", "Messages that failed to be delivered", ["topic"])
+PRODUCER_QUEUE_DEPTH = Gauge(
+    "kafsync_producer_queue_depth", "Messages and requests waiting in the producer queue")
+
+# Kafka consumer
+HANDLER_LATENCY = Histogram(
+    "kafsync_handler_latency_seconds", "Time spent handling a consumed message", ["topic", "operation"])
+HANDLER_ERRORS = Counter(
+    "kafsync_handler_errors_total", "Consumed messages whose handler raised", ["topic", "operation"])
+CONSUMER_LAG = Gauge(
+    "kafsync_consumer_lag", "Messages between the committed offset and the end of a partition", ["topic", "partition"])
+RETRIED_MESSAGES = Counter(
+    "kafsync_retried_messages_total", "Failed messages moved to a retry topic", ["topic", "attempt"])
+DEAD_LETTERS = Counter(
+    "kafsync_dead_letters_total", "Failed messages moved to the dead-letter topic", ["topic", "kind"])
+
+# End-to-end sync, from the originating change to the offset commit
+SYNC_LATENCY = Histogram(
+    "kafsync_sync_latency_seconds", "Time from a change to the commit of the message applying it", ["topic", "operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+SYNC_STAGE_LATENCY = Histogram(
+    "kafsync_sync_stage_latency_seconds", "Time spent by a message in each sync stage", ["topic", "stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+# Stripe API
+STRIPE_LATENCY = Histogram(
+    "kafsync_stripe_request_latency_seconds", "Duration of a single Stripe request attempt", ["method"])
+STRIPE_ERRORS = Counter(
+    "kafsync_stripe_errors_total", "Failed Stripe request attempts", ["method", "kind"])
+STRIPE_RETRIES = Counter(
+    "kafsync_stripe_retries_total", "Stripe request attempts that were retried", ["method"])
+
+# Stripe poller
+POLL_DURATION = Histogram(
+    "kafsync_poll_duration_seconds", "Duration of a Stripe poll", ["kind"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+RECONCILE_CHANGES = Gauge(
+    "kafsync_reconcile_changes", "Changes produced by the last full reconcile", ["operation"])
+POLLED_EVENTS = Counter(
+    "kafsync_polled_events_total", "Stripe events read by the events poller")
+
+# Webhook ingestion
+WEBHOOK_QUEUE_DEPTH = Gauge(
+    "kafsync_webhook_queue_depth", "Webhook events waiting to be produced")
+WEBHOOK_DUPLICATES = Counter(
+    "kafsync_webhook_duplicates_total", "Redelivered webhook events that were dropped")
+
+
+def start_exporter(port_variable: str, default_port: int) -> None:
+    """
+    Serve the metrics of a standalone process over HTTP, on the port set by an environment variable.
+
+    Parameters:
+    - port_variable (str): Name of the environment variable holding the port, 0 disables the exporter.
+    - default_port (int): Port used when the variable is not set.
+
+    Returns:
+    None
+    """
+    port = int(os.getenv(port_variable, default_port))
+    if port:
+        start_http_server(port)
+        print(f"Serving metrics on port {port}")
+
+
+def record_consumer_stats(stats: str) -> None:
+    """
+    Update the consumer lag gauges from a librdkafka statistics report.
+
+    Parameters:
+    - stats (str): JSON statistics emitted by the consumer every 'statistics.interval.ms'.
+
+    Returns:
+    None
+    """
+    for topic, topic_stats in json.loads(stats).get("topics", {}).items():
+        for partition, partition_stats in topic_stats.get("partitions", {}).items():
+            # -1 is the internal unassigned partition, lag is -1 until known
+            if partition == "-1" or partition_stats.get("consumer_lag", -1) < 0:
+                continue
+            CONSUMER_LAG.labels(topic, partition).set(
+                partition_stats["consumer_lag"])
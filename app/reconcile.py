@@ -0,0 +1,84 @@
+from typing import Dict, Iterable, Iterator, Tuple
+
+from sqlalchemy.orm import Session
+from stripe import Customer as StripeCustomer
+
+from .sql import crud as sql_crud, schemas
+from .stripeapp import echo
+from .kafka import producer, topics
+
+# (operation, message key, message data) of a single change
+Change = Tuple[str, str, Dict]
+
+
+def diff_customers(customers: Iterable[StripeCustomer], index: Dict[str, Tuple[int, str, str]]) -> Iterator[Change]:
+    """
+    Compute the changes needed to bring the local database in line with Stripe in a single pass.
+
+    Creates and updates are yielded while the customers are streamed.
+    Entries are popped from the index as their customer is seen, whatever is
+    left once the stream is exhausted gets deleted.
+
+    Parameters:
+    - customers (Iterable[StripeCustomer]): Every Stripe customer.
+    - index (Dict[str, Tuple[int, str, str]]): Local ID, name and email of synchronized customers keyed by external ID, consumed by the diff.
+
+    Returns:
+    Iterator[Change]: Changes to be produced.
+    """
+    for customer in customers:
+        local_customer = schemas.Customer(
+            name=customer.name, email=customer.email)
+        entry = index.pop(customer.id, None)
+        if entry is None and echo.ORIGIN_LOCALID in (getattr(customer, "metadata", None) or {}):
+            # created by KafSync, the consumer is about to map it
+            continue
+        if entry is None:
+            yield topics.CREATE, customer.id, {
+                "stripe_customer_id": customer.id,
+                "customer": local_customer.model_dump()
+            }
+        elif entry[1:] != (local_customer.name, local_customer.email):
+            yield topics.UPDATE, customer.id, {
+                "customer_id": entry[0],
+                "stripe_customer_id": customer.id,
+                "customer": local_customer.model_dump()
+            }
+
+    for externalid, (localid, _, _) in index.items():
+        yield topics.DELETE, externalid, {
+            "customer_id": localid,
+            "stripe_customer_id": externalid
+        }
+
+
+def emit_changes(changes: Iterable[Change]) -> Dict[str, int]:
+    """
+    Produce changes to the 'stripetolocal' topic as they come and wait for them to be delivered once.
+
+    Parameters:
+    - changes (Iterable[Change]): Changes to be produced.
+
+    Returns:
+    Dict[str, int]: Number of changes produced per operation.
+    """
+    counts = {topics.CREATE: 0, topics.UPDATE: 0, topics.DELETE: 0}
+    for operation, key, data in changes:
+        producer.produce_event(topics.STRIPE_TO_LOCAL, operation, key, data)
+        counts[operation] += 1
+    producer.flush()
+    return counts
+
+
+def reconcile(db: Session, customers: Iterable[StripeCustomer]) -> Dict[str, int]:
+    """
+    Diff every Stripe customer against the local database and produce the changes.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - customers (Iterable[StripeCustomer]): Every Stripe customer, possibly streamed.
+
+    Returns:
+    Dict[str, int]: Number of changes produced per operation.
+    """
+    return emit_changes(diff_customers(customers, sql_crud.get_customer_index(db)))
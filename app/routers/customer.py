@@ -1,10 +1,13 @@
-from typing import Dict
+import json
+
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple, Type
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+from pydantic import BaseModel, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..sql import crud, database, schemas, models
-from ..stripeapp import webhook as stripe_webhook
+from ..sql import async_crud, database, schemas, models
+from ..stripeapp import ingest, webhook as stripe_webhook
 
 models.Base.metadata.create_all(bind=database.engine)
 
@@ -13,43 +16,195 @@ router = APIRouter(
     tags=['customers']
 )
 
+# number of bulk items applied per transaction
+BULK_CHUNK_SIZE = 1000
+
 
 @router.post('/', response_model=schemas.Customer)
-async def create_customer(customer: schemas.Customer, db: Session = Depends(database.get_db)) -> models.Customer:
+async def create_customer(customer: schemas.Customer, db: AsyncSession = Depends(database.get_async_db)) -> models.Customer:
     """
     Create a new customer in the local database.
 
     Parameters:
-    - db (Session): SQLAlchemy database session.
+    - db (AsyncSession): SQLAlchemy async database session.
     - customer (schemas.Customer): Customer data to be created.
 
     Returns:
     models.Customer: Created customer object.
     """
-    db_customer = crud.get_customer_by_email(db, email=customer.email)
+    db_customer = await async_crud.get_customer_by_email(db, email=customer.email)
     if db_customer:
         raise HTTPException(
             status_code=400, detail="Email already registered")
     try:
-        return crud.create_customer(db=db, customer=customer)
+        return await async_crud.create_customer(db=db, customer=customer)
+    except:
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error occured. Please try again later")
+
+
+async def iter_bulk_items(request: Request) -> AsyncIterator[Any]:
+    """
+    Read the items of a bulk request, either streamed as NDJSON or as a JSON array.
+
+    Parameters:
+    - request (Request): FastAPI request object.
+
+    Returns:
+    AsyncIterator[Any]: Decoded items, None for lines that are not valid JSON.
+    """
+    if not request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = await request.json()
+        if not isinstance(items, list):
+            raise HTTPException(
+                status_code=400, detail="Expected a JSON array or NDJSON")
+        for item in items:
+            yield item
+        return
+
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    if buffer.strip():
+        try:
+            yield json.loads(buffer)
+        except ValueError:
+            yield None
+
+
+async def run_bulk(request: Request, db: AsyncSession, model: Type[BaseModel],
+                   apply: Callable[[AsyncSession, List[Tuple[int, Any]]], Awaitable[List[schemas.BulkResult]]]) -> List[schemas.BulkResult]:
+    """
+    Validate the items of a bulk request and apply them in chunks, each in its own transaction.
+
+    Once a chunk fails, it and the following items are reported with an 'error'
+    status, while the chunks applied before it stay committed.
+
+    Parameters:
+    - request (Request): FastAPI request object.
+    - db (AsyncSession): SQLAlchemy async database session.
+    - model (Type[BaseModel]): Schema each item is validated against.
+    - apply (Callable): Bulk CRUD function applying a chunk of validated items.
+
+    Returns:
+    List[schemas.BulkResult]: Result of each item, in request order.
+    """
+    results, chunk = [], []
+    index = 0
+    failed = False
+
+    async def apply_chunk(chunk: List[Tuple[int, Any]]) -> None:
+        nonlocal failed
+        if not failed:
+            try:
+                results.extend(await apply(db, chunk))
+                return
+            except Exception as e:
+                print(f"Unable to apply bulk chunk of {len(chunk)} items: {e}")
+                failed = True
+        results.extend(schemas.BulkResult(index=index, status="error", detail="Not applied, a server error occurred")
+                       for index, _ in chunk)
+
+    async for item in iter_bulk_items(request):
+        try:
+            chunk.append((index, model.model_validate(item)))
+        except ValidationError as e:
+            results.append(schemas.BulkResult(
+                index=index, status="invalid", detail=str(e)))
+        index += 1
+
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            await apply_chunk(chunk)
+            chunk = []
+    if chunk:
+        await apply_chunk(chunk)
+
+    return sorted(results, key=lambda result: result.index)
+
+
+@router.post('/bulk', response_model=List[schemas.BulkResult])
+async def create_customers(request: Request, db: AsyncSession = Depends(database.get_async_db)) -> List[schemas.BulkResult]:
+    """
+    Create many customers in the local database from a JSON array or an NDJSON stream.
+
+    Parameters:
+    - request (Request): FastAPI request object.
+    - db (AsyncSession): SQLAlchemy async database session.
+
+    Returns:
+    List[schemas.BulkResult]: Result of each customer.
+    """
+    try:
+        return await run_bulk(request, db, schemas.Customer, async_crud.create_customers_bulk)
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error occured. Please try again later")
+
+
+@router.put('/bulk', response_model=List[schemas.BulkResult])
+async def modify_customers(request: Request, db: AsyncSession = Depends(database.get_async_db)) -> List[schemas.BulkResult]:
+    """
+    Modify many customers in the local database from a JSON array or an NDJSON stream.
+
+    Parameters:
+    - request (Request): FastAPI request object.
+    - db (AsyncSession): SQLAlchemy async database session.
+
+    Returns:
+    List[schemas.BulkResult]: Result of each customer.
+    """
+    try:
+        return await run_bulk(request, db, schemas.CustomerWithId, async_crud.update_customers_bulk)
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error occured. Please try again later")
+
+
+@router.delete('/bulk', response_model=List[schemas.BulkResult])
+async def remove_customers(request: Request, db: AsyncSession = Depends(database.get_async_db)) -> List[schemas.BulkResult]:
+    """
+    Remove many customers from the local database given a JSON array or an NDJSON stream of IDs.
+
+    Parameters:
+    - request (Request): FastAPI request object.
+    - db (AsyncSession): SQLAlchemy async database session.
+
+    Returns:
+    List[schemas.BulkResult]: Result of each customer.
+    """
+    try:
+        return await run_bulk(request, db, schemas.CustomerRef, async_crud.delete_customers_bulk)
+    except HTTPException:
+        raise
     except:
         raise HTTPException(
             status_code=500, detail="Internal Server Error occured. Please try again later")
 
 
 @router.get('/{customer_id}', response_model=schemas.Customer)
-async def read_customer(customer_id: int, db: Session = Depends(database.get_db)) -> models.Customer:
+async def read_customer(customer_id: int, db: AsyncSession = Depends(database.get_async_db)) -> models.Customer:
     """
     Read customer details from the local database.
 
     Parameters:
     - customer_id (int): ID of the customer to be read.
-    - db (Session): SQLAlchemy database session.
+    - db (AsyncSession): SQLAlchemy async database session.
 
     Returns:
     models.Customer: Customer details.
     """
-    db_customer = crud.get_customer(db, customer_id)
+    db_customer = await async_crud.get_customer(db, customer_id)
     if db_customer is None:
         raise HTTPException(
             status_code=404, detail="Customer not found")
@@ -57,21 +212,21 @@ async def read_customer(customer_id: int, db: Session = Depends(database.get_db)
 
 
 @router.put('/{customer_id}')
-async def modify_customer(customer_id: int, customer: schemas.Customer, db: Session = Depends(database.get_db)) -> Dict:
+async def modify_customer(customer_id: int, customer: schemas.Customer, db: AsyncSession = Depends(database.get_async_db)) -> Dict:
     """
     Modify an existing customer in the local database.
 
     Parameters:
     - customer_id (int): ID of the customer to be modified.
     - customer (schemas.Customer): Updated customer data.
-    - db (Session): SQLAlchemy database session.
+    - db (AsyncSession): SQLAlchemy async database session.
 
     Returns:
     dict: Detail of the modification.
     """
     update_cnt = None
     try:
-        update_cnt = crud.update_customer(db, customer_id, customer)
+        update_cnt = await async_crud.update_customer(db, customer_id, customer)
     except:
         raise HTTPException(
             status_code=500, detail="Internal Server Error occured. Please try again later")
@@ -83,20 +238,20 @@ async def modify_customer(customer_id: int, customer: schemas.Customer, db: Sess
 
 
 @router.delete('/{customer_id}', status_code=200)
-async def remove_customer(customer_id: int, db: Session = Depends(database.get_db)) -> Dict:
+async def remove_customer(customer_id: int, db: AsyncSession = Depends(database.get_async_db)) -> Dict:
     """
     Remove a customer from the local database.
 
     Parameters:
     - customer_id (int): ID of the customer to be removed.
-    - db (Session): SQLAlchemy database session.
+    - db (AsyncSession): SQLAlchemy async database session.
 
     Returns:
     dict: Detail of the deletion.
     """
     db_customer = None
     try:
-        db_customer = crud.delete_customer(db, customer_id)
+        db_customer = await async_crud.delete_customer(db, customer_id)
     except:
         raise HTTPException(
             status_code=500, detail="Internal Server Error occured. Please try again later")
@@ -109,7 +264,7 @@ async def remove_customer(customer_id: int, db: Session = Depends(database.get_d
 @router.post('/webhook', status_code=200)
 async def webhook(request: Request) -> Dict:
     """
-    Handle incoming webhooks from Stripe.
+    Handle incoming webhooks from Stripe, acknowledging them once validated and queued.
 
     Parameters:
     - request (Request): FastAPI request object.
@@ -117,10 +272,14 @@ async def webhook(request: Request) -> Dict:
     Returns:
     dict: Detail of the webhook handling.
     """
-    payload = await request.json()
+    payload = await request.body()
     try:
-        stripe_webhook.handle_event(payload)
-        return {"detail": "Event Sucessfully Captured"}
+        event, operation = stripe_webhook.verify_event(
+            payload, request.headers.get("stripe-signature"))
     except Exception as e:
         raise HTTPException(
-            status_code=404, detail=e)
+            status_code=404, detail=str(e))
+    if not ingest.enqueue(event, operation):
+        raise HTTPException(
+            status_code=503, detail="Webhook queue is full. Please try again later")
+    return {"detail": "Event Sucessfully Captured"}
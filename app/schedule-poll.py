@@ -1,88 +1,186 @@
+import os
+import sys
+import threading
 import time
-import json
 
 import schedule
+import stripe
 
-from typing import List
+from typing import Callable, Iterable
+from sqlalchemy.orm import Session
 from stripe import Customer as StripeCustomer
 
-from .stripeapp import crud as stripe_crud
-from .sql import database, crud as sql_crud, schemas
+from . import metrics, reconcile
+from .stripeapp import crud as stripe_crud, webhook as stripe_webhook
+from .sql import database, models, crud as sql_crud
 from .kafka import producer
 
-db = database.SessionLocal()
+PAGE_SIZE = int(os.getenv("STRIPE_PAGE_SIZE", 100))
+EVENTS_POLL_INTERVAL = int(os.getenv("STRIPE_EVENTS_POLL_INTERVAL", 10))
+FULL_RECONCILE_INTERVAL = int(
+    os.getenv("STRIPE_FULL_RECONCILE_INTERVAL", 3600))
 
+EVENTS_CURSOR = "stripe_customer_events"
+# Stripe only keeps events for 30 days
+EVENT_RETENTION = 30 * 24 * 60 * 60
 
-def sync_customer(customers: List[StripeCustomer]) -> None:
+stopping = threading.Event()
+
+
+def sync_customer(db: Session, customers: Iterable[StripeCustomer]) -> None:
     """
     Synchronize customer data between Stripe and local database.
 
     Parameters:
-    - customers (List[StripeCustomer]): List of Stripe customer objects.
+    - db (Session): SQLAlchemy database session.
+    - customers (Iterable[StripeCustomer]): Stream of every Stripe customer object.
 
     Returns:
     None
     """
-    customer_list = []
-    for customer in customers:
-        customer_list.append(customer.id)
-        localid = sql_crud.get_idmap_from_externalid(
-            db, customer.id)
-        local_customer = schemas.Customer(
-            name=customer.name, email=customer.email)
-        if localid is None:
-            # create
-            data = {
-                "stripe_customer_id": customer.id,
-                "customer": local_customer.model_dump()
-            }
-            producer.produce_message(
-                json.dumps(data), topic="stripetolocal", partition=0)
-        else:
-            # update
-            data = {
-                "customer_id": localid.localid,
-                "customer": local_customer.model_dump()
-            }
-            if not sql_crud.is_data_same(db, data["customer_id"], local_customer):
-                producer.produce_message(
-                    json.dumps(data), topic="stripetolocal", partition=1)
-
-    # find customers to be deleted and delete it
-    customer_idmap_list = sql_crud.get_all_customer_with_externalid(
-        db, customer_list)
-    for customer, idmap in customer_idmap_list:
-        if idmap.externalid not in customer_list:
-            data = {
-                "customer_id": customer.id
-            }
-            producer.produce_message(
-                json.dumps(data), topic="stripetolocal", partition=2)
+    counts = reconcile.reconcile(db, customers)
+    for operation, count in counts.items():
+        metrics.RECONCILE_CHANGES.labels(operation).set(count)
+    print(
+        f"Produced {counts['create']} creates, {counts['update']} updates and {counts['delete']} deletes")
 
 
+@metrics.POLL_DURATION.labels("full").time()
 def poll_stripe_customers() -> None:
     """
-    Poll Stripe for customer updates periodically.
+    Reconcile every Stripe customer against the local database.
+
+    The event cursor is anchored at the latest event seen before the
+    reconcile started, or at its start time when there is none, so
+    incremental polling resumes from there.
+
+    Returns:
+    None
+    """
+
+    print("Full reconcile started...")
+
+    with database.session_scope() as db:
+        started_at = int(time.time())
+        try:
+            latest_event = stripe_crud.get_latest_event()
+            sync_customer(db, stripe_crud.iter_customers(PAGE_SIZE))
+        except stripe.StripeError as e:
+            # nothing was deleted, deletes are only produced once every page was read
+            print({'error': "Unable to get Customer", 'details': e})
+            return
+
+        if latest_event is not None:
+            sql_crud.save_sync_cursor(
+                db, EVENTS_CURSOR, latest_event.id, latest_event.created, started_at)
+        else:
+            sql_crud.save_sync_cursor(db, EVENTS_CURSOR, None, None, started_at)
+
+    print("Full reconcile completed successfully.")
+
+
+@metrics.POLL_DURATION.labels("events").time()
+def poll_stripe_events() -> None:
+    """
+    Poll the Stripe customer events that happened since the persisted cursor
+    and handle them like webhook events.
+
+    Falls back to a full reconcile when the cursor is missing or was last
+    checked longer ago than Stripe keeps events.
+
+    Returns:
+    None
+    """
+    with database.session_scope() as db:
+        cursor = sql_crud.get_sync_cursor(db, EVENTS_CURSOR)
+        started_at = int(time.time())
+        usable = cursor is not None and cursor.checked_at >= started_at - EVENT_RETENTION
+        last_event = None
+        checked = False
+        try:
+            if usable:
+                if cursor.last_event_id is not None and cursor.last_created >= started_at - EVENT_RETENTION:
+                    events = stripe_crud.iter_events_after(
+                        cursor.last_event_id, PAGE_SIZE)
+                else:
+                    # no event to resume after, or Stripe no longer has it
+                    events = stripe_crud.iter_events_since(
+                        cursor.checked_at, PAGE_SIZE)
+                for event in events:
+                    stripe_webhook.handle_event(event, db)
+                    metrics.POLLED_EVENTS.inc()
+                    last_event = event
+                checked = True
+        except stripe.StripeError as e:
+            print({'error': "Unable to get Events", 'details': e})
+        finally:
+            if last_event is not None or checked:
+                # only move the cursor past events that reached Kafka
+                producer.flush()
+                if last_event is not None:
+                    sql_crud.save_sync_cursor(
+                        db, EVENTS_CURSOR, last_event.id, last_event.created,
+                        started_at if checked else max(cursor.checked_at, last_event.created))
+                    print(f"Handled customer events up to {last_event.id}")
+                else:
+                    sql_crud.save_sync_cursor(
+                        db, EVENTS_CURSOR, cursor.last_event_id, cursor.last_created, started_at)
+
+    if not usable:
+        print("No usable event cursor, falling back to a full reconcile")
+        poll_stripe_customers()
+
+
+def run_job(job: Callable[[], None]) -> None:
+    """
+    Run a poll, reporting its failure instead of letting it end the poller.
+
+    Parameters:
+    - job (Callable[[], None]): Poll to run.
 
     Returns:
     None
     """
+    try:
+        job()
+    except Exception as e:
+        print({'error': f"Poll {job.__name__} failed", 'details': repr(e)})
 
-    print("Polling started...")
 
-    customers = stripe_crud.get_customer_list()
+def run(full: bool = False) -> None:
+    """
+    Run the scheduled polls until stop() is called.
 
-    if customers.get("error") is not None:
-        print(customers.get("error"))
-        return
+    Parameters:
+    - full (bool, optional): Flag to indicate whether to reconcile the full customer list right away. Defaults to False.
+
+    Returns:
+    None
+    """
+    if full:
+        run_job(poll_stripe_customers)
+
+    schedule.every(EVENTS_POLL_INTERVAL).seconds.do(run_job, poll_stripe_events)
+    schedule.every(FULL_RECONCILE_INTERVAL).seconds.do(
+        run_job, poll_stripe_customers)
+
+    while not stopping.is_set():
+        schedule.run_pending()
+        stopping.wait(1)
 
-    sync_customer(customers)
 
-    print("Polling completed successfully.")
+def stop() -> None:
+    """
+    Make the running poller return once its current poll is done.
 
+    Returns:
+    None
+    """
+    stopping.set()
 
-schedule.every(10).seconds.do(poll_stripe_customers)
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+if __name__ == "__main__":
+    database.configure_role(database.POLLER)
+    models.Base.metadata.create_all(bind=database.engine)
+    metrics.start_exporter("POLLER_METRICS_PORT", 9102)
+    run("--full" in sys.argv[1:])
@@ -0,0 +1,273 @@
+from typing import List, Tuple, Union
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import exc, delete, insert, select, update
+
+from . import models, schemas, crud
+from ..kafka import topics
+
+
+async def get_customer(db: AsyncSession, customer_id: int) -> models.Customer:
+    """
+    Get customer details from the local database.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - customer_id (int): ID of the customer to be retrieved.
+
+    Returns:
+    models.Customer: Customer details.
+    """
+    return await db.scalar(select(models.Customer).where(models.Customer.id == customer_id))
+
+
+async def get_customer_by_email(db: AsyncSession, email: str) -> models.Customer:
+    """
+    Get customer details by email from the local database.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - email (str): Email of the customer to be retrieved.
+
+    Returns:
+    models.Customer: Customer details.
+    """
+    return await db.scalar(select(models.Customer).where(models.Customer.email == email))
+
+
+async def create_customer(db: AsyncSession, customer: schemas.Customer, create_message: bool = True) -> Union[models.Customer, None]:
+    """
+    Create a new customer in the local database along with its outbox event.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - customer (schemas.Customer): Customer data to be created.
+    - create_message (bool, optional): Flag to indicate whether to create a Kafka message. Defaults to True.
+
+    Returns:
+    models.Customer: Created customer object.
+    """
+    db_customer = models.Customer(email=customer.email, name=customer.name)
+    try:
+        db.add(db_customer)
+        await db.flush()
+        if create_message:
+            data = {
+                "customer_id": db_customer.id,
+                "customer": customer.model_dump()
+            }
+            await db.run_sync(crud.add_outbox_event, topics.LOCAL_TO_STRIPE, topics.CREATE, db_customer.id, data)
+        await db.commit()
+        return db_customer
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        raise  # bare raise to maintain the stack trace
+
+
+async def update_customer(db: AsyncSession, customer_id: int, customer: schemas.Customer, create_message: bool = True) -> Union[int, None]:
+    """
+    Update an existing customer in the local database along with its outbox event.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - customer_id (int): ID of the customer to be updated.
+    - customer (schemas.Customer): Updated customer data.
+    - create_message (bool, optional): Flag to indicate whether to create a Kafka message. Defaults to True.
+
+    Returns:
+    int: Number of rows updated.
+    """
+    try:
+        result = await db.execute(update(models.Customer).where(models.Customer.id == customer_id).values(
+            name=customer.name, email=customer.email))
+        if result.rowcount > 0:
+            # always sent, an earlier change may still be in flight; the consumer skips the ones already synced
+            if create_message:
+                data = {
+                    "customer_id": customer_id,
+                    "customer": customer.model_dump()
+                }
+                await db.run_sync(crud.add_outbox_event, topics.LOCAL_TO_STRIPE, topics.UPDATE, customer_id, data)
+            await db.commit()
+            return result.rowcount
+        await db.rollback()
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        raise  # bare raise to maintain the stack trace
+
+
+async def delete_customer(db: AsyncSession, customer_id: int, create_message: bool = True) -> Union[int, None]:
+    """
+    Delete a customer from the local database along with its outbox event.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - customer_id (int): ID of the customer to be deleted.
+    - create_message (bool, optional): Flag to indicate whether to create a Kafka message. Defaults to True.
+
+    Returns:
+    int: Number of rows deleted.
+    """
+    try:
+        result = await db.execute(delete(models.Customer).where(models.Customer.id == customer_id))
+        if result.rowcount > 0:
+            if create_message:
+                data = {
+                    "customer_id": customer_id
+                }
+                await db.run_sync(crud.add_outbox_event, topics.LOCAL_TO_STRIPE, topics.DELETE, customer_id, data)
+            await db.commit()
+            return result.rowcount
+        await db.rollback()
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        raise  # bare raise to maintain the stack trace
+
+
+async def create_customers_bulk(db: AsyncSession, customers: List[Tuple[int, schemas.Customer]]) -> List[schemas.BulkResult]:
+    """
+    Create many customers with a single email conflict query, a bulk insert and
+    a bulk insert of their outbox events, all in one transaction.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - customers (List[Tuple[int, schemas.Customer]]): Request index and data of each customer to be created.
+
+    Returns:
+    List[schemas.BulkResult]: Result of each customer.
+    """
+    taken = set(await db.scalars(select(models.Customer.email).where(
+        models.Customer.email.in_({customer.email for _, customer in customers}))))
+
+    results, accepted = [], []
+    for index, customer in customers:
+        if customer.email in taken:
+            results.append(schemas.BulkResult(
+                index=index, status="conflict", detail="Email already registered"))
+        else:
+            taken.add(customer.email)
+            accepted.append((index, customer))
+    if not accepted:
+        return results
+
+    try:
+        if db.get_bind().dialect.insert_returning:
+            customer_ids = (await db.scalars(
+                insert(models.Customer).returning(
+                    models.Customer.id, sort_by_parameter_order=True),
+                [customer.model_dump() for _, customer in accepted])).all()
+        else:
+            # MySQL returns no rows, the new customers are read back by their unique email
+            await db.execute(insert(models.Customer), [customer.model_dump() for _, customer in accepted])
+            ids = dict((await db.execute(select(models.Customer.email, models.Customer.id).where(
+                models.Customer.email.in_([customer.email for _, customer in accepted])))).all())
+            customer_ids = [ids[customer.email] for _, customer in accepted]
+        await db.execute(insert(models.Outbox), [
+            crud.outbox_row(topics.LOCAL_TO_STRIPE, topics.CREATE, customer_id,
+                            {"customer_id": customer_id, "customer": customer.model_dump()})
+            for customer_id, (_, customer) in zip(customer_ids, accepted)])
+        await db.commit()
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        raise  # bare raise to maintain the stack trace
+
+    results.extend(schemas.BulkResult(index=index, status="created", id=customer_id)
+                   for customer_id, (index, _) in zip(customer_ids, accepted))
+    return results
+
+
+async def update_customers_bulk(db: AsyncSession, customers: List[Tuple[int, schemas.CustomerWithId]]) -> List[schemas.BulkResult]:
+    """
+    Update many customers with set-based existence and email conflict queries,
+    a bulk update and a bulk insert of their outbox events, all in one transaction.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - customers (List[Tuple[int, schemas.CustomerWithId]]): Request index and data of each customer to be updated.
+
+    Returns:
+    List[schemas.BulkResult]: Result of each customer.
+    """
+    ids = {customer.id for _, customer in customers}
+    existing = set(await db.scalars(select(models.Customer.id).where(models.Customer.id.in_(ids))))
+    owners = dict((await db.execute(select(models.Customer.email, models.Customer.id).where(
+        models.Customer.email.in_({customer.email for _, customer in customers})))).all())
+
+    results, accepted = [], {}
+    for index, customer in customers:
+        if customer.id not in existing:
+            results.append(schemas.BulkResult(
+                index=index, status="not_found", id=customer.id, detail="Customer not found"))
+        elif owners.get(customer.email, customer.id) != customer.id:
+            results.append(schemas.BulkResult(
+                index=index, status="conflict", id=customer.id, detail="Email already registered"))
+        else:
+            if customer.id in accepted:
+                # a repeated ID is applied once, with its latest data
+                results.append(schemas.BulkResult(
+                    index=accepted[customer.id][0], status="updated", id=customer.id))
+            owners[customer.email] = customer.id
+            accepted[customer.id] = (index, customer)
+    if not accepted:
+        return results
+
+    try:
+        await db.execute(update(models.Customer), [
+            {"id": customer.id, "name": customer.name, "email": customer.email}
+            for _, customer in accepted.values()])
+        outbox_rows = [
+            crud.outbox_row(topics.LOCAL_TO_STRIPE, topics.UPDATE, customer.id,
+                            {"customer_id": customer.id, "customer": schemas.Customer(name=customer.name, email=customer.email).model_dump()})
+            for _, customer in accepted.values()]
+        await db.execute(insert(models.Outbox), outbox_rows)
+        await db.commit()
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        raise  # bare raise to maintain the stack trace
+
+    results.extend(schemas.BulkResult(index=index, status="updated", id=customer.id)
+                   for index, customer in accepted.values())
+    return results
+
+
+async def delete_customers_bulk(db: AsyncSession, customers: List[Tuple[int, schemas.CustomerRef]]) -> List[schemas.BulkResult]:
+    """
+    Delete many customers with a single bulk delete and a bulk insert of their outbox events, in one transaction.
+
+    Parameters:
+    - db (AsyncSession): SQLAlchemy async database session.
+    - customers (List[Tuple[int, schemas.CustomerRef]]): Request index and ID of each customer to be deleted.
+
+    Returns:
+    List[schemas.BulkResult]: Result of each customer.
+    """
+    ids = {customer.id for _, customer in customers}
+    try:
+        if db.get_bind().dialect.delete_returning:
+            deleted = set(await db.scalars(delete(models.Customer).where(
+                models.Customer.id.in_(ids)).returning(models.Customer.id)))
+        else:
+            # MySQL returns no rows, the existing customers are locked and read before the delete
+            deleted = set(await db.scalars(select(models.Customer.id).where(
+                models.Customer.id.in_(ids)).with_for_update()))
+            await db.execute(delete(models.Customer).where(models.Customer.id.in_(deleted)))
+        if deleted:
+            await db.execute(insert(models.Outbox), [
+                crud.outbox_row(topics.LOCAL_TO_STRIPE, topics.DELETE, customer_id,
+                                {"customer_id": customer_id})
+                for customer_id in deleted])
+        await db.commit()
+    except exc.SQLAlchemyError:
+        await db.rollback()
+        raise  # bare raise to maintain the stack trace
+
+    results = []
+    for index, customer in customers:
+        if customer.id in deleted:
+            # a repeated ID is only reported deleted once
+            deleted.discard(customer.id)
+            results.append(schemas.BulkResult(
+                index=index, status="deleted", id=customer.id))
+        else:
+            results.append(schemas.BulkResult(
+                index=index, status="not_found", id=customer.id, detail="Customer not found"))
+    return results
@@ -1,11 +1,12 @@
 import json
+import time
 
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 from sqlalchemy.orm import Session
-from sqlalchemy import exc
+from sqlalchemy import exc, delete, select, update
 
-from . import models, schemas
-from ..kafka import producer
+from . import database, idmapping, models, schemas, syncstate
+from ..kafka import codec, topics
 
 
 def get_customer(db: Session, customer_id: int) -> models.Customer:
@@ -36,23 +37,78 @@ def get_customer_by_email(db: Session, email: str) -> models.Customer:
     return db.query(models.Customer).filter(models.Customer.email == email).first()
 
 
-def get_all_customer_with_externalid(db: Session, external_ids: List) -> List[Tuple[models.Customer, models.IDMap]]:
+def get_all_customer_with_externalid(db: Session, external_ids: List = None) -> List[Tuple[models.Customer, models.IDMap]]:
     """
     Get a list of customers with their external IDs from the local database.
 
     Parameters:
     - db (Session): SQLAlchemy database session.
-    - external_ids (List): List of external IDs.
+    - external_ids (List, optional): List of external IDs to restrict the result to. Defaults to all customers.
 
     Returns:
     List[Tuple[models.Customer, models.IDMap]]: List of customer and IDMap tuples.
     """
-    return db.query(models.Customer, models.IDMap).join(models.IDMap, models.Customer.id == models.IDMap.localid).all()
+    query = db.query(models.Customer, models.IDMap).join(
+        models.IDMap, models.Customer.id == models.IDMap.localid)
+    if external_ids is not None:
+        query = query.filter(models.IDMap.externalid.in_(set(external_ids)))
+    return query.all()
+
+
+def get_customer_index(db: Session) -> Dict[str, Tuple[int, str, str]]:
+    """
+    Get every synchronized customer with a single joined query, indexed by external ID.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+
+    Returns:
+    Dict[str, Tuple[int, str, str]]: Local ID, name and email keyed by external ID.
+    """
+    rows = db.query(models.IDMap.externalid, models.Customer.id, models.Customer.name, models.Customer.email).join(
+        models.Customer, models.Customer.id == models.IDMap.localid)
+    return {externalid: (localid, name, email) for externalid, localid, name, email in rows}
+
+
+def add_outbox_event(db: Session, topic: str, operation: str, key: str, data: Dict) -> models.Outbox:
+    """
+    Add a change event to the outbox within the caller's transaction. The relay produces it once committed.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - topic (str): Kafka topic the event is meant for.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - key (str): Customer ID owning the change.
+    - data (Dict): Message data.
+
+    Returns:
+    models.Outbox: Added outbox entry.
+    """
+    event = models.Outbox(**outbox_row(topic, operation, key, data))
+    db.add(event)
+    return event
+
+
+def outbox_row(topic: str, operation: str, key: str, data: Dict) -> Dict:
+    """
+    Build the column values of an outbox event, for bulk inserts.
+
+    Parameters:
+    - topic (str): Kafka topic the event is meant for.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - key (str): Customer ID owning the change.
+    - data (Dict): Message data.
+
+    Returns:
+    Dict: Outbox column values.
+    """
+    return {"topic": topic, "operation": operation, "key": str(key),
+            "payload": json.dumps(data), "created_at": time.time()}
 
 
 def create_customer(db: Session, customer: schemas.Customer, create_message: bool = True) -> Union[models.Customer, None]:
     """
-    Create a new customer in the local database and produce a Kafka message.
+    Create a new customer in the local database along with its outbox event.
 
     Parameters:
     - db (Session): SQLAlchemy database session.
@@ -62,37 +118,28 @@ def create_customer(db: Session, customer: schemas.Customer, create_message: boo
     Returns:
     models.Customer: Created customer object.
     """
-    msg_sucess = None
     db_customer = models.Customer(email=customer.email, name=customer.name)
     try:
-        with db.begin_nested():
-            db.add(db_customer)
-            db.flush()
-            db.refresh(db_customer)
-            if create_message:
-                data = {
-                    "customer_id": db_customer.id,
-                    "customer": customer.model_dump()
-                }
-                producer.produce_message(
-                    json.dumps(data), topic="localtostripe", partition=0)
-                msg_sucess = True
-        return db_customer
-    except (exec.SQLAlchemyError, producer.ProduceError):
-        print(e)
-        if msg_sucess:
-            # reverting the produced message action
+        db.add(db_customer)
+        db.flush()
+        if create_message:
             data = {
-                "customer_id": db_customer.id
+                "customer_id": db_customer.id,
+                "customer": customer.model_dump()
             }
-            producer.produce_message(
-                json.dumps(data), topic="localtostripe", partition=2)
+            add_outbox_event(
+                db, topics.LOCAL_TO_STRIPE, topics.CREATE, db_customer.id, data)
+        db.commit()
+        db.refresh(db_customer)
+        return db_customer
+    except exc.SQLAlchemyError:
+        db.rollback()
         raise  # bare raise to maintain the stack trace
 
 
 def update_customer(db: Session, customer_id: int, customer: schemas.Customer, create_message: bool = True) -> Union[int, None]:
     """
-    Update an existing customer in the local database and produce a Kafka message.
+    Update an existing customer in the local database along with its outbox event.
 
     Parameters:
     - db (Session): SQLAlchemy database session.
@@ -103,38 +150,29 @@ def update_customer(db: Session, customer_id: int, customer: schemas.Customer, c
     Returns:
     int: Number of rows updated.
     """
-    msg_sucess = None
     try:
-        with db.begin_nested():
-            row_cnt = db.query(models.Customer).filter(models.Customer.id == customer_id).update(
-                {models.Customer.name: customer.name, models.Customer.email: customer.email}, synchronize_session=False)
-            if row_cnt > 0:
-                if create_message:
-                    data = {
-                        "customer_id": customer_id,
-                        "customer": customer.model_dump()
-                    }
-                    producer.produce_message(
-                        json.dumps(data), topic="localtostripe", partition=1)
-                    msg_sucess = True
-                return row_cnt
-    except (exec.SQLAlchemyError, producer.ProduceError):
-        print(e)
-        if msg_sucess:
-            # reverting the produced message action
-            model_customer = get_customer(db, customer_id)
-            data = {
-                "customer_id": customer_id,
-                "customer": schemas.Customer(name=model_customer.name, email=model_customer.email).model_dump()
-            }
-            producer.produce_message(
-                json.dumps(data), topic="localtostripe", partition=1)
+        row_cnt = db.query(models.Customer).filter(models.Customer.id == customer_id).update(
+            {models.Customer.name: customer.name, models.Customer.email: customer.email}, synchronize_session=False)
+        if row_cnt > 0:
+            # always sent, an earlier change may still be in flight; the consumer skips the ones already synced
+            if create_message:
+                data = {
+                    "customer_id": customer_id,
+                    "customer": customer.model_dump()
+                }
+                add_outbox_event(
+                    db, topics.LOCAL_TO_STRIPE, topics.UPDATE, customer_id, data)
+            db.commit()
+            return row_cnt
+        db.rollback()
+    except exc.SQLAlchemyError:
+        db.rollback()
         raise  # bare raise to maintain the stack trace
 
 
 def delete_customer(db: Session, customer_id: int, create_message: bool = True) -> Union[int, None]:
     """
-    Delete a customer from the local database and produce a Kafka message.
+    Delete a customer from the local database along with its outbox event.
 
     Parameters:
     - db (Session): SQLAlchemy database session.
@@ -144,37 +182,111 @@ def delete_customer(db: Session, customer_id: int, create_message: bool = True)
     Returns:
     int: Number of rows deleted.
     """
-    msg_sucess = None
     try:
-        with db.begin_nested():
-            row_cnt = db.query(models.Customer).filter(models.Customer.id ==
-                                                       customer_id).delete(synchronize_session=False)
-            if row_cnt > 0:
-                if create_message:
-                    data = {
-                        "customer_id": customer_id
-                    }
-                    producer.produce_message(
-                        json.dumps(data), topic="localtostripe", partition=2)
-                    msg_sucess = True
-                return row_cnt
-    except (exec.SQLAlchemyError, producer.ProduceError):
-        print(e)
-        if msg_sucess:
-            # reverting the produced message action
-            model_customer = get_customer(db, customer_id)
-            data = {
-                "customer_id": customer_id,
-                "customer": schemas.Customer(name=model_customer.name, email=model_customer.email).model_dump()
-            }
-            producer.produce_message(
-                json.dumps(data), topic="localtostripe", partition=0)
+        row_cnt = db.query(models.Customer).filter(models.Customer.id ==
+                                                   customer_id).delete(synchronize_session=False)
+        if row_cnt > 0:
+            if create_message:
+                data = {
+                    "customer_id": customer_id
+                }
+                add_outbox_event(
+                    db, topics.LOCAL_TO_STRIPE, topics.DELETE, customer_id, data)
+            db.commit()
+            return row_cnt
+        db.rollback()
+    except exc.SQLAlchemyError:
+        db.rollback()
         raise  # bare raise to maintain the stack trace
 
 
+def get_pending_outbox_events(db: Session, limit: int) -> List[models.Outbox]:
+    """
+    Get the oldest outbox events that were not sent yet.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - limit (int): Maximum number of events.
+
+    Returns:
+    List[models.Outbox]: Pending events, oldest first.
+    """
+    return db.query(models.Outbox).filter(models.Outbox.sent_at.is_(None)).order_by(models.Outbox.id).limit(limit).all()
+
+
+def mark_outbox_events_sent(db: Session, event_ids: List[int], retention: float) -> None:
+    """
+    Mark outbox events as sent in bulk and drop the ones sent longer ago than the retention.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - event_ids (List[int]): IDs of the sent events.
+    - retention (float): Time in seconds sent events are kept for.
+
+    Returns:
+    None
+    """
+    now = time.time()
+    if event_ids:
+        db.execute(update(models.Outbox).where(
+            models.Outbox.id.in_(event_ids)).values(sent_at=now))
+    db.execute(delete(models.Outbox).where(
+        models.Outbox.sent_at < now - retention))
+    db.commit()
+
+
+def upsert_idmaps(db: Session, mappings: List[Tuple[int, str]]) -> None:
+    """
+    Create the IDMap entries of local IDs in bulk, replacing any existing ones, within the caller's transaction.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - mappings (List[Tuple[int, str]]): Local ID and external ID pairs.
+
+    Returns:
+    None
+    """
+    if not mappings:
+        return
+    rows = {localid: {"localid": localid, "externalid": externalid}
+            for localid, externalid in mappings}
+    db.execute(database.upsert(db, models.IDMap, ["localid"], ["externalid"]),
+               list(rows.values()))
+
+
+def upsert_customers(db: Session, customers: List[schemas.Customer]) -> Dict[str, int]:
+    """
+    Create customers in bulk within the caller's transaction, updating instead the unmapped
+    local customers that already have their email.
+
+    A customer whose email belongs to a mapped local customer is neither created nor updated.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - customers (List[schemas.Customer]): Customer data.
+
+    Returns:
+    Dict[str, int]: Local IDs of the created or updated customers, keyed by email.
+    """
+    if not customers:
+        return {}
+    unmapped = models.Customer.id.not_in(select(models.IDMap.localid))
+    stmt = database.upsert(db, models.Customer, ["email"], ["name"], where=unmapped)
+    if db.get_bind().dialect.insert_returning:
+        rows = db.execute(stmt.returning(models.Customer.email, models.Customer.id),
+                          [customer.model_dump() for customer in customers])
+    else:
+        # MySQL returns no rows, the customers are read back by email before they are mapped
+        db.execute(stmt, [customer.model_dump() for customer in customers])
+        rows = db.execute(select(models.Customer.email, models.Customer.id).where(
+            models.Customer.email.in_([customer.email for customer in customers]), unmapped))
+    return {email: customer_id for email, customer_id in rows}
+
+
 def create_idmap(db: Session, localid: int, externalid: str) -> models.IDMap:
     """
-    Create an IDMap entry in the local database.
+    Create the IDMap entry of a local ID in the local database, replacing any existing one
+    so a redelivered message can record it again.
 
     Parameters:
     - db (Session): SQLAlchemy database session.
@@ -184,11 +296,59 @@ def create_idmap(db: Session, localid: int, externalid: str) -> models.IDMap:
     Returns:
     models.IDMap: Created IDMap object.
     """
-    idmap_element = models.IDMap(localid=localid, externalid=externalid)
-    db.add(idmap_element)
-    db.commit()
-    db.refresh(idmap_element)
-    return idmap_element
+    try:
+        upsert_idmaps(db, [(localid, externalid)])
+        db.commit()
+    except exc.SQLAlchemyError:
+        db.rollback()
+        raise  # bare raise to maintain the stack trace
+    idmapping.cache.put(localid, externalid)
+    return db.get(models.IDMap, localid)
+
+
+def upsert_external_customer(db: Session, externalid: str, customer: schemas.Customer) -> Tuple[models.Customer, bool]:
+    """
+    Create a customer coming from Stripe along with its ID mapping, or update the local customer
+    it was already created as, so a redelivered create is only applied once.
+
+    An unmapped local customer with the same email is linked to the Stripe customer rather than
+    conflicting with it.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - externalid (str): External ID.
+    - customer (schemas.Customer): Customer data.
+
+    Returns:
+    Tuple[models.Customer, bool]: Local customer, and whether it was created.
+    """
+    try:
+        db_customer = None
+        localid = idmapping.get_localid(db, externalid)
+        if localid is not None:
+            db_customer = db.get(models.Customer, localid)
+        if db_customer is None:
+            db_customer = db.query(models.Customer).outerjoin(
+                models.IDMap, models.Customer.id == models.IDMap.localid).filter(
+                models.Customer.email == customer.email, models.IDMap.localid.is_(None)).first()
+
+        created = db_customer is None
+        if created:
+            db_customer = models.Customer(
+                email=customer.email, name=customer.name)
+            db.add(db_customer)
+        else:
+            db_customer.name = customer.name
+            db_customer.email = customer.email
+        db.flush()
+        upsert_idmaps(db, [(db_customer.id, externalid)])
+        db.commit()
+        db.refresh(db_customer)
+        idmapping.cache.put(db_customer.id, externalid)
+        return db_customer, created
+    except exc.SQLAlchemyError:
+        db.rollback()
+        raise  # bare raise to maintain the stack trace
 
 
 def get_idmap_from_localid(db: Session, localid: int) -> models.IDMap:
@@ -230,6 +390,7 @@ def delete_idmap_by_localid(db: Session, localid: int) -> int:
     Returns:
     int: Number of rows deleted.
     """
+    idmapping.cache.invalidate(localid)
     row_cnt = db.query(models.IDMap).filter(models.IDMap.localid ==
                                             localid).delete(synchronize_session=False)
     if row_cnt > 0:
@@ -256,3 +417,140 @@ def is_data_same(db: Session, customer_id: int, customer: models.Customer) -> bo
         return existing_customer.name == customer.name and existing_customer.email == customer.email
 
     return False
+
+
+def apply_customer_batch(db: Session, creates: List[codec.CustomerChange], updates: List[codec.CustomerChange], deletes: List[codec.CustomerChange]) -> Tuple[int, int, int]:
+    """
+    Apply a batch of synchronized customer changes in a single transaction.
+
+    Each change is a decoded message. Creates carry the Stripe customer
+    ID, while updates and deletes carry either the local or the Stripe
+    customer ID. Creates of Stripe customers that are already mapped, as
+    redelivered after a crash, are applied as updates. Creates matching
+    an unmapped local customer by email are linked to it, a create whose
+    email belongs to another mapped customer fails the batch, as do two
+    creates sharing an email and an update or delete of an unmapped
+    Stripe customer.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - creates (List[codec.CustomerChange]): Customers to be created along with their ID mapping.
+    - updates (List[codec.CustomerChange]): Customers to be updated.
+    - deletes (List[codec.CustomerChange]): Customers to be deleted along with their ID mapping.
+
+    Returns:
+    Tuple[int, int, int]: Number of customers created, updated and deleted.
+    """
+    try:
+        mapped = idmapping.resolve_many(
+            db, [data.stripe_customer_id for data in creates])
+        if mapped:
+            updates = [data for data in creates if data.stripe_customer_id in mapped] + updates
+            creates = [data for data in creates if data.stripe_customer_id not in mapped]
+
+        customer_ids = []
+        if creates:
+            if len({data.customer.email for data in creates}) < len(creates):
+                # a second create would update the customer of the first one and leave its own unmapped
+                raise ValueError("Creates of a batch must have distinct emails")
+            by_email = upsert_customers(db, [data.customer for data in creates])
+            conflicts = [data.customer.email for data in creates
+                         if data.customer.email not in by_email]
+            if conflicts:
+                db.rollback()
+                raise ValueError(
+                    f"Emails already belong to other synchronized customers: {', '.join(conflicts)}")
+            customer_ids = [by_email[data.customer.email] for data in creates]
+            upsert_idmaps(db, [(customer_id, data.stripe_customer_id)
+                               for customer_id, data in zip(customer_ids, creates)])
+
+        # resolved after the inserts so changes to customers created in this batch are found
+        localids = idmapping.resolve_many(db, [
+            data.stripe_customer_id for data in updates + deletes if not data.customer_id])
+
+        def localid(data: codec.CustomerChange) -> int:
+            if data.customer_id:
+                return data.customer_id
+            customer_id = localids.get(data.stripe_customer_id)
+            if customer_id is None:
+                # its create may not be applied yet, handled on its own it goes through the retry topics
+                raise ValueError(
+                    f"No Id mapping found for {data.stripe_customer_id}")
+            return customer_id
+
+        synced_states = [(customer_id, data.stripe_customer_id, data.customer)
+                         for customer_id, data in zip(customer_ids, creates)]
+
+        resolved_updates = [(localid(data), data) for data in updates]
+        fingerprints = syncstate.get_fingerprints(
+            db, [customer_id for customer_id, _ in resolved_updates])
+        update_rows = []
+        for customer_id, data in resolved_updates:
+            customer = data.customer
+            if fingerprints.get(customer_id) == syncstate.fingerprint(customer):
+                # already in the last synced state
+                continue
+            update_rows.append({"id": customer_id, **customer.model_dump()})
+            if data.stripe_customer_id:
+                synced_states.append(
+                    (customer_id, data.stripe_customer_id, customer))
+        if update_rows:
+            db.execute(update(models.Customer), update_rows)
+
+        delete_ids = [localid(data) for data in deletes]
+        if delete_ids:
+            db.execute(delete(models.Customer).where(
+                models.Customer.id.in_(delete_ids)))
+            db.execute(delete(models.IDMap).where(
+                models.IDMap.localid.in_(delete_ids)))
+            syncstate.forget(db, delete_ids, commit=False)
+            for customer_id in delete_ids:
+                idmapping.cache.invalidate(customer_id)
+
+        syncstate.save_many(db, synced_states)
+        db.commit()
+        for customer_id, data in zip(customer_ids, creates):
+            idmapping.cache.put(customer_id, data.stripe_customer_id)
+        return len(creates), len(update_rows), len(delete_ids)
+    except exc.SQLAlchemyError:
+        db.rollback()
+        raise  # bare raise to maintain the stack trace
+
+
+def get_sync_cursor(db: Session, name: str) -> Union[models.SyncCursor, None]:
+    """
+    Get a persisted sync cursor from the local database.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - name (str): Name of the cursor.
+
+    Returns:
+    models.SyncCursor: Cursor details, None if it was never saved.
+    """
+    return db.query(models.SyncCursor).filter(models.SyncCursor.name == name).first()
+
+
+def save_sync_cursor(db: Session, name: str, last_event_id: Union[str, None], last_created: Union[int, None], checked_at: int) -> models.SyncCursor:
+    """
+    Create or move a sync cursor in the local database.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - name (str): Name of the cursor.
+    - last_event_id (str): ID of the last handled event, None if there was none.
+    - last_created (int): Creation timestamp of the last handled event, None if there was none.
+    - checked_at (int): Epoch time up to which every event was handled.
+
+    Returns:
+    models.SyncCursor: Saved cursor.
+    """
+    cursor = get_sync_cursor(db, name)
+    if cursor is None:
+        cursor = models.SyncCursor(name=name)
+        db.add(cursor)
+    cursor.last_event_id = last_event_id
+    cursor.last_created = last_created
+    cursor.checked_at = checked_at
+    db.commit()
+    return cursor
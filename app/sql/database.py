@@ -1,19 +1,211 @@
 import os
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Type
+
+from sqlalchemy import case, create_engine, event
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import make_url, Engine, URL
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy.sql.dml import Insert
+from sqlalchemy.sql.elements import ColumnElement
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
 
-engine = create_engine(
-    os.getenv("SQLALCHEMY_DATABASE_URL"), connect_args={"check_same_thread": False}
-)
+DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL")
+
+# async drivers used by the async engine for each database backend
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+
+# process roles, each sizing its connection pool with DB_<ROLE>_POOL_SIZE and DB_<ROLE>_MAX_OVERFLOW
+API = "api"
+CONSUMER = "consumer"
+POLLER = "poller"
+RELAY = "relay"
+POOL_SIZES = {
+    API: (int(os.getenv("DB_POOL_SIZE", 20)), int(os.getenv("DB_MAX_OVERFLOW", 40))),
+    CONSUMER: (10, 10),
+    POLLER: (2, 2),
+    RELAY: (2, 2),
+}
+# seconds after which server connections are replaced, before the server or a proxy drops them
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+
+# WAL lets readers go on while a writer commits, and NORMAL only syncs to disk on checkpoints
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# milliseconds a writer waits for the lock instead of failing with "database is locked"
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+
+
+def get_async_url(url: str) -> URL:
+    """
+    Convert a database URL to the same database reached through its async driver.
+
+    Parameters:
+    - url (str): SQLAlchemy database URL.
+
+    Returns:
+    URL: SQLAlchemy database URL using an async driver.
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS.get(backend, url.get_driver_name())}")
+
+
+def pool_options(url: URL, role: str) -> Dict:
+    """
+    Get the connection pool settings of a process role.
+
+    Parameters:
+    - url (URL): SQLAlchemy database URL.
+    - role (str): Process role, one of API, CONSUMER, POLLER or RELAY.
+
+    Returns:
+    Dict: Keyword arguments of the engine.
+    """
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # in-memory databases live in a single connection, their pool is not sized
+        return {}
+    size, overflow = POOL_SIZES[role]
+    options = {
+        "pool_size": int(os.getenv(f"DB_{role.upper()}_POOL_SIZE", size)),
+        "max_overflow": int(os.getenv(f"DB_{role.upper()}_MAX_OVERFLOW", overflow)),
+    }
+    if url.get_backend_name() != "sqlite":
+        options.update(pool_pre_ping=True, pool_recycle=POOL_RECYCLE)
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """
+    Apply the SQLite journal, sync and lock settings to a new connection.
+
+    Parameters:
+    - dbapi_connection: DBAPI connection, from sqlite3 or aiosqlite.
+    - connection_record: Pool record of the connection.
+
+    Returns:
+    None
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+
+def create_sync_engine(url: str, role: str) -> Engine:
+    """
+    Create the engine of a process role.
+
+    Parameters:
+    - url (str): SQLAlchemy database URL.
+    - role (str): Process role, one of API, CONSUMER, POLLER or RELAY.
+
+    Returns:
+    Engine: SQLAlchemy engine.
+    """
+    url = make_url(url)
+    connect_args = {}
+    if url.get_backend_name() == "sqlite":
+        # sessions are handed between threads, each is still used by one thread at a time
+        connect_args["check_same_thread"] = False
+    sync_engine = create_engine(
+        url, connect_args=connect_args, **pool_options(url, role))
+    if url.get_backend_name() == "sqlite":
+        event.listen(sync_engine, "connect", set_sqlite_pragmas)
+    return sync_engine
+
+
+engine = create_sync_engine(DATABASE_URL, API)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(
+    get_async_url(DATABASE_URL), **pool_options(get_async_url(DATABASE_URL), API))
+if async_engine.dialect.name == "sqlite":
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
+def configure_role(role: str) -> None:
+    """
+    Size the connection pool of the synchronous engine for the role of the current process.
+    Call it on process start, before any session is opened.
+
+    Parameters:
+    - role (str): Process role, one of API, CONSUMER, POLLER or RELAY.
+
+    Returns:
+    None
+    """
+    global engine
+    engine.dispose()
+    engine = create_sync_engine(DATABASE_URL, role)
+    SessionLocal.configure(bind=engine)
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    Open a session for a unit of work, committing it on success and rolling it back on error.
+
+    Returns:
+    Iterator[Session]: SQLAlchemy database session, closed on exit.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise  # bare raise to maintain the stack trace
+    finally:
+        db.close()
+
+
+def upsert(db: Session, model: Type[Base], index_elements: List[str], update_columns: List[str],
+           where: ColumnElement = None) -> Insert:
+    """
+    Build an INSERT of model rows that updates the existing row instead when one conflicts,
+    as INSERT ... ON CONFLICT on SQLite and PostgreSQL or ON DUPLICATE KEY UPDATE on MySQL.
+
+    MySQL has no conflict condition, each column is set to its own value there when where is false.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session, picking the dialect.
+    - model (Type[Base]): Mapped class of the table.
+    - index_elements (List[str]): Columns of the unique constraint the rows may conflict on.
+    - update_columns (List[str]): Columns set from the inserted values on conflict.
+    - where (ColumnElement, optional): Condition for an existing row to be updated, a conflicting row is skipped otherwise.
+
+    Returns:
+    Insert: Statement to execute with the rows as parameters.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        stmt = insert(model)
+        return stmt.on_conflict_do_update(
+            index_elements=index_elements, set_={column: stmt.excluded[column] for column in update_columns}, where=where)
+    if dialect == "mysql":
+        stmt = mysql.insert(model)
+        if where is None:
+            return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in update_columns})
+        return stmt.on_duplicate_key_update({column: case((where, stmt.inserted[column]), else_=model.__table__.c[column])
+                                             for column in update_columns})
+    raise NotImplementedError(f"Upserts are not supported on {dialect}")
+
+
 def get_db():
     """
     Create a new database session for each request.
@@ -23,3 +215,11 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """
+    Create a new async database session for each request.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
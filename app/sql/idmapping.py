@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Dict, List, Union
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv, find_dotenv
+
+from . import models
+
+load_dotenv(find_dotenv())
+
+
+class IDMapCache:
+    """
+    Bidirectional LRU cache of local ID <-> external ID mappings, each trusted for ttl seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # localid -> (externalid, loaded at)
+        self._by_localid: OrderedDict = OrderedDict()
+        self._by_externalid: Dict[str, int] = {}
+
+    def _lookup(self, localid: int) -> Union[str, None]:
+        """
+        Get the external ID of a local ID, dropping it once expired. The lock must be held.
+
+        Parameters:
+        - localid (int): Local ID.
+
+        Returns:
+        str: External ID, None if not cached or expired.
+        """
+        entry = self._by_localid.get(localid)
+        if entry is None:
+            return None
+        externalid, loaded_at = entry
+        if time.monotonic() - loaded_at > self._ttl:
+            del self._by_localid[localid]
+            self._by_externalid.pop(externalid, None)
+            return None
+        self._by_localid.move_to_end(localid)
+        return externalid
+
+    def get_externalid(self, localid: int) -> Union[str, None]:
+        """
+        Get the cached external ID of a local ID.
+
+        Parameters:
+        - localid (int): Local ID.
+
+        Returns:
+        str: External ID, None if not cached.
+        """
+        with self._lock:
+            return self._lookup(localid)
+
+    def get_localid(self, externalid: str) -> Union[int, None]:
+        """
+        Get the cached local ID of an external ID.
+
+        Parameters:
+        - externalid (str): External ID.
+
+        Returns:
+        int: Local ID, None if not cached.
+        """
+        with self._lock:
+            localid = self._by_externalid.get(externalid)
+            if localid is None or self._lookup(localid) != externalid:
+                return None
+            return localid
+
+    def put(self, localid: int, externalid: str) -> None:
+        """
+        Cache a mapping, evicting the least recently used ones beyond the size limit.
+
+        Parameters:
+        - localid (int): Local ID.
+        - externalid (str): External ID.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            previous = self._by_localid.pop(localid, None)
+            if previous is not None:
+                self._by_externalid.pop(previous[0], None)
+            self._by_localid[localid] = (externalid, time.monotonic())
+            self._by_externalid[externalid] = localid
+            while len(self._by_localid) > self._maxsize:
+                _, (evicted, _) = self._by_localid.popitem(last=False)
+                self._by_externalid.pop(evicted, None)
+
+    def invalidate(self, localid: int) -> None:
+        """
+        Drop the cached mapping of a local ID.
+
+        Parameters:
+        - localid (int): Local ID.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            entry = self._by_localid.pop(localid, None)
+            if entry is not None:
+                self._by_externalid.pop(entry[0], None)
+
+
+# other processes create and delete mappings too, so cached ones are only trusted for a while
+cache = IDMapCache(int(os.getenv("IDMAP_CACHE_SIZE", 100000)),
+                   float(os.getenv("IDMAP_CACHE_TTL", 60.0)))
+
+
+def get_externalid(db: Session, localid: int, fresh: bool = False) -> Union[str, None]:
+    """
+    Resolve the external ID of a local ID, going to the database on cache misses.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - localid (int): Local ID.
+    - fresh (bool, optional): Flag to indicate whether to skip the cache and read the database. Defaults to False.
+
+    Returns:
+    str: External ID, None if the customer is not mapped.
+    """
+    externalid = None if fresh else cache.get_externalid(localid)
+    if externalid is not None:
+        return externalid
+
+    idmap = db.query(models.IDMap).filter(
+        models.IDMap.localid == localid).first()
+    if idmap is None:
+        cache.invalidate(localid)
+        return None
+    cache.put(idmap.localid, idmap.externalid)
+    return idmap.externalid
+
+
+def get_localid(db: Session, externalid: str) -> Union[int, None]:
+    """
+    Resolve the local ID of an external ID, going to the database on cache misses.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - externalid (str): External ID.
+
+    Returns:
+    int: Local ID, None if the customer is not mapped.
+    """
+    localid = cache.get_localid(externalid)
+    if localid is not None:
+        return localid
+
+    idmap = db.query(models.IDMap).filter(
+        models.IDMap.externalid == externalid).first()
+    if idmap is None:
+        return None
+    cache.put(idmap.localid, idmap.externalid)
+    return idmap.localid
+
+
+def resolve_many(db: Session, externalids: List[str]) -> Dict[str, int]:
+    """
+    Resolve the local IDs of several external IDs, fetching every cache miss with a single query.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - externalids (List[str]): External IDs.
+
+    Returns:
+    Dict[str, int]: Local IDs keyed by external ID, for the customers that are mapped.
+    """
+    resolved = {}
+    missing = set()
+    for externalid in externalids:
+        localid = cache.get_localid(externalid)
+        if localid is None:
+            missing.add(externalid)
+        else:
+            resolved[externalid] = localid
+
+    if missing:
+        rows = db.query(models.IDMap.localid, models.IDMap.externalid).filter(
+            models.IDMap.externalid.in_(missing))
+        for localid, externalid in rows:
+            cache.put(localid, externalid)
+            resolved[externalid] = localid
+    return resolved
+
+
+def resolve_many_external(db: Session, localids: List[int]) -> Dict[int, str]:
+    """
+    Resolve the external IDs of several local IDs, fetching every cache miss with a single query.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - localids (List[int]): Local IDs.
+
+    Returns:
+    Dict[int, str]: External IDs keyed by local ID, for the customers that are mapped.
+    """
+    resolved = {}
+    missing = set()
+    for localid in localids:
+        externalid = cache.get_externalid(localid)
+        if externalid is None:
+            missing.add(localid)
+        else:
+            resolved[localid] = externalid
+
+    if missing:
+        rows = db.query(models.IDMap.localid, models.IDMap.externalid).filter(
+            models.IDMap.localid.in_(missing))
+        for localid, externalid in rows:
+            cache.put(localid, externalid)
+            resolved[localid] = externalid
+    return resolved
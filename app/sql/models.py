@@ -1,4 +1,4 @@
-from sqlalchemy import Column,  Integer, String
+from sqlalchemy import Column,  Float, Integer, String, Text
 
 from .database import Base
 
@@ -15,4 +15,52 @@ class IDMap(Base):
     __tablename__ = "idmap"
 
     localid = Column(Integer, primary_key=True, index=True, nullable=False)
-    externalid = Column(String, nullable=False)
+    externalid = Column(String, nullable=False, index=True)
+
+
+class SyncCursor(Base):
+    __tablename__ = "sync_cursor"
+
+    name = Column(String, primary_key=True, nullable=False)
+    # None until a customer event was seen
+    last_event_id = Column(String, nullable=True)
+    last_created = Column(Integer, nullable=True)
+    # time of the last successful poll, events after it are still to be handled
+    checked_at = Column(Integer, nullable=False)
+
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+
+    localid = Column(Integer, primary_key=True, index=True, nullable=False)
+    externalid = Column(String, nullable=False, index=True)
+    fingerprint = Column(String, nullable=False)
+
+
+class OutstandingWrite(Base):
+    __tablename__ = "outstanding_writes"
+
+    id = Column(Integer, nullable=False, primary_key=True, index=True)
+    externalid = Column(String, nullable=False, index=True)
+    operation = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=True)
+    expires_at = Column(Float, nullable=False, index=True)
+
+
+class Outbox(Base):
+    __tablename__ = "outbox"
+
+    id = Column(Integer, nullable=False, primary_key=True, index=True)
+    topic = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    operation = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(Float, nullable=False)
+    sent_at = Column(Float, nullable=True, index=True)
+
+
+class ProcessedEvent(Base):
+    __tablename__ = "processed_events"
+
+    id = Column(String, nullable=False, primary_key=True, index=True)
+    received_at = Column(Float, nullable=False, index=True)
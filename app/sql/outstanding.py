@@ -0,0 +1,62 @@
+import os
+import time
+
+from sqlalchemy.orm import Session
+from sqlalchemy import delete
+from dotenv import load_dotenv, find_dotenv
+
+from . import models
+
+load_dotenv(find_dotenv())
+
+# how long the echo of one of our own Stripe writes is expected to take at most
+TTL = float(os.getenv("OUTSTANDING_WRITE_TTL", 300))
+
+
+def register(db: Session, externalid: str, operation: str, fingerprint: str = None) -> None:
+    """
+    Register a write about to be made to Stripe, so that its echo can be recognised.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - externalid (str): External ID of the written customer.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - fingerprint (str, optional): Fingerprint of the written customer state.
+
+    Returns:
+    None
+    """
+    now = time.time()
+    db.execute(delete(models.OutstandingWrite).where(
+        models.OutstandingWrite.expires_at < now))
+    db.add(models.OutstandingWrite(externalid=externalid, operation=operation,
+                                   fingerprint=fingerprint, expires_at=now + TTL))
+    db.commit()
+
+
+def claim(db: Session, externalid: str, operation: str, fingerprint: str = None) -> bool:
+    """
+    Check if a change seen on Stripe is the echo of an outstanding write, and consume it.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - externalid (str): External ID of the changed customer.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - fingerprint (str, optional): Fingerprint of the changed customer state.
+
+    Returns:
+    bool: True if the change is our own echo, False otherwise.
+    """
+    query = db.query(models.OutstandingWrite).filter(
+        models.OutstandingWrite.externalid == externalid,
+        models.OutstandingWrite.operation == operation,
+        models.OutstandingWrite.expires_at >= time.time())
+    if fingerprint is not None:
+        query = query.filter(models.OutstandingWrite.fingerprint == fingerprint)
+
+    write = query.first()
+    if write is None:
+        return False
+    db.delete(write)
+    db.commit()
+    return True
@@ -1,6 +1,23 @@
+from typing import Union
+
 from pydantic import BaseModel
 
 
 class Customer(BaseModel):
     name: str
     email: str
+
+
+class CustomerWithId(Customer):
+    id: int
+
+
+class CustomerRef(BaseModel):
+    id: int
+
+
+class BulkResult(BaseModel):
+    index: int
+    status: str
+    id: Union[int, None] = None
+    detail: Union[str, None] = None
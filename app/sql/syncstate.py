@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from typing import Dict, List, Tuple, Union
+from sqlalchemy.orm import Session
+from sqlalchemy import delete
+from dotenv import load_dotenv, find_dotenv
+
+from . import database, models, schemas
+
+load_dotenv(find_dotenv())
+
+# other processes record sync states too, so mirrored entries are only trusted for a short while
+CACHE_TTL = float(os.getenv("SYNC_STATE_CACHE_TTL", 5.0))
+
+_lock = threading.Lock()
+# localid -> (externalid, fingerprint, loaded at)
+_by_localid: Dict[int, Tuple[str, str, float]] = {}
+_by_externalid: Dict[str, int] = {}
+
+
+def fingerprint(customer: schemas.Customer) -> str:
+    """
+    Compute a content hash of the synchronized customer fields.
+
+    Parameters:
+    - customer (schemas.Customer): Customer data.
+
+    Returns:
+    str: Hex digest identifying the customer state.
+    """
+    content = json.dumps(customer.model_dump(), sort_keys=True)
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _remember(localid: int, externalid: str, customer_fingerprint: str) -> None:
+    """
+    Store a sync state in the in-memory mirror.
+
+    Parameters:
+    - localid (int): Local ID.
+    - externalid (str): External ID.
+    - customer_fingerprint (str): Fingerprint of the last synced state.
+
+    Returns:
+    None
+    """
+    with _lock:
+        _by_localid[localid] = (externalid, customer_fingerprint, time.monotonic())
+        _by_externalid[externalid] = localid
+
+
+def _evict(localid: int) -> None:
+    """
+    Drop a sync state from the in-memory mirror.
+
+    Parameters:
+    - localid (int): Local ID.
+
+    Returns:
+    None
+    """
+    with _lock:
+        entry = _by_localid.pop(localid, None)
+        if entry is not None:
+            _by_externalid.pop(entry[0], None)
+
+
+def get_fingerprint(db: Session, localid: int = None, externalid: str = None) -> Union[str, None]:
+    """
+    Get the fingerprint of the last synced state of a customer, by local or external ID.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - localid (int, optional): Local ID.
+    - externalid (str, optional): External ID, used when no local ID is given.
+
+    Returns:
+    str: Fingerprint of the last synced state, None if the customer was never synced.
+    """
+    with _lock:
+        if localid is None:
+            localid = _by_externalid.get(externalid)
+        entry = _by_localid.get(localid) if localid is not None else None
+    if entry is not None and time.monotonic() - entry[2] < CACHE_TTL:
+        return entry[1]
+
+    query = db.query(models.SyncState)
+    if localid is not None:
+        state = query.filter(models.SyncState.localid == localid).first()
+    else:
+        state = query.filter(models.SyncState.externalid == externalid).first()
+
+    if state is None:
+        if localid is not None:
+            _evict(localid)
+        return None
+    _remember(state.localid, state.externalid, state.fingerprint)
+    return state.fingerprint
+
+
+def get_fingerprints(db: Session, localids: List[int]) -> Dict[int, str]:
+    """
+    Get the fingerprints of the last synced states of several customers with a single query.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - localids (List[int]): Local IDs.
+
+    Returns:
+    Dict[int, str]: Fingerprints keyed by local ID, for the customers that were synced.
+    """
+    if not localids:
+        return {}
+    states = db.query(models.SyncState).filter(
+        models.SyncState.localid.in_(set(localids))).all()
+    for state in states:
+        _remember(state.localid, state.externalid, state.fingerprint)
+    return {state.localid: state.fingerprint for state in states}
+
+
+def is_synced(db: Session, customer: schemas.Customer, localid: int = None, externalid: str = None) -> bool:
+    """
+    Check if a customer state is the one last synced, making its sync a no-op.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - customer (schemas.Customer): Customer data to be synced.
+    - localid (int, optional): Local ID.
+    - externalid (str, optional): External ID, used when no local ID is given.
+
+    Returns:
+    bool: True if the customer state was already synced, False otherwise.
+    """
+    return get_fingerprint(db, localid, externalid) == fingerprint(customer)
+
+
+def upsert_statement(db: Session):
+    """
+    Build the statement recording sync states, replacing the existing ones.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+
+    Returns:
+    Insert: Statement to execute with the sync state rows as parameters.
+    """
+    return database.upsert(db, models.SyncState, ["localid"], ["externalid", "fingerprint"])
+
+
+def save(db: Session, localid: int, externalid: str, customer: schemas.Customer) -> None:
+    """
+    Record the state a customer was synced to and commit it.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - localid (int): Local ID.
+    - externalid (str): External ID.
+    - customer (schemas.Customer): Synced customer data.
+
+    Returns:
+    None
+    """
+    customer_fingerprint = fingerprint(customer)
+    db.execute(upsert_statement(db), {"localid": localid, "externalid": externalid,
+                                      "fingerprint": customer_fingerprint})
+    db.commit()
+    _remember(localid, externalid, customer_fingerprint)
+
+
+def save_many(db: Session, states: List[Tuple[int, str, schemas.Customer]]) -> None:
+    """
+    Record the states several customers were synced to, within the caller's transaction.
+
+    The mirror entries are dropped rather than updated, as the transaction
+    may still be rolled back.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - states (List[Tuple[int, str, schemas.Customer]]): Local ID, external ID and synced customer data.
+
+    Returns:
+    None
+    """
+    if not states:
+        return
+    rows = {localid: {"localid": localid, "externalid": externalid, "fingerprint": fingerprint(customer)}
+            for localid, externalid, customer in states}
+    db.execute(upsert_statement(db), list(rows.values()))
+    for localid in rows:
+        _evict(localid)
+
+
+def forget(db: Session, localids: List[int], commit: bool = True) -> None:
+    """
+    Drop the sync states of deleted customers.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - localids (List[int]): Local IDs.
+    - commit (bool, optional): Flag to indicate whether to commit. Defaults to True.
+
+    Returns:
+    None
+    """
+    if not localids:
+        return
+    db.execute(delete(models.SyncState).where(
+        models.SyncState.localid.in_(localids)))
+    if commit:
+        db.commit()
+    for localid in localids:
+        _evict(localid)
@@ -0,0 +1,106 @@
+import asyncio
+import importlib
+import os
+import threading
+import time
+
+from contextlib import asynccontextmanager
+from typing import List
+
+from dotenv import load_dotenv, find_dotenv
+from fastapi import FastAPI
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .kafka import consumer, relay, topics, transport
+from .stripeapp import ingest
+
+load_dotenv(find_dotenv())
+
+# the webhook keeps Stripe changes flowing, the poller is only needed without it
+POLLER = os.getenv("INPROCESS_POLLER", "false").lower() == "true"
+# seconds the consumer gets on shutdown to handle the messages still on the bus
+SHUTDOWN_TIMEOUT = float(os.getenv("INPROCESS_SHUTDOWN_TIMEOUT", 30))
+
+
+def _wake_relay(session: Session) -> None:
+    relay.notify()
+
+
+def start_workers() -> List[threading.Thread]:
+    """
+    Start the outbox relay, the consumer and optionally the poller in background threads.
+
+    Returns:
+    List[threading.Thread]: Started threads, relay first.
+    """
+    # hand committed outbox events over at once instead of on the next relay poll
+    event.listen(Session, "after_commit", _wake_relay)
+    threads = [
+        threading.Thread(target=relay.run, name="outbox-relay", daemon=True),
+        threading.Thread(target=consumer.run, name="consumer", daemon=True),
+    ]
+    if POLLER:
+        poller = importlib.import_module("app.schedule-poll")
+        threads.append(threading.Thread(
+            target=poller.run, name="poller", daemon=True))
+    for thread in threads:
+        thread.start()
+    print(f"Started {', '.join(thread.name for thread in threads)} in process")
+    return threads
+
+
+def stop_workers(threads: List[threading.Thread]) -> None:
+    """
+    Stop the producing threads, then let the consumer handle what is left on the bus before stopping it.
+
+    The bus lives in memory, the messages it still holds when the process exits are lost.
+
+    Parameters:
+    - threads (List[threading.Thread]): Threads returned by start_workers().
+
+    Returns:
+    None
+    """
+    relay.stop()
+    if POLLER:
+        importlib.import_module("app.schedule-poll").stop()
+    for thread in threads:
+        if thread.name != "consumer":
+            thread.join()
+
+    # messages waiting in the retry and dead-letter topics are not waited for
+    local = transport.get_transport()
+    sync_topics = [topics.LOCAL_TO_STRIPE, topics.STRIPE_TO_LOCAL]
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while local.backlog(sync_topics) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if local.backlog(sync_topics):
+        print(f"Dropped {local.backlog(sync_topics)} unhandled messages on shutdown")
+
+    consumer.stop()
+    for thread in threads:
+        thread.join()
+    event.remove(Session, "after_commit", _wake_relay)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Run the webhook drain for the lifetime of the application, along with the
+    relay, consumer and poller when they share the process through the in-process transport.
+
+    Parameters:
+    - app (FastAPI): FastAPI application.
+    """
+    if not transport.is_in_process():
+        async with ingest.lifespan(app):
+            yield
+        return
+
+    threads = start_workers()
+    try:
+        async with ingest.lifespan(app):
+            yield
+    finally:
+        await asyncio.to_thread(stop_workers, threads)
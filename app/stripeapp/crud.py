@@ -1,35 +1,49 @@
 import os
-from typing import Dict, Union, List
+from typing import Dict, Iterator, Union
 
 from dotenv import load_dotenv, find_dotenv
 import stripe
 
 from ..sql import schemas
+from .gateway import StripeGateway, StripeResult
 
 
 load_dotenv(find_dotenv())
 
 stripe.api_key = os.getenv("STRIPE_API_KEY")
 
+# one gateway per process, so every consumer worker shares its connections and rate limit
+RATE_LIMIT = float(os.getenv("STRIPE_RATE_LIMIT", 25))
+gateway = StripeGateway(
+    stripe.api_key,
+    rate=RATE_LIMIT,
+    burst=int(os.getenv("STRIPE_RATE_BURST", RATE_LIMIT)),
+    max_retries=int(os.getenv("STRIPE_MAX_RETRIES", 5)),
+    base_delay=float(os.getenv("STRIPE_RETRY_BASE_DELAY", 0.5)),
+    max_delay=float(os.getenv("STRIPE_RETRY_MAX_DELAY", 30)),
+    timeout=float(os.getenv("STRIPE_TIMEOUT", 30)),
+    api_base=os.getenv("STRIPE_API_BASE"))
 
-def create_customer(customer: schemas.Customer) -> Union[Dict, stripe.Customer]:
+CUSTOMER_EVENT_TYPES = ["customer.created",
+                        "customer.updated", "customer.deleted"]
+
+
+def create_customer(customer: schemas.Customer, metadata: Dict[str, str] = None, idempotency_key: str = None) -> StripeResult:
     """
     Create a new customer on the Stripe platform.
 
     Parameters:
     - customer (schemas.Customer): Customer data for creation.
+    - metadata (Dict[str, str], optional): Metadata to attach to the customer.
+    - idempotency_key (str, optional): Idempotency key of the request.
 
     Returns:
-    dict or stripe.Customer: Created customer data or error details.
+    StripeResult: Created customer or failure.
     """
+    return gateway.create_customer(customer, metadata, idempotency_key)
 
-    try:
-        return stripe.Customer.create(name=customer.name, email=customer.email)
-    except Exception as e:
-        return {'error': "Unable to create Customer", 'details': e}
 
-
-def get_customer(customer_id: str) -> Union[Dict, stripe.Customer]:
+def get_customer(customer_id: str) -> StripeResult:
     """
     Retrieve customer data from the Stripe platform.
 
@@ -37,55 +51,131 @@ def get_customer(customer_id: str) -> Union[Dict, stripe.Customer]:
     - customer_id (str): ID of the customer to retrieve.
 
     Returns:
-    dict or stripe.Customer: Retrieved customer data or error details.
+    StripeResult: Retrieved customer or failure.
+    """
+    return gateway.get_customer(customer_id)
+
+
+def iter_customers(page_size: int = 100) -> Iterator[stripe.Customer]:
+    """
+    Stream every customer from the Stripe platform, one page at a time.
+
+    Pages are fetched lazily using the 'starting_after' cursor, so only a
+    single page is held in memory. Errors are raised to the caller, since a
+    partially read stream must not be mistaken for the full customer list.
+
+    Parameters:
+    - page_size (int, optional): Number of customers per page, at most 100. Defaults to 100.
+
+    Returns:
+    Iterator[stripe.Customer]: Every Stripe customer.
+    """
+    starting_after = None
+    while True:
+        params = {"limit": page_size}
+        if starting_after is not None:
+            params["starting_after"] = starting_after
+        page = gateway.list_customers(params)
+
+        yield from page.data
+
+        if not page.has_more or not page.data:
+            return
+        starting_after = page.data[-1].id
+
+
+def get_latest_event() -> Union[stripe.Event, None]:
+    """
+    Retrieve the most recent customer event from the Stripe platform.
+
+    Returns:
+    stripe.Event: Latest customer event, None if there is none.
     """
-    try:
-        return stripe.Customer.retrieve(id=customer_id)
-    except Exception as e:
-        return {'error': "Unable to get Customer", 'details': e}
+    page = gateway.list_events({"limit": 1, "types": CUSTOMER_EVENT_TYPES})
+    return page.data[0] if page.data else None
 
 
-def get_customer_list() -> Union[Dict, List[stripe.Customer]]:
+def iter_events_after(event_id: str, page_size: int = 100) -> Iterator[stripe.Event]:
     """
-    Retrieve a list of customers from the Stripe platform.
+    Stream the customer events that happened after a given event, oldest first.
+
+    Stripe lists events newest first, so pages are walked towards newer
+    events with the 'ending_before' cursor and each page is reversed. Errors
+    are raised to the caller.
+
+    Parameters:
+    - event_id (str): ID of the last event already handled.
+    - page_size (int, optional): Number of events per page, at most 100. Defaults to 100.
 
     Returns:
-    dict or List[stripe.Customer]: List of customer data or error details.
+    Iterator[stripe.Event]: Customer events newer than the given one.
+    """
+    ending_before = event_id
+    while True:
+        page = gateway.list_events(
+            {"limit": page_size, "ending_before": ending_before, "types": CUSTOMER_EVENT_TYPES})
+
+        yield from reversed(page.data)
+
+        if not page.has_more or not page.data:
+            return
+        ending_before = page.data[0].id
+
+
+def iter_events_since(created: int, page_size: int = 100) -> Iterator[stripe.Event]:
     """
-    try:
-        return stripe.Customer.list()
-    except Exception as e:
-        return {'error': "Unable to get Customer", 'details': e}
+    Stream the customer events created at or after a given time, oldest first.
 
+    Used when there is no usable event to resume after. The events are
+    collected walking towards older ones with the 'starting_after' cursor,
+    then returned oldest first. Errors are raised to the caller.
 
-def update_customer(customer_id: str, customer: schemas.Customer) -> Union[Dict, stripe.Customer]:
+    Parameters:
+    - created (int): Epoch time of the oldest events to return.
+    - page_size (int, optional): Number of events per page, at most 100. Defaults to 100.
+
+    Returns:
+    Iterator[stripe.Event]: Customer events created since the given time.
+    """
+    events = []
+    starting_after = None
+    while True:
+        params = {"limit": page_size, "created": {"gte": created}, "types": CUSTOMER_EVENT_TYPES}
+        if starting_after is not None:
+            params["starting_after"] = starting_after
+        page = gateway.list_events(params)
+        events.extend(page.data)
+
+        if not page.has_more or not page.data:
+            break
+        starting_after = page.data[-1].id
+    yield from reversed(events)
+
+
+def update_customer(customer_id: str, customer: schemas.Customer, idempotency_key: str = None) -> StripeResult:
     """
     Update an existing customer on the Stripe platform.
 
     Parameters:
     - customer_id (str): ID of the customer to update.
     - customer (schemas.Customer): Updated customer data.
+    - idempotency_key (str, optional): Idempotency key of the request.
 
     Returns:
-    dict or stripe.Customer: Updated customer data or error details.
+    StripeResult: Updated customer or failure.
     """
-    try:
-        return stripe.Customer.modify(id=customer_id, name=customer.name, email=customer.email)
-    except Exception as e:
-        return {'error': "Unable to update Customer", 'details': e}
+    return gateway.update_customer(customer_id, customer, idempotency_key)
 
 
-def delete_customer(customer_id: str) -> Union[Dict, stripe.Customer]:
+def delete_customer(customer_id: str, idempotency_key: str = None) -> StripeResult:
     """
     Delete a customer from the Stripe platform.
 
     Parameters:
     - customer_id (str): ID of the customer to delete.
+    - idempotency_key (str, optional): Idempotency key of the request.
 
     Returns:
-    dict or stripe.Deleted: Deletion confirmation or error details.
+    StripeResult: Deleted customer or failure.
     """
-    try:
-        return stripe.Customer.delete(customer_id)
-    except Exception as e:
-        return {'error': "Unable to delete Customer", 'details': e}
+    return gateway.delete_customer(customer_id, idempotency_key)
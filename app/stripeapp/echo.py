@@ -0,0 +1,51 @@
+from typing import Dict
+
+import stripe
+from sqlalchemy.orm import Session
+
+from ..kafka import topics
+from ..sql import outstanding, schemas, syncstate
+
+# metadata key tagging the Stripe customers created by KafSync with their local ID
+ORIGIN_LOCALID = "kafsync_localid"
+
+
+def origin_metadata(localid: int) -> Dict[str, str]:
+    """
+    Build the metadata tagging a Stripe customer as created by KafSync.
+
+    Parameters:
+    - localid (int): Local ID of the created customer.
+
+    Returns:
+    Dict[str, str]: Stripe customer metadata.
+    """
+    return {ORIGIN_LOCALID: str(localid)}
+
+
+def is_echo(db: Session, operation: str, customer: stripe.Customer) -> bool:
+    """
+    Check if a change seen on Stripe was caused by KafSync itself.
+
+    Creates are recognised by their origin tag, which a customer carries
+    from its creation on. Updates and deletes are recognised by the
+    outstanding write registered before they were made.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - customer (stripe.Customer): Changed Stripe customer object.
+
+    Returns:
+    bool: True if the change is our own echo, False otherwise.
+    """
+    if operation == topics.CREATE:
+        metadata = getattr(customer, "metadata", None) or {}
+        return ORIGIN_LOCALID in metadata
+
+    if operation == topics.DELETE:
+        return outstanding.claim(db, customer.id, topics.DELETE)
+
+    customer_fingerprint = syncstate.fingerprint(
+        schemas.Customer(name=customer.name, email=customer.email))
+    return outstanding.claim(db, customer.id, topics.UPDATE, customer_fingerprint)
@@ -0,0 +1,343 @@
+import random
+import threading
+import time
+import uuid
+
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Union
+
+import stripe
+
+from .. import metrics, tracing
+from ..sql import schemas
+
+
+@dataclass
+class StripeFailure:
+    """
+    Typed description of a failed Stripe call.
+    """
+
+    kind: str
+    message: str
+    status: Union[int, None] = None
+    code: Union[str, None] = None
+    retryable: bool = False
+
+    @classmethod
+    def from_error(cls, error: stripe.StripeError) -> "StripeFailure":
+        """
+        Classify a Stripe error.
+
+        Parameters:
+        - error (stripe.StripeError): Error raised by the Stripe client.
+
+        Returns:
+        StripeFailure: Failure details.
+        """
+        if isinstance(error, stripe.RateLimitError):
+            kind = "rate_limited"
+        elif isinstance(error, stripe.APIConnectionError):
+            kind = "connection"
+        elif isinstance(error, stripe.InvalidRequestError):
+            kind = "not_found" if error.http_status == 404 else "invalid_request"
+        elif isinstance(error, (stripe.AuthenticationError, stripe.PermissionError)):
+            kind = "unauthorized"
+        else:
+            kind = "api"
+        return cls(kind=kind, message=error.user_message or str(error), status=error.http_status,
+                   code=error.code, retryable=is_retryable(error))
+
+
+@dataclass
+class StripeResult:
+    """
+    Outcome of a Stripe call, holding either the returned object or the failure.
+    """
+
+    value: Any = None
+    error: Union[StripeFailure, None] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def is_retryable(error: stripe.StripeError) -> bool:
+    """
+    Check if a failed Stripe call may succeed when retried with the same idempotency key.
+
+    Parameters:
+    - error (stripe.StripeError): Error raised by the Stripe client.
+
+    Returns:
+    bool: True if the call should be retried, False otherwise.
+    """
+    should_retry = get_header(error, "stripe-should-retry")
+    if should_retry is not None:
+        return should_retry == "true"
+    if isinstance(error, (stripe.RateLimitError, stripe.APIConnectionError)):
+        return True
+    # 409 is returned on concurrent requests for the same object or idempotency key
+    return error.http_status is not None and (error.http_status == 409 or error.http_status >= 500)
+
+
+def get_header(error: stripe.StripeError, name: str) -> Union[str, None]:
+    """
+    Read a response header of a Stripe error, ignoring its case.
+
+    Parameters:
+    - error (stripe.StripeError): Error raised by the Stripe client.
+    - name (str): Lower case header name.
+
+    Returns:
+    str: Header value, None if absent.
+    """
+    for key, value in (error.headers or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def method_name(method: Callable) -> str:
+    """
+    Name a Stripe client method for the metrics, such as 'customers.create'.
+
+    Parameters:
+    - method (Callable): Bound method of the Stripe client.
+
+    Returns:
+    str: Resource and method name.
+    """
+    resource = type(method.__self__).__name__.removesuffix("Service").lower()
+    return f"{resource}.{method.__name__}"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of Stripe requests. Callers
+    reserve a token and wait until it becomes available, so concurrent
+    workers are served in order instead of retrying into 429s.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token, possibly borrowing it from the future.
+
+        Returns:
+        float: Seconds to wait before the token may be used.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self._rate)
+
+    def acquire(self) -> None:
+        """
+        Block until a token is available.
+
+        Returns:
+        None
+        """
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+
+class StripeGateway:
+    """
+    Stripe client sharing one pooled HTTP client, one rate limiter and one
+    retry policy between every caller of a process.
+    """
+
+    def __init__(self, api_key: str, rate: float, burst: int, max_retries: int,
+                 base_delay: float, max_delay: float, timeout: float, api_base: str = None) -> None:
+        self._client = stripe.StripeClient(
+            api_key or "",
+            # another base, such as stripe-mock, can stand in for the Stripe API
+            base_addresses={"api": api_base} if api_base else None,
+            http_client=stripe.HTTPXClient(
+                timeout=timeout, allow_sync_methods=True),
+            # retries are handled here, so they are rate limited as well
+            max_network_retries=0)
+        # a rate of 0 or less disables the limiter
+        self._limiter = TokenBucket(rate, burst) if rate > 0 else None
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def _backoff(self, attempt: int, error: stripe.StripeError) -> float:
+        """
+        Compute the delay before retrying a call, with full jitter.
+
+        Parameters:
+        - attempt (int): Number of the failed attempt, starting at 0.
+        - error (stripe.StripeError): Error of the failed attempt.
+
+        Returns:
+        float: Seconds to wait.
+        """
+        retry_after = get_header(error, "retry-after")
+        if retry_after is not None:
+            try:
+                return min(self._max_delay, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+
+    def call(self, method: Callable, *args, **kwargs) -> Any:
+        """
+        Call a Stripe client method under the rate limit, retrying retryable errors.
+
+        Parameters:
+        - method (Callable): Bound method of the Stripe client.
+
+        Returns:
+        Any: Result of the method. Errors are raised once the retries are exhausted.
+        """
+        name = method_name(method)
+        for attempt in range(self._max_retries + 1):
+            if self._limiter is not None:
+                self._limiter.acquire()
+            start = time.time()
+            try:
+                with metrics.STRIPE_LATENCY.labels(name).time():
+                    return method(*args, **kwargs)
+            except stripe.StripeError as e:
+                metrics.STRIPE_ERRORS.labels(
+                    name, StripeFailure.from_error(e).kind).inc()
+                if attempt == self._max_retries or not is_retryable(e):
+                    raise
+                metrics.STRIPE_RETRIES.labels(name).inc()
+                time.sleep(self._backoff(attempt, e))
+            finally:
+                tracing.record(f"stripe {name}", start, time.time())
+
+    def _write(self, method: Callable, *args, params: Dict, idempotency_key: str = None) -> StripeResult:
+        """
+        Call a Stripe write method with an idempotency key kept across retries.
+
+        Parameters:
+        - method (Callable): Bound method of the Stripe client.
+        - params (Dict): Request parameters.
+        - idempotency_key (str, optional): Idempotency key, a random one is used if None.
+
+        Returns:
+        StripeResult: Returned object or failure.
+        """
+        options = {"idempotency_key": idempotency_key or str(uuid.uuid4())}
+        try:
+            return StripeResult(value=self.call(method, *args, params=params, options=options))
+        except stripe.StripeError as e:
+            return StripeResult(error=StripeFailure.from_error(e))
+
+    def create_customer(self, customer: schemas.Customer, metadata: Dict[str, str] = None, idempotency_key: str = None) -> StripeResult:
+        """
+        Create a new customer on the Stripe platform.
+
+        Parameters:
+        - customer (schemas.Customer): Customer data for creation.
+        - metadata (Dict[str, str], optional): Metadata to attach to the customer.
+        - idempotency_key (str, optional): Idempotency key of the request.
+
+        Returns:
+        StripeResult: Created customer or failure.
+        """
+        return self._write(self._client.v1.customers.create,
+                           params=customer_params(customer, metadata), idempotency_key=idempotency_key)
+
+    def update_customer(self, customer_id: str, customer: schemas.Customer, idempotency_key: str = None) -> StripeResult:
+        """
+        Update an existing customer on the Stripe platform.
+
+        Parameters:
+        - customer_id (str): ID of the customer to update.
+        - customer (schemas.Customer): Updated customer data.
+        - idempotency_key (str, optional): Idempotency key of the request.
+
+        Returns:
+        StripeResult: Updated customer or failure.
+        """
+        return self._write(self._client.v1.customers.update, customer_id,
+                           params=customer_params(customer), idempotency_key=idempotency_key)
+
+    def delete_customer(self, customer_id: str, idempotency_key: str = None) -> StripeResult:
+        """
+        Delete a customer from the Stripe platform.
+
+        Parameters:
+        - customer_id (str): ID of the customer to delete.
+        - idempotency_key (str, optional): Idempotency key of the request.
+
+        Returns:
+        StripeResult: Deleted customer or failure.
+        """
+        return self._write(self._client.v1.customers.delete, customer_id,
+                           params={}, idempotency_key=idempotency_key)
+
+    def get_customer(self, customer_id: str) -> StripeResult:
+        """
+        Retrieve customer data from the Stripe platform.
+
+        Parameters:
+        - customer_id (str): ID of the customer to retrieve.
+
+        Returns:
+        StripeResult: Retrieved customer or failure.
+        """
+        try:
+            return StripeResult(value=self.call(self._client.v1.customers.retrieve, customer_id))
+        except stripe.StripeError as e:
+            return StripeResult(error=StripeFailure.from_error(e))
+
+    def list_customers(self, params: Dict) -> stripe.ListObject:
+        """
+        Retrieve a page of customers, raising errors.
+
+        Parameters:
+        - params (Dict): List parameters such as 'limit' and 'starting_after'.
+
+        Returns:
+        stripe.ListObject: Page of customers.
+        """
+        return self.call(self._client.v1.customers.list, params=params)
+
+    def list_events(self, params: Dict) -> stripe.ListObject:
+        """
+        Retrieve a page of events, raising errors.
+
+        Parameters:
+        - params (Dict): List parameters such as 'limit', 'ending_before' and 'types'.
+
+        Returns:
+        stripe.ListObject: Page of events.
+        """
+        return self.call(self._client.v1.events.list, params=params)
+
+
+def customer_params(customer: schemas.Customer, metadata: Dict[str, str] = None) -> Dict:
+    """
+    Build the Stripe request parameters of a customer.
+
+    Parameters:
+    - customer (schemas.Customer): Customer data.
+    - metadata (Dict[str, str], optional): Metadata to attach to the customer.
+
+    Returns:
+    Dict: Request parameters.
+    """
+    params = {"name": customer.name, "email": customer.email}
+    if metadata:
+        params["metadata"] = metadata
+    return params
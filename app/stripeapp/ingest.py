@@ -0,0 +1,243 @@
+import asyncio
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import wait
+from contextlib import asynccontextmanager
+from typing import List, Tuple
+
+import stripe
+from dotenv import load_dotenv, find_dotenv
+from fastapi import FastAPI
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from .. import metrics
+from ..kafka import producer
+from ..sql import database, models
+from . import webhook
+
+
+load_dotenv(find_dotenv())
+
+QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 10000))
+BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", 500))
+DEDUP_CACHE_SIZE = int(os.getenv("WEBHOOK_DEDUP_CACHE_SIZE", 100000))
+# Stripe retries a webhook delivery for up to three days
+DEDUP_RETENTION = float(os.getenv("WEBHOOK_DEDUP_RETENTION", 3 * 24 * 60 * 60))
+# Stripe got its response already, events failing to be produced are retried here with a growing delay
+RETRIES = int(os.getenv("WEBHOOK_RETRIES", 5))
+RETRY_BASE_DELAY = float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", 1.0))
+RETRY_MAX_DELAY = float(os.getenv("WEBHOOK_RETRY_MAX_DELAY", 30.0))
+
+Received = Tuple[stripe.Event, str, float]
+
+
+class SeenEvents:
+    """
+    Bounded LRU set of recently received Stripe event IDs.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._ids: OrderedDict = OrderedDict()
+
+    def add(self, event_id: str) -> bool:
+        """
+        Remember an event ID, evicting the least recently seen ones beyond the size limit.
+
+        Parameters:
+        - event_id (str): Stripe event ID.
+
+        Returns:
+        bool: True if the ID is new, False if it was already seen.
+        """
+        with self._lock:
+            if event_id in self._ids:
+                self._ids.move_to_end(event_id)
+                return False
+            self._ids[event_id] = None
+            while len(self._ids) > self._maxsize:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, event_id: str) -> None:
+        """
+        Forget an event ID so a later delivery of it is accepted again.
+
+        Parameters:
+        - event_id (str): Stripe event ID.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._ids.pop(event_id, None)
+
+
+seen = SeenEvents(DEDUP_CACHE_SIZE)
+queue: asyncio.Queue = None
+metrics.WEBHOOK_QUEUE_DEPTH.set_function(
+    lambda: queue.qsize() if queue is not None else 0)
+
+
+def enqueue(event: stripe.Event, operation: str) -> bool:
+    """
+    Queue a validated Stripe event for the background drain, dropping IDs seen recently.
+
+    Parameters:
+    - event (stripe.Event): Stripe event.
+    - operation (str): One of 'create', 'update' or 'delete'.
+
+    Returns:
+    bool: False if the event must be retried by Stripe, as the queue is full or it failed to be produced inline, True otherwise.
+    """
+    if not seen.add(event.id):
+        metrics.WEBHOOK_DUPLICATES.inc()
+        return True
+    if queue is None:
+        # no drain running, handle the event inline
+        return not ingest_batch([(event, operation, time.time())])
+    try:
+        queue.put_nowait((event, operation, time.time()))
+        return True
+    except asyncio.QueueFull:
+        seen.discard(event.id)
+        return False
+
+
+def claim_new_events(db: Session, events: List[Received]) -> List[Received]:
+    """
+    Record the IDs of a batch of events in the processed events table, dropping the ones already there.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - events (List[Received]): Received events, with their operation and receive time.
+
+    Returns:
+    List[Received]: Events that were not processed before.
+    """
+    ids = {event.id for event, _, _ in events}
+    processed = set(db.scalars(select(models.ProcessedEvent.id).where(
+        models.ProcessedEvent.id.in_(ids))))
+    new_events = [received for received in events
+                  if received[0].id not in processed]
+    metrics.WEBHOOK_DUPLICATES.inc(len(events) - len(new_events))
+    if new_events:
+        db.execute(insert(models.ProcessedEvent), [
+            {"id": event.id, "received_at": received_at} for event, _, received_at in new_events])
+    db.execute(delete(models.ProcessedEvent).where(
+        models.ProcessedEvent.received_at < time.time() - DEDUP_RETENTION))
+    db.commit()
+    return new_events
+
+
+def release_events(db: Session, events: List[Received]) -> None:
+    """
+    Forget the IDs of claimed events that failed to be produced, so they can be ingested again.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session.
+    - events (List[Received]): Claimed events.
+
+    Returns:
+    None
+    """
+    db.rollback()
+    db.execute(delete(models.ProcessedEvent).where(
+        models.ProcessedEvent.id.in_([event.id for event, _, _ in events])))
+    db.commit()
+    for event, _, _ in events:
+        seen.discard(event.id)
+
+
+def ingest_batch(events: List[Received]) -> List[Received]:
+    """
+    Produce the Kafka messages of a batch of received events and wait for their delivery.
+
+    Each event is handled on its own: the ones that fail to be produced or
+    delivered are released, the others stay recorded as processed.
+
+    Parameters:
+    - events (List[Received]): Received events, with their operation and receive time.
+
+    Returns:
+    List[Received]: Events that failed, to be ingested again.
+    """
+    failed, futures = [], []
+    with database.SessionLocal() as db:
+        for received in claim_new_events(db, events):
+            event, operation, received_at = received
+            try:
+                future = webhook.publish_event(
+                    db, operation, event.data.object, received_at)
+            except Exception as e:
+                print(f"Failed to produce webhook event {event.id}: {e}")
+                db.rollback()
+                failed.append(received)
+                continue
+            if future is not None:
+                futures.append((future, received))
+
+        wait([future for future, _ in futures])
+        for future, received in futures:
+            if future.exception() is not None:
+                print(f"Failed to produce webhook event {received[0].id}: {future.exception()}")
+                failed.append(received)
+        if failed:
+            release_events(db, failed)
+    return failed
+
+
+async def drain() -> None:
+    """
+    Drain the queued webhook events to Kafka in batches until cancelled.
+
+    Returns:
+    None
+    """
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        events = batch
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            try:
+                events = await asyncio.to_thread(ingest_batch, events)
+            except Exception as e:
+                # the database failed before the events were recorded, the whole batch is tried again
+                print(f"Failed to ingest {len(events)} webhook events: {e}")
+            if not events:
+                break
+        else:
+            # released, the Stripe events poller can still pick them up
+            print(f"Dropped {len(events)} webhook events after {RETRIES + 1} attempts: "
+                  f"{', '.join(event.id for event, _, _ in events)}")
+        for _ in batch:
+            queue.task_done()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Run the webhook drain for the lifetime of the application, handling the queued events on shutdown.
+
+    Parameters:
+    - app (FastAPI): FastAPI application.
+    """
+    global queue
+    queue = asyncio.Queue(QUEUE_SIZE)
+    task = asyncio.create_task(drain())
+    try:
+        yield
+    finally:
+        await queue.join()
+        task.cancel()
+        queue = None
+        producer.flush()
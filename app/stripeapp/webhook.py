@@ -1,62 +1,136 @@
 import json
 import os
 
+from concurrent.futures import Future
+from typing import Tuple, Union
+
 import stripe
 from dotenv import load_dotenv, find_dotenv
+from sqlalchemy.orm import Session
 
-from ..kafka import producer
-from ..sql import schemas
+from ..kafka import producer, topics
+from ..sql import database
+from . import echo
 
 
 load_dotenv(find_dotenv())
 
 stripe.api_key = os.getenv("STRIPE_API_KEY")
+WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+
+EVENT_OPERATIONS = {
+    'customer.created': topics.CREATE,
+    'customer.updated': topics.UPDATE,
+    'customer.deleted': topics.DELETE,
+}
 
 
-def handle_event(payload: bytes) -> None:
+def is_redundant(db: Session, operation: str, customer: stripe.Customer) -> bool:
     """
-    Handle a Stripe event and produce Kafka messages for customer-related events.
+    Check if a Stripe customer change needs no local sync because KafSync caused it.
+
+    Changes back to the last synced state are still produced, as a change
+    away from it may be in flight. The consumer skips the ones already synced.
 
     Parameters:
-    - payload (dict): Stripe event payload.
+    - db (Session): SQLAlchemy database session.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - customer (stripe.Customer): Changed Stripe customer object.
 
     Returns:
-    None
+    bool: True if the change can be dropped, False otherwise.
+    """
+    return echo.is_echo(db, operation, customer)
+
+
+def parse_event(payload: dict) -> Tuple[stripe.Event, str]:
     """
-    event = None
+    Parse a Stripe event payload and find the sync operation it maps to.
 
+    Parameters:
+    - payload (dict): Stripe event payload.
+
+    Returns:
+    Tuple[stripe.Event, str]: Stripe event and one of 'create', 'update' or 'delete'.
+    """
     try:
         event = stripe.Event.construct_from(payload, stripe.api_key)
     except ValueError as e:
         raise Exception("Invalid Payload")
 
-    # Handle the event
-    if event.type == 'customer.created':
-        customer = event.data.object
+    operation = EVENT_OPERATIONS.get(event.type)
+    if operation is None:
+        raise Exception('Unhandled event type {}'.format(event.type))
+    return event, operation
 
-        data = {
-            "stripe_customer_id": customer.id,
-            "customer": {"name": customer.name, "email": customer.email}
-        }
-        producer.produce_message(
-            json.dumps(data), topic="stripetolocal", partition=0)
 
-    elif event.type == 'customer.updated':
-        customer = event.data.object
+def verify_event(payload: bytes, signature: Union[str, None]) -> Tuple[stripe.Event, str]:
+    """
+    Parse a raw webhook body, checking its Stripe signature when STRIPE_WEBHOOK_SECRET is set.
+
+    Parameters:
+    - payload (bytes): Raw webhook request body.
+    - signature (str): Value of the Stripe-Signature header.
+
+    Returns:
+    Tuple[stripe.Event, str]: Stripe event and one of 'create', 'update' or 'delete'.
+    """
+    if WEBHOOK_SECRET:
+        try:
+            stripe.Webhook.construct_event(payload, signature, WEBHOOK_SECRET)
+        except (ValueError, stripe.SignatureVerificationError):
+            raise Exception("Invalid Signature")
+    try:
+        return parse_event(json.loads(payload))
+    except ValueError:
+        raise Exception("Invalid Payload")
+
+
+def publish_event(db: Session, operation: str, customer: stripe.Customer, origin: float = None) -> Union[Future, None]:
+    """
+    Produce the Kafka message of a Stripe customer change unless it is redundant.
+
+    Parameters:
+    - db (Session): SQLAlchemy database session used to drop redundant changes.
+    - operation (str): One of 'create', 'update' or 'delete'.
+    - customer (stripe.Customer): Changed Stripe customer object.
+    - origin (float, optional): Epoch time the change was noticed, now if None.
+
+    Returns:
+    Future: Delivery future of the message, None if the change was dropped.
+    """
+    if is_redundant(db, operation, customer):
+        return None
 
+    if operation == topics.DELETE:
+        data = {
+            "stripe_customer_id": customer.id
+        }
+    else:
         data = {
             "stripe_customer_id": customer.id,
             "customer": {"name": customer.name, "email": customer.email}
         }
-        producer.produce_message(
-            json.dumps(data), topic="stripetolocal", partition=1)
-    elif event.type == 'customer.deleted':
-        customer = event.data.object
+    return producer.produce_event(
+        topics.STRIPE_TO_LOCAL, operation, customer.id, data, origin=origin)
 
-        data = {
-            "stripe_customer_id": customer.id
-        }
-        producer.produce_message(
-            json.dumps(data), topic="stripetolocal", partition=2)
+
+def handle_event(payload: dict, db: Session = None) -> None:
+    """
+    Handle a Stripe event and produce Kafka messages for customer-related events.
+
+    Parameters:
+    - payload (dict): Stripe event payload.
+    - db (Session, optional): SQLAlchemy database session used to drop redundant changes, a new one is used if None.
+
+    Returns:
+    None
+    """
+    event, operation = parse_event(payload)
+
+    customer = event.data.object
+    if db is None:
+        with database.SessionLocal() as session:
+            publish_event(session, operation, customer, event.created)
     else:
-        raise Exception('Unhandled event type {}'.format(event.type))
+        publish_event(db, operation, customer, event.created)
@@ -0,0 +1,321 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple, Union
+
+import httpx
+from confluent_kafka import Message, TopicPartition, TIMESTAMP_NOT_AVAILABLE
+from dotenv import load_dotenv, find_dotenv
+
+from . import metrics
+from .kafka import topics
+
+load_dotenv(find_dotenv())
+
+# share of traces exported as spans, every trace is still measured in the metrics
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+EXPORT_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL = 5.0
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "kafsync")
+
+# (name, start, end) of a span, times in seconds since the epoch
+Span = Tuple[str, float, float]
+
+
+@dataclass
+class Trace:
+    """
+    Timings of a consumed message along its trip from the change that caused it.
+    """
+
+    trace_id: str
+    topic: str
+    operation: str
+    origin: float
+    produced: float
+    consumed: float
+    await_commit: bool
+    handled: Union[float, None] = None
+    spans: List[Span] = field(default_factory=list)
+
+    @property
+    def sampled(self) -> bool:
+        # decided from the trace ID, so every process agrees on it
+        return int(self.trace_id[:8], 16) < SAMPLE_RATE * 0x100000000
+
+
+_pending: Dict[Tuple[str, int, int], Trace] = {}
+_pending_lock = threading.Lock()
+_active: contextvars.ContextVar = contextvars.ContextVar(
+    "active_traces", default=())
+_exports: queue.Queue = queue.Queue()
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def new_trace_id() -> str:
+    """
+    Generate a random W3C trace ID.
+
+    Returns:
+    str: 32 hexadecimal characters.
+    """
+    return f"{random.getrandbits(128):032x}"
+
+
+def headers(origin: float = None, trace_id: str = None) -> Dict[str, str]:
+    """
+    Build the tracing headers of a produced message.
+
+    Parameters:
+    - origin (float, optional): Epoch time of the change the message carries, now if None.
+    - trace_id (str, optional): Trace ID to continue, a new one if None.
+
+    Returns:
+    Dict[str, str]: Message headers.
+    """
+    return {topics.TRACE_HEADER: trace_id or new_trace_id(),
+            topics.ORIGIN_TS_HEADER: repr(origin if origin is not None else time.time())}
+
+
+def begin(msg: Message, await_commit: bool) -> None:
+    """
+    Start tracking a consumed message carrying tracing headers.
+
+    Parameters:
+    - msg (Message): Kafka message object.
+    - await_commit (bool): Flag to indicate whether the trace ends on the offset commit or once handled.
+
+    Returns:
+    None
+    """
+    trace_id = topics.get_header(msg, topics.TRACE_HEADER)
+    if trace_id is None:
+        return
+    consumed = time.time()
+    origin = float(topics.get_header(msg, topics.ORIGIN_TS_HEADER) or consumed)
+    timestamp_type, timestamp = msg.timestamp()
+    produced = timestamp / 1000 if timestamp_type != TIMESTAMP_NOT_AVAILABLE else consumed
+    trace = Trace(trace_id, msg.topic(), topics.get_operation(msg) or "unknown",
+                  origin, produced, consumed, await_commit)
+    with _pending_lock:
+        _pending[(msg.topic(), msg.partition(), msg.offset())] = trace
+
+
+@contextmanager
+def handling(*msgs: Message) -> Iterator[None]:
+    """
+    Time the handler stage of messages and collect the external calls made meanwhile.
+
+    Parameters:
+    - msgs (Message): Kafka message objects being handled.
+    """
+    keys = [(msg.topic(), msg.partition(), msg.offset()) for msg in msgs]
+    with _pending_lock:
+        traced = [(key, _pending[key]) for key in keys if key in _pending]
+    token = _active.set(tuple(trace for _, trace in traced))
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        _active.reset(token)
+        for key, trace in traced:
+            trace.spans.append(("handler", start, end))
+            trace.handled = end
+            if not trace.await_commit:
+                _finish(*key, end)
+
+
+def record(name: str, start: float, end: float) -> None:
+    """
+    Add an external call span to the messages being handled by the current thread or task.
+
+    Parameters:
+    - name (str): Span name, such as 'stripe customer.update'.
+    - start (float): Epoch time the call started.
+    - end (float): Epoch time the call ended.
+
+    Returns:
+    None
+    """
+    for trace in _active.get():
+        trace.spans.append((name, start, end))
+
+
+def committed(offsets: List[TopicPartition]) -> None:
+    """
+    End the traces of every message below the committed offsets.
+
+    Parameters:
+    - offsets (List[TopicPartition]): Committed offsets.
+
+    Returns:
+    None
+    """
+    now = time.time()
+    with _pending_lock:
+        done = [key for key in _pending
+                if any(key[0] == tp.topic and key[1] == tp.partition and key[2] < tp.offset for tp in offsets)]
+    for key in done:
+        _finish(*key, now)
+
+
+def _finish(topic: str, partition: int, offset: int, end: float) -> None:
+    """
+    Record the stage latencies of a trace and queue it for export when sampled.
+
+    Parameters:
+    - topic (str): Topic of the message.
+    - partition (int): Partition of the message.
+    - offset (int): Offset of the message.
+    - end (float): Epoch time the message was done with.
+
+    Returns:
+    None
+    """
+    with _pending_lock:
+        trace = _pending.pop((topic, partition, offset), None)
+    if trace is None:
+        return
+
+    stages = [("enqueue", trace.origin, trace.produced),
+              ("broker", trace.produced, trace.consumed)]
+    if trace.await_commit:
+        stages.append(("commit", trace.handled or trace.consumed, end))
+    trace.spans[:0] = stages
+    for name, start, stop in trace.spans:
+        if name in ("enqueue", "broker", "handler", "commit"):
+            stage = name
+        else:
+            stage = "external"
+        metrics.SYNC_STAGE_LATENCY.labels(
+            trace.topic, stage).observe(max(0.0, stop - start))
+    metrics.SYNC_LATENCY.labels(trace.topic, trace.operation).observe(
+        max(0.0, end - trace.origin))
+
+    if trace.sampled and (EXPORT_ENDPOINT or EXPORT_FILE):
+        _start_exporter()
+        _exports.put(to_otlp_spans(trace, end))
+
+
+def to_otlp_spans(trace: Trace, end: float) -> List[Dict]:
+    """
+    Convert a trace into OTLP/JSON spans: a root span for the whole sync with a child per stage.
+
+    Parameters:
+    - trace (Trace): Finished trace.
+    - end (float): Epoch time the message was done with.
+
+    Returns:
+    List[Dict]: OTLP/JSON span objects.
+    """
+    def span(span_id: str, parent_id: str, name: str, start: float, stop: float) -> Dict:
+        return {
+            "traceId": trace.trace_id,
+            "spanId": span_id,
+            "parentSpanId": parent_id,
+            "name": name,
+            "kind": 5 if parent_id == "" else 1,
+            "startTimeUnixNano": str(int(start * 1e9)),
+            "endTimeUnixNano": str(int(stop * 1e9)),
+            "attributes": [
+                {"key": "messaging.destination.name", "value": {"stringValue": trace.topic}},
+                {"key": "kafsync.operation", "value": {"stringValue": trace.operation}},
+            ],
+        }
+
+    root_id = f"{random.getrandbits(64):016x}"
+    return [span(root_id, "", f"sync {trace.topic}", trace.origin, end)] + [
+        span(f"{random.getrandbits(64):016x}", root_id, name, start, stop)
+        for name, start, stop in trace.spans]
+
+
+def _start_exporter() -> None:
+    """
+    Start the background thread exporting sampled spans, if not running yet.
+
+    Returns:
+    None
+    """
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = threading.Thread(
+                target=_export_loop, name="trace-exporter", daemon=True)
+            _exporter.start()
+
+
+def _export_loop() -> None:
+    """
+    Export sampled spans in batches, to the OTLP/HTTP endpoint or as OTLP/JSON lines to a file.
+
+    Returns:
+    None
+    """
+    while True:
+        spans = _exports.get()
+        deadline = time.monotonic() + EXPORT_INTERVAL
+        while len(spans) < EXPORT_BATCH_SIZE and time.monotonic() < deadline:
+            try:
+                spans.extend(_exports.get(timeout=deadline - time.monotonic()))
+            except queue.Empty:
+                break
+
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "kafsync"}, "spans": spans}],
+        }]}
+        try:
+            if EXPORT_ENDPOINT:
+                httpx.post(EXPORT_ENDPOINT, json=payload,
+                           timeout=10).raise_for_status()
+            else:
+                with open(EXPORT_FILE, "a") as f:
+                    f.write(json.dumps(payload) + "\n")
+        except (OSError, httpx.HTTPError) as e:
+            print(f"Failed to export {len(spans)} spans: {e}")
+
+
+def percentiles(path: str, quantiles: Tuple[float, ...] = (0.5, 0.9, 0.99)) -> Dict[str, Dict[float, float]]:
+    """
+    Compute span latency percentiles from an OTLP/JSON lines file.
+
+    Parameters:
+    - path (str): File written with TRACE_EXPORT_FILE.
+    - quantiles (Tuple[float, ...], optional): Quantiles to compute. Defaults to p50, p90 and p99.
+
+    Returns:
+    Dict[str, Dict[float, float]]: Latency in seconds per span name and quantile.
+    """
+    durations: Dict[str, List[float]] = {}
+    with open(path) as f:
+        for line in f:
+            for resource_spans in json.loads(line)["resourceSpans"]:
+                for scope_spans in resource_spans["scopeSpans"]:
+                    for span in scope_spans["spans"]:
+                        durations.setdefault(span["name"], []).append(
+                            (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9)
+
+    result = {}
+    for name, values in durations.items():
+        values.sort()
+        result[name] = {q: values[min(len(values) - 1, int(q * len(values)))]
+                        for q in quantiles}
+    return result
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else EXPORT_FILE
+    for name, values in sorted(percentiles(path).items()):
+        print(f"{name:<28}" + "  ".join(f"p{int(q * 100)} {value * 1000:9.1f}ms" for q, value in values.items()))
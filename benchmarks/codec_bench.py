@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of the Kafka message codecs.
+
+Compares the encode and decode cost and the wire size of a customer change
+for every format, with and without lz4 and zstd batch compression.
+
+Run from the project root with:
+
+    python -m benchmarks.codec_bench
+"""
+import json
+import timeit
+import zlib
+
+from app.kafka import codec
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ROUNDS = 20000
+BATCH_SIZE = 500
+
+
+def sample(i: int = 0) -> dict:
+    """
+    Build a customer change message, distinct for every index.
+    """
+    return {
+        "customer_id": 123456 + i,
+        "stripe_customer_id": f"cus_PzX1bT4n{i:06d}",
+        "customer": {"name": f"Customer {i}", "email": f"customer.{i}@example.com"},
+    }
+
+
+def compressors():
+    """
+    Get the batch compressors available in this environment, by name.
+    """
+    found = {"gzip": lambda data: zlib.compress(data, 6)}
+    if lz4 is not None:
+        found["lz4"] = lz4.frame.compress
+    if zstandard is not None:
+        found["zstd"] = zstandard.ZstdCompressor().compress
+    return found
+
+
+def bench(name, encode, decode):
+    """
+    Time the encoding and decoding of a message and measure its size.
+    """
+    data = sample()
+    value = encode(data)
+    encode_us = timeit.timeit(lambda: encode(data), number=ROUNDS) / ROUNDS * 1e6
+    decode_us = timeit.timeit(lambda: decode(value), number=ROUNDS) / ROUNDS * 1e6
+
+    # a producer batch of similar messages, as compressed by the broker client
+    batch = b"".join(encode(sample(i)) for i in range(BATCH_SIZE))
+    sizes = {compressor: len(compress(batch)) / BATCH_SIZE
+             for compressor, compress in compressors().items()}
+    print(f"{name:<16} encode {encode_us:6.2f}us  decode {decode_us:6.2f}us  size {len(value):4d}B  " +
+          "  ".join(f"{compressor} {size:6.1f}B" for compressor, size in sizes.items()))
+
+
+if __name__ == "__main__":
+    print(f"{ROUNDS} rounds, compressed sizes per message in batches of {BATCH_SIZE}")
+    bench("stdlib json",
+          lambda data: json.dumps(data).encode('utf-8'),
+          lambda value: codec.CustomerChange(**json.loads(value.decode('utf-8'))))
+    for format in codec.ENCODERS:
+        bench(f"codec {format}",
+              lambda data: codec.encode(data, format)[0],
+              lambda value: codec.decode_value(value, format))
@@ -0,0 +1,173 @@
+"""
+In-process stand-in for the Stripe API used by the benchmarks.
+"""
+import itertools
+import json
+import threading
+import time
+
+from bisect import bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeStripe:
+    """
+    Local HTTP server answering the Stripe customer endpoints KafSync uses,
+    with a fixed latency per request and an optional rate limit answered with 429s.
+    Writes repeating an idempotency key get the response of the first one.
+    """
+
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0) -> None:
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._order: List[str] = []
+        self._customers: Dict[str, Dict] = {}
+        self._window = (0.0, 0)
+        self._idempotent: Dict[str, Tuple[int, Dict]] = {}
+        self._server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> "FakeStripe":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+    def add_customer(self, name: str, email: str, metadata: Dict[str, str] = None) -> Dict:
+        """
+        Create a customer directly in the store, without going through HTTP.
+        """
+        with self._lock:
+            customer_id = f"cus_{next(self._ids):012d}"
+            customer = {"id": customer_id, "object": "customer", "name": name, "email": email,
+                        "metadata": metadata or {}, "created": int(time.time())}
+            self._order.append(customer_id)
+            self._customers[customer_id] = customer
+        return customer
+
+    def customers(self) -> List[Dict]:
+        with self._lock:
+            return list(self._customers.values())
+
+    def _admit(self) -> bool:
+        """
+        Count a request against the rate limit of the current second.
+        """
+        with self._lock:
+            self.requests += 1
+            if not self.rate_limit:
+                return True
+            second, count = self._window
+            now = int(time.monotonic())
+            if now != second:
+                second, count = now, 0
+            self._window = (second, count + 1)
+            if count < self.rate_limit:
+                return True
+            self.rate_limited += 1
+            return False
+
+    def _list(self, query: Dict[str, List[str]]) -> Dict:
+        limit = int(query.get("limit", ["10"])[0])
+        with self._lock:
+            start = 0
+            if "starting_after" in query:
+                start = bisect_right(self._order, query["starting_after"][0])
+            data = []
+            for customer_id in self._order[start:]:
+                if customer_id in self._customers:
+                    data.append(self._customers[customer_id])
+                    if len(data) > limit:
+                        break
+        return {"object": "list", "url": "/v1/customers", "data": data[:limit], "has_more": len(data) > limit}
+
+    def _write(self, method: str, path: str, form: Dict[str, List[str]]) -> Tuple[int, Dict]:
+        fields = {key: values[0] for key, values in form.items()}
+        metadata = {key[len("metadata["):-1]: value for key, value in fields.items()
+                    if key.startswith("metadata[")}
+        parts = path.strip("/").split("/")
+        if method == "POST" and len(parts) == 2:
+            return 200, self.add_customer(fields.get("name"), fields.get("email"), metadata)
+
+        with self._lock:
+            customer = self._customers.get(parts[2]) if len(parts) == 3 else None
+            if customer is None:
+                return 404, {"error": {"type": "invalid_request_error", "code": "resource_missing",
+                                       "message": f"No such customer: '{parts[-1]}'"}}
+            if method == "DELETE":
+                del self._customers[parts[2]]
+                return 200, {"id": parts[2], "object": "customer", "deleted": True}
+            customer.update({key: value for key, value in fields.items() if key in ("name", "email")})
+            customer["metadata"].update(metadata)
+            return 200, customer
+
+    def _handler_class(self):
+        stripe = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, Nagle would hold the body back
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _reply(self, status: int, body: Dict) -> None:
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _serve(self, method: str) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                form = parse_qs(self.rfile.read(length).decode()) if length else {}
+                if stripe.latency:
+                    time.sleep(stripe.latency)
+                if not stripe._admit():
+                    self._reply(429, {"error": {"type": "invalid_request_error", "code": "rate_limit",
+                                                "message": "Too many requests"}})
+                    return
+                url = urlparse(self.path)
+                if method == "GET" and url.path == "/v1/customers":
+                    self._reply(200, stripe._list(parse_qs(url.query)))
+                elif method == "GET" and url.path == "/v1/events":
+                    self._reply(200, {"object": "list", "url": "/v1/events", "data": [], "has_more": False})
+                elif url.path.startswith("/v1/customers"):
+                    key = self.headers.get("Idempotency-Key")
+                    with stripe._lock:
+                        response = stripe._idempotent.get(key) if key else None
+                    if response is None:
+                        response = stripe._write(method, url.path, form)
+                        if key:
+                            with stripe._lock:
+                                stripe._idempotent[key] = response
+                    self._reply(*response)
+                else:
+                    self._reply(404, {"error": {"type": "invalid_request_error", "message": "Unknown path"}})
+
+            def do_GET(self) -> None:
+                self._serve("GET")
+
+            def do_POST(self) -> None:
+                self._serve("POST")
+
+            def do_DELETE(self) -> None:
+                self._serve("DELETE")
+
+        return Handler
@@ -0,0 +1,225 @@
+"""
+Throughput benchmark of the KafSync pipeline, fully offline.
+
+Drives the real code paths (API CRUD, outbox relay, consumer handlers,
+webhook handling and the poller's full reconcile) against the in-process
+transport and a local fake Stripe server. Every size runs in a
+fresh process with its own SQLite database, and reports messages per
+second, p50/p99 latency per call and peak traced memory per stage.
+
+Run from the project root with:
+
+    python -m benchmarks.pipeline_bench --sizes 1000,10000,100000 --label baseline
+    python -m benchmarks.pipeline_bench --sizes 1000,10000 --compare benchmarks/results/baseline.json
+"""
+import argparse
+import gc
+import importlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from typing import Callable, Dict, Iterable, List, Union
+
+from benchmarks.fakes import FakeStripe
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+RELAY_BATCH_SIZE = 500
+PAGE_SIZE = 100
+# share of Stripe customers renamed before the full reconcile
+RECONCILE_CHANGE_RATE = 0.1
+
+
+def measure(name: str, items: Iterable, fn: Callable, trace_memory: bool) -> Dict:
+    """
+    Call a function for every item and collect its throughput, latency and memory peak.
+
+    The function returns the number of messages a call processed, None counting as one.
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    latencies, messages = [], 0
+    start = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        processed = fn(item)
+        latencies.append(time.perf_counter() - call_start)
+        messages += 1 if processed is None else processed
+    seconds = time.perf_counter() - start
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+
+    def percentile(q: float) -> Union[float, None]:
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+    result = {
+        "messages": messages,
+        "seconds": round(seconds, 4),
+        "msgs_per_sec": round(messages / seconds, 1) if seconds else None,
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+        "peak_mib": round(peak / 2 ** 20, 2) if trace_memory else None,
+    }
+    print(f"  {name:<28} {messages:>8} msgs  {result['msgs_per_sec'] or 0:>10.1f} msgs/s  "
+          f"p50 {result['p50_ms'] or 0:8.3f}ms  p99 {result['p99_ms'] or 0:8.3f}ms  "
+          f"peak {result['peak_mib'] or 0:8.2f}MiB", file=sys.stderr)
+    return result
+
+
+def run_size(size: int, args: argparse.Namespace) -> Dict[str, Dict]:
+    """
+    Run every stage for a number of customers, in the current process.
+    """
+    stripe_server = FakeStripe(args.stripe_latency_ms / 1000, args.stripe_rate_limit).start()
+    workdir = tempfile.mkdtemp(prefix="kafsync-bench-")
+    # configure the app before it is imported, its clients read the environment at import time
+    os.environ.update({
+        "SQLALCHEMY_DATABASE_URL": f"sqlite:///{workdir}/bench.db",
+        "STRIPE_API_KEY": "sk_test_benchmark",
+        "STRIPE_API_BASE": stripe_server.url,
+        "STRIPE_RATE_LIMIT": str(args.client_rate_limit),
+        "STRIPE_RETRY_BASE_DELAY": "0.05",
+        "KAFSYNC_TRANSPORT": "inprocess",
+    })
+
+    from app.kafka import relay, topics, transport
+    from app.kafka import consumer
+    from app.sql import crud, database, models, schemas
+    from app.stripeapp import crud as stripe_crud, webhook
+    poller = importlib.import_module("app.schedule-poll")
+
+    # one group per topic, so every stage reads the messages of the previous one
+    readers = {topic: transport.get_transport().create_consumer({"group.id": f"benchmark-{topic}"})
+               for topic in (topics.LOCAL_TO_STRIPE, topics.STRIPE_TO_LOCAL)}
+    for topic, reader in readers.items():
+        reader.subscribe([topic])
+
+    def take(topic: str) -> List:
+        return readers[topic].consume(2 * size + 1, 0)
+
+    models.Base.metadata.create_all(bind=database.engine)
+    db = database.SessionLocal()
+    trace_memory = not args.no_memory
+    results = {}
+
+    customers = [schemas.Customer(name=f"Customer {i}", email=f"customer.{i}@example.com")
+                 for i in range(size)]
+    results["api.create_customer"] = measure(
+        "api.create_customer", customers, lambda customer: crud.create_customer(db, customer) and None, trace_memory)
+
+    results["relay.outbox"] = measure(
+        "relay.outbox", range(math.ceil(size / RELAY_BATCH_SIZE)),
+        lambda _: relay.relay_batch(db, RELAY_BATCH_SIZE), trace_memory)
+
+    results["consumer.local_to_stripe"] = measure(
+        "consumer.local_to_stripe", take(topics.LOCAL_TO_STRIPE), consumer.handle_message, trace_memory)
+
+    now = int(time.time())
+    events = [{"id": f"evt_{i}", "object": "event", "type": "customer.updated", "created": now,
+               "data": {"object": {**customer, "name": f"{customer['name']} (renamed)"}}}
+              for i, customer in enumerate(stripe_server.customers())]
+    results["webhook.handle_event"] = measure(
+        "webhook.handle_event", events, lambda event: webhook.handle_event(event, db), trace_memory)
+
+    results["consumer.stripe_to_local"] = measure(
+        "consumer.stripe_to_local", take(topics.STRIPE_TO_LOCAL), consumer.handle_message, trace_memory)
+
+    for customer in stripe_server.customers()[:int(size * RECONCILE_CHANGE_RATE)]:
+        customer["name"] = f"{customer['name']} (reconciled)"
+    results["poller.full_reconcile"] = measure(
+        "poller.full_reconcile", [None],
+        lambda _: poller.sync_customer(db, stripe_crud.iter_customers(PAGE_SIZE)) or size, trace_memory)
+    take(topics.STRIPE_TO_LOCAL)
+
+    results["stripe"] = {"requests": stripe_server.requests,
+                         "rate_limited": stripe_server.rate_limited}
+    stripe_server.stop()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(current: Dict, baseline: Dict) -> None:
+    """
+    Print the throughput and p99 change of every stage against a previous run.
+    """
+    print(f"\nCompared to {baseline['label']} ({baseline['commit']}):")
+    for size, stages in current["results"].items():
+        for stage, result in stages.items():
+            previous = baseline["results"].get(size, {}).get(stage)
+            if stage == "stripe" or not previous or not previous.get("msgs_per_sec"):
+                continue
+            throughput = (result["msgs_per_sec"] / previous["msgs_per_sec"] - 1) * 100
+            p99 = (result["p99_ms"] / previous["p99_ms"] - 1) * 100 if previous.get("p99_ms") else 0
+            print(f"  {size:>7} {stage:<28} throughput {throughput:+7.1f}%  p99 {p99:+7.1f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma separated numbers of customers")
+    parser.add_argument("--stripe-latency-ms", type=float, default=0.0,
+                        help="latency added by the fake Stripe server to every request")
+    parser.add_argument("--stripe-rate-limit", type=float, default=0.0,
+                        help="requests per second the fake Stripe server accepts before answering 429, 0 for none")
+    parser.add_argument("--client-rate-limit", type=float, default=0.0,
+                        help="STRIPE_RATE_LIMIT of the gateway, 0 for unlimited")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip tracemalloc, which slows every stage down")
+    parser.add_argument("--label", default=time.strftime("%Y%m%d-%H%M%S"),
+                        help="name of the results file")
+    parser.add_argument("--compare", help="results file of a previous run")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(run_size(args.worker, args)))
+        return
+
+    report = {
+        "label": args.label,
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("worker", "compare", "label")},
+        "results": {},
+    }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print(f"{size} customers", file=sys.stderr)
+        # a fresh process per size, so no state or memory is shared between runs
+        worker = subprocess.run([sys.executable, "-m", "benchmarks.pipeline_bench", "--worker", str(size)] +
+                                sys.argv[1:], stdout=subprocess.PIPE, text=True, check=True)
+        report["results"][str(size)] = json.loads(worker.stdout.strip().splitlines()[-1])
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{args.label}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {path}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
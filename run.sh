@@ -29,7 +29,10 @@ lt -p 8000
 ### Webhook Endpoint URL would look like https://{public_URL}/api/v1/customers/webhook
 
 
-# Step 7: Start the Kafka Consumer
-python -m app.kafka.consumer.py &
+# Step 7: Start the Kafka Consumers, in processes per sync direction
+python -m app.kafka.supervisor &
+
+# Step 8: Start the Outbox Relay
+python -m app.kafka.relay &
 
 echo "KafSync is now running. Access the API at http://localhost:8000/docs."